@@ -0,0 +1,116 @@
+"""
+Async SMTP Transport
+Drives many SMTP sessions concurrently on a single asyncio event loop.
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, Optional
+
+try:
+    import aiosmtplib
+except ImportError:  # optional dependency, only needed for the async send path
+    aiosmtplib = None
+
+from smtp_pool import DEFAULT_POOL_SETTINGS, RECONNECT_CODES
+
+
+class AsyncSMTPSender:
+    """Pool of aiosmtplib connections shared by coroutines on one event loop."""
+
+    def __init__(self, smtp_config: Dict, max_connections: int = 100,
+                 logger: Optional[logging.Logger] = None):
+        if aiosmtplib is None:
+            raise RuntimeError("The async send path requires aiosmtplib (pip install aiosmtplib)")
+        self.smtp_config = smtp_config
+        settings = dict(DEFAULT_POOL_SETTINGS)
+        settings.update(smtp_config.get('pool', {}))
+        self.max_messages_per_session = int(settings['max_messages_per_session'])
+        self.timeout = float(settings['timeout'])
+        self.max_connections = max(1, int(max_connections))
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._idle: List = []
+        self._message_counts: Dict[int, int] = {}
+        self._slots = asyncio.Semaphore(self.max_connections)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def send_message(self, msg, from_addr: Optional[str] = None,
+                           to_addrs: Optional[List[str]] = None):
+        """Send a message, reconnecting once on 421 or a dropped connection."""
+        async with self._slots:
+            client = await self._acquire()
+            try:
+                try:
+                    response = await client.send_message(msg, sender=from_addr, recipients=to_addrs)
+                except aiosmtplib.SMTPServerDisconnected:
+                    client = await self._reconnect(client)
+                    response = await client.send_message(msg, sender=from_addr, recipients=to_addrs)
+                except aiosmtplib.SMTPResponseException as e:
+                    if e.code not in RECONNECT_CODES:
+                        raise
+                    client = await self._reconnect(client)
+                    response = await client.send_message(msg, sender=from_addr, recipients=to_addrs)
+            except Exception:
+                await self._release(client, failed=True)
+                raise
+            self._message_counts[id(client)] = self._message_counts.get(id(client), 0) + 1
+            await self._release(client)
+            return response
+
+    async def close(self):
+        """Close every idle connection."""
+        idle, self._idle = self._idle, []
+        for client in idle:
+            await self._disconnect(client)
+
+    async def _connect(self):
+        client = aiosmtplib.SMTP(
+            hostname=self.smtp_config['server'],
+            port=self.smtp_config['port'],
+            username=self.smtp_config.get('username') or None,
+            password=self.smtp_config.get('password') or None,
+            start_tls=bool(self.smtp_config.get('use_tls')),
+            timeout=self.timeout
+        )
+        await client.connect()
+        self._message_counts[id(client)] = 0
+        return client
+
+    async def _acquire(self):
+        while self._idle:
+            client = self._idle.pop()
+            if client.is_connected:
+                return client
+            self._message_counts.pop(id(client), None)
+        return await self._connect()
+
+    async def _reconnect(self, client):
+        await self._disconnect(client)
+        return await self._connect()
+
+    async def _release(self, client, failed: bool = False):
+        spent = self._message_counts.get(id(client), 0) >= self.max_messages_per_session
+        if not client.is_connected or spent:
+            await self._disconnect(client)
+            return
+        if failed:
+            try:
+                await client.rset()
+            except Exception:
+                await self._disconnect(client)
+                return
+        self._idle.append(client)
+
+    async def _disconnect(self, client):
+        self._message_counts.pop(id(client), None)
+        try:
+            if client.is_connected:
+                await client.quit()
+        except Exception:
+            client.close()
@@ -0,0 +1,164 @@
+"""
+Attachment Cache
+Base64-encodes each attachment once and reuses the encoded MIME part.
+"""
+
+import base64
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from email.mime.base import MIMEBase
+from email.utils import encode_rfc2231
+from typing import Iterator, Tuple, Union
+
+from message_builder import encode_header
+
+CRLF = b"\r\n"
+
+# base64 turns 57 input bytes into one 76-character line
+LINE_INPUT_BYTES = 57
+
+
+def encode_attachment(file_path: str) -> bytes:
+    """Read and base64-encode a file as an application/octet-stream part body."""
+    with open(file_path, "rb") as attachment:
+        data = attachment.read()
+    encoded = base64.encodebytes(data)
+    if encoded.endswith(b"\n"):
+        encoded = encoded[:-1]
+    return encoded.replace(b"\n", CRLF)
+
+
+def content_disposition(file_path: str) -> str:
+    """The Content-Disposition value for an attachment.
+
+    Non-ASCII file names are encoded as RFC 2231 parameters, as
+    Message.add_header(..., filename=name) writes them, so the header
+    stays 7-bit.
+    """
+    name = os.path.basename(file_path)
+    if name.isascii():
+        return f'attachment; filename= {name}'
+    return f"attachment; filename*={encode_rfc2231(name, 'utf-8')}"
+
+
+def attachment_headers(file_path: str) -> bytes:
+    """Part headers matching MIMEBase + encode_base64 + Content-Disposition."""
+    return (b'Content-Type: application/octet-stream\r\n'
+            b'MIME-Version: 1.0\r\n'
+            b'Content-Transfer-Encoding: base64\r\n'
+            + encode_header('Content-Disposition', content_disposition(file_path))
+            + CRLF)
+
+
+class StreamedAttachment:
+    """An attachment part that is base64-encoded from a memory map while it is sent.
+
+    Only one chunk of encoded output exists at a time, so memory use does not
+    grow with the file size.
+    """
+
+    def __init__(self, file_path: str, chunk_lines: int = mmap.PAGESIZE):
+        self.file_path = file_path
+        self.headers = attachment_headers(file_path)
+        self.file_size = os.path.getsize(file_path)
+        self.chunk_lines = chunk_lines
+
+    def __len__(self) -> int:
+        lines = -(-self.file_size // LINE_INPUT_BYTES)
+        encoded = 4 * -(-self.file_size // 3)
+        return len(self.headers) + encoded + 2 * max(lines - 1, 0)
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        """Yield the part headers, then the body as CRLF-separated base64 lines."""
+        yield self.headers
+        if not self.file_size:
+            return
+        step = LINE_INPUT_BYTES * self.chunk_lines
+        with open(self.file_path, "rb") as attachment, \
+                mmap.mmap(attachment.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            for offset in range(0, self.file_size, step):
+                chunk = base64.encodebytes(mapped[offset:offset + step])[:-1]
+                # Release the encoded pages; madvise needs a page-aligned start
+                if hasattr(mmap, 'MADV_DONTNEED'):
+                    start = offset - offset % mmap.PAGESIZE
+                    mapped.madvise(mmap.MADV_DONTNEED, start,
+                                   min(offset + step, self.file_size) - start)
+                if offset:
+                    yield CRLF
+                yield chunk.replace(b"\n", CRLF)
+
+
+class AttachmentCache:
+    """Thread-safe LRU cache of encoded attachment parts with a memory cap.
+
+    Entries are keyed by path, mtime and size, so a changed file is
+    re-encoded. Files larger than the cap are encoded on every use, and files
+    of stream_threshold bytes or more are streamed instead of encoded up front.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024,
+                 stream_threshold: int = 8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.stream_threshold = stream_threshold
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[Tuple, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_part(self, file_path: str) -> Union[bytes, StreamedAttachment]:
+        """Return the serialized MIME part (headers and base64 body) for a file.
+
+        Large files come back as a StreamedAttachment to be encoded on the fly.
+        """
+        stat = os.stat(file_path)
+        if stat.st_size >= self.stream_threshold:
+            return StreamedAttachment(file_path)
+        key = (os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            part = self._entries.get(key)
+            if part is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return part
+            self.misses += 1
+
+        part = attachment_headers(file_path) + encode_attachment(file_path)
+        if len(part) <= self.max_bytes:
+            self._store(key, part)
+        return part
+
+    def get_mime_part(self, file_path: str) -> MIMEBase:
+        """Return a MIMEBase attachment whose payload is already base64-encoded."""
+        part_bytes = self.get_part(file_path)
+        if isinstance(part_bytes, StreamedAttachment):
+            # A MIME object holds its whole payload, so this path cannot stream
+            part_bytes = attachment_headers(file_path) + encode_attachment(file_path)
+        body = part_bytes.split(b"\r\n\r\n", 1)[1]
+        part = MIMEBase('application', 'octet-stream')
+        part.set_payload(body.decode('ascii'))
+        part['Content-Transfer-Encoding'] = 'base64'
+        part.add_header('Content-Disposition', content_disposition(file_path))
+        return part
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def _store(self, key: Tuple, part: bytes):
+        with self._lock:
+            if key in self._entries:
+                return
+            # Drop stale versions of the same path before evicting others
+            for stale in [k for k in self._entries if k[0] == key[0]]:
+                self.current_bytes -= len(self._entries.pop(stale))
+            while self._entries and self.current_bytes + len(part) > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= len(evicted)
+            self._entries[key] = part
+            self.current_bytes += len(part)
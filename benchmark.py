@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+Send Throughput Benchmark
+Runs send_bulk_emails against the local SMTP sink with synthetic customers,
+or compares template renderers with --mode render.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from email_automation import EmailAutomation
+from template_engine import JinjaEngine
+
+BENCHMARK_HTML = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <title>Monthly Newsletter</title>
+    <style>
+        body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; }
+        .container { max-width: 600px; margin: 0 auto; padding: 20px; }
+        .article { margin-bottom: 20px; padding: 15px; border-left: 4px solid #2196F3; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h2>Hello {{first_name}},</h2>
+        <p>Here is what happened at {{company}} this month.</p>
+""" + """        <div class="article">
+            <h3>Product update</h3>
+            <p>We shipped improvements across the board. Read more on our blog.</p>
+        </div>
+""" * 8 + """        <p>Sent to {{email}}. Thanks, {{full_name}}!</p>
+    </div>
+</body>
+</html>
+"""
+
+BENCHMARK_TEXT = """Hello {{first_name}},
+
+Here is what happened at {{company}} this month.
+
+Sent to {{email}}. Thanks, {{full_name}}!
+"""
+
+# The same newsletter written with a Jinja2 loop and conditional
+BENCHMARK_JINJA_HTML = BENCHMARK_HTML.split('        <div class="article">')[0] + """\
+{% for title in ["Product update", "Events", "Customer stories", "Tips", "Security", "Roadmap", "Team", "Support"] %}
+        <div class="article">
+            <h3>{{ title }}</h3>
+            <p>We shipped improvements across the board. Read more on our blog.</p>
+        </div>
+{% endfor %}
+        <p>Sent to {{ email }}.{% if first_name %} Thanks, {{ full_name }}!{% endif %}</p>
+    </div>
+</body>
+</html>
+"""
+
+
+def replace_personalize(content: str, customer: Dict) -> str:
+    """The original str.replace renderer, kept as the baseline for --mode render."""
+    replacements = {
+        '{{first_name}}': customer.get('first_name', ''),
+        '{{last_name}}': customer.get('last_name', ''),
+        '{{email}}': customer.get('email', ''),
+        '{{company}}': customer.get('company', ''),
+        '{{phone}}': customer.get('phone', ''),
+        '{{full_name}}': f"{customer.get('first_name', '')} {customer.get('last_name', '')}".strip()
+    }
+    for placeholder, value in replacements.items():
+        content = content.replace(placeholder, value)
+    return content
+
+
+class TimedEmailAutomation(EmailAutomation):
+    """EmailAutomation that records how long each SMTP transmission takes."""
+
+    def __init__(self, config_file: str):
+        self.latencies: List[float] = []
+        super().__init__(config_file)
+
+    def _transmit(self, msg, session=None, from_addr=None, to_addrs=None):
+        start = time.perf_counter()
+        try:
+            return super()._transmit(msg, session, from_addr, to_addrs)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+    async def _send_prepared_async(self, to_email, msg, sender=None):
+        start = time.perf_counter()
+        try:
+            return await super()._send_prepared_async(to_email, msg, sender)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def start_sink(args) -> Tuple[subprocess.Popen, int]:
+    """Start smtp_sink.py in its own process so it does not skew CPU figures."""
+    sink_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "smtp_sink.py")
+    process = subprocess.Popen(
+        [sys.executable, sink_script, "--port", "0",
+         "--latency", str(args.latency), "--error-rate", str(args.error_rate),
+         "--disconnect-rate", str(args.disconnect_rate), "--seed", "1"],
+        stdout=subprocess.PIPE, text=True
+    )
+    line = process.stdout.readline()
+    return process, int(line.rsplit(":", 1)[1])
+
+
+def write_config(workdir: str, port: int, args) -> str:
+    """Write a throwaway config whose files all live in workdir; returns its path."""
+    config = {
+        "smtp": {
+            "server": "127.0.0.1",
+            "port": port,
+            "username": "bench@example.com",
+            "password": "bench",
+            "use_tls": False,
+            "pipelining": not args.no_pipelining,
+            "pool": {"max_sessions": max(args.concurrency, 1)}
+        },
+        "email_settings": {
+            "from_name": "Benchmark",
+            "reply_to": "noreply@example.com",
+            "max_emails_per_batch": 50,
+            "delay_between_emails": 0,
+            "concurrency": args.concurrency,
+            "async_concurrency": args.concurrency,
+            "max_recipients_per_message": 1
+        },
+        "rate_limits": {},
+        "outbox": {"enabled": False},
+        "templates": {"jinja_bytecode_cache": os.path.join(workdir, "jinja_cache")},
+        "database": {"file": os.path.join(workdir, "bench.db")}
+    }
+    config_file = os.path.join(workdir, "config.json")
+    with open(config_file, "w") as f:
+        json.dump(config, f, indent=4)
+    return config_file
+
+
+def seed_customers(db_path: str, count: int):
+    """Insert synthetic customers directly; the import path is not what is measured."""
+    conn = sqlite3.connect(db_path)
+    conn.executemany(
+        "INSERT INTO customers (email, first_name, last_name, company, phone, status) "
+        "VALUES (?, ?, ?, ?, ?, 'active')",
+        ((f"user{i}@domain{i % 50}.example", f"First{i}", f"Last{i}",
+          f"Company {i % 500}", f"555-{i:07d}") for i in range(count))
+    )
+    conn.commit()
+    conn.close()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_one(count: int, port: int, args, results: multiprocessing.Queue):
+    """Benchmark one customer count in a fresh process (for a clean peak RSS)."""
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        config_file = write_config(workdir, port, args)
+        automation = TimedEmailAutomation(config_file)
+        automation.logger.setLevel(logging.WARNING)
+        seed_customers(automation.db_path, count)
+        automation.create_email_template("benchmark", "News for {{first_name}} at {{company}}",
+                                         BENCHMARK_HTML, BENCHMARK_TEXT)
+
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        if args.mode == "async":
+            summary = asyncio.run(automation.send_bulk_emails_async("benchmark"))
+        else:
+            summary = automation.send_bulk_emails("benchmark")
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        automation.close()
+
+    latencies = automation.latencies
+    results.put({
+        "customers": count,
+        "sent": summary["sent"],
+        "failed": summary["failed"],
+        "seconds": round(wall, 3),
+        "messages_per_second": round(summary["sent"] / wall, 1) if wall else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "cpu_seconds": round(cpu, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    })
+
+
+def run_render(count: int, args) -> List[Dict]:
+    """Time personalization of all three parts per customer with each renderer; nothing is sent."""
+    customers = [{"email": f"user{i}@domain{i % 50}.example", "first_name": f"First{i}",
+                  "last_name": f"Last{i}", "company": f"Company {i % 500}", "phone": f"555-{i:07d}"}
+                 for i in range(count)]
+    subject = "News for {{first_name}} at {{company}}"
+    # Runs in the main process, so paths are passed explicitly instead of changing directory
+    with tempfile.TemporaryDirectory() as workdir:
+        automation = EmailAutomation(write_config(workdir, 0, args))
+        automation.logger.setLevel(logging.WARNING)
+        renderers = [
+            ("str.replace (original)", lambda customer: [replace_personalize(part, customer)
+                                                         for part in (subject, BENCHMARK_HTML, BENCHMARK_TEXT)]),
+            ("compiled placeholders", lambda customer: automation.personalize_parts(
+                customer, subject, BENCHMARK_HTML, BENCHMARK_TEXT)),
+            ("jinja2, fields only", lambda customer: automation.personalize_parts(
+                customer, subject, BENCHMARK_HTML, BENCHMARK_TEXT, "jinja2")),
+            ("jinja2, loop and if", lambda customer: automation.personalize_parts(
+                customer, subject, BENCHMARK_JINJA_HTML, BENCHMARK_TEXT, "jinja2")),
+        ]
+        rows = []
+        for name, render in renderers:
+            render(customers[0])  # compile outside the timed loop
+            start = time.perf_counter()
+            for customer in customers:
+                render(customer)
+            elapsed = time.perf_counter() - start
+            rows.append({"renderer": name, "customers": count,
+                         "renders_per_second": round(count / elapsed, 1) if elapsed else 0.0,
+                         "us_per_customer": round(elapsed / count * 1e6, 2)})
+        
+        # A fresh engine compiles from source, or loads the code another process cached.
+        # The cache directory is new, so only the priming compile below fills it.
+        cache_dir = os.path.join(workdir, "compile_cache")
+        JinjaEngine(cache_dir).compile(BENCHMARK_JINJA_HTML, html=True)
+        for label, engine_cache in (("jinja2 compile, no cache", None),
+                                    ("jinja2 compile, bytecode cache", cache_dir)):
+            repeats = 20
+            start = time.perf_counter()
+            for _ in range(repeats):
+                JinjaEngine(engine_cache).compile(BENCHMARK_JINJA_HTML, html=True)
+            elapsed = (time.perf_counter() - start) / repeats
+            rows.append({"renderer": label, "customers": 1, "renders_per_second": 0.0,
+                         "us_per_customer": round(elapsed * 1e6, 2)})
+        automation.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark bulk sending against a local SMTP sink")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--mode", choices=["threads", "async", "render"], default="threads",
+                        help="send_bulk_emails (serial when --concurrency is 1), the async path, "
+                             "or template rendering only")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="sink round-trip latency in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0)
+    parser.add_argument("--no-pipelining", action="store_true")
+    parser.add_argument("--json", help="also write results to this file")
+    args = parser.parse_args()
+
+    if args.mode == "render":
+        rows = [row for count in args.sizes for row in run_render(count, args)]
+        print(f"{'Renderer':<32} {'Customers':>10} {'Renders/s':>11} {'us each':>10}")
+        print("-" * 66)
+        for row in rows:
+            print(f"{row['renderer']:<32} {row['customers']:>10} {row['renders_per_second']:>11} "
+                  f"{row['us_per_customer']:>10}")
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(rows, f, indent=4)
+        return
+
+    sink, port = start_sink(args)
+    context = multiprocessing.get_context("spawn")
+    rows: List[Dict] = []
+    try:
+        for count in args.sizes:
+            results = context.Queue()
+            worker = context.Process(target=run_one, args=(count, port, args, results))
+            worker.start()
+            rows.append(results.get())
+            worker.join()
+    finally:
+        sink.terminate()
+        sink.wait()
+
+    print(f"{'Customers':>10} {'Sent':>8} {'Failed':>7} {'Msg/s':>9} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'CPU s':>8} {'RSS MB':>8}")
+    print("-" * 74)
+    for row in rows:
+        print(f"{row['customers']:>10} {row['sent']:>8} {row['failed']:>7} "
+              f"{row['messages_per_second']:>9} {row['p50_ms']:>8} {row['p99_ms']:>8} "
+              f"{row['cpu_seconds']:>8} {row['peak_rss_mb']:>8}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Bulk Run Checkpoints
+Persists bulk send progress so an interrupted run can be resumed.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from connection_manager import ConnectionManager
+
+# Counts one sent email for a customer; run with executemany per flush
+STATS_UPDATE = '''
+    UPDATE customers
+    SET last_email_sent = CURRENT_TIMESTAMP,
+        email_count = email_count + 1
+    WHERE id = ?
+'''
+
+
+class BulkRunCheckpoint:
+    """Buffers per-recipient results of a bulk run and writes them in batches.
+
+    Each flush is one transaction that stores the buffered recipient rows,
+    updates the email stats of the customers sent to, adds to the run's
+    sent/failed totals and advances the cursor: the highest customer id
+    such that every customer up to it is done. A crash loses at most one
+    unflushed batch, whose recipients are sent again (and counted once) on
+    resume.
+    """
+
+    def __init__(self, connections: ConnectionManager, run_id: int, customer_ids: Iterable[int],
+                 batch_size: int = 500, flush_interval: float = 1.0, track_cursor: bool = True):
+        self.connections = connections
+        self.run_id = run_id
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.track_cursor = track_cursor
+        self._order: List[int] = sorted(customer_ids)
+        self._position = 0
+        self._done: Set[int] = set()
+        self._pending: List[tuple] = []
+        self._sent = 0
+        self._failed = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def create_run(connections: ConnectionManager, template_name: str, customer_filter: str,
+                   max_customer_id: Optional[int], attachments: Optional[List[str]]) -> int:
+        """Insert a bulk_runs row and return its run id."""
+        conn = connections.connection()
+        with conn:
+            cursor = conn.execute('''
+                INSERT INTO bulk_runs (template_name, customer_filter, max_customer_id, attachments)
+                VALUES (?, ?, ?, ?)
+            ''', (template_name, customer_filter, max_customer_id,
+                  json.dumps(attachments) if attachments else None))
+        return cursor.lastrowid
+
+    @staticmethod
+    def load_run(connections: ConnectionManager, run_id: int) -> Optional[Dict]:
+        """The bulk_runs row for run_id as a dict, or None."""
+        # The connection is shared, so rows are only turned into dicts on this cursor
+        cursor = connections.connection().cursor()
+        cursor.row_factory = sqlite3.Row
+        row = cursor.execute("SELECT * FROM bulk_runs WHERE id = ?", (run_id,)).fetchone()
+        if row is None:
+            return None
+        run = dict(row)
+        run['attachments'] = json.loads(run['attachments']) if run['attachments'] else None
+        return run
+
+    @staticmethod
+    def done_customer_ids(connections: ConnectionManager, run_id: int, after_id: int = 0) -> Set[int]:
+        """Ids above after_id of customers that already have a recorded result in the run."""
+        rows = connections.connection().execute('''
+            SELECT customer_id FROM bulk_run_recipients WHERE run_id = ? AND customer_id > ?
+        ''', (run_id, after_id)).fetchall()
+        return {row[0] for row in rows}
+
+    @staticmethod
+    def set_status(connections: ConnectionManager, run_id: int, status: str):
+        conn = connections.connection()
+        with conn:
+            conn.execute('''
+                UPDATE bulk_runs SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+            ''', (status, run_id))
+
+    def record(self, customer_id: int, success: bool, error=None):
+        """Buffer one recipient's result, flushing when the batch is full or old."""
+        with self._lock:
+            self._pending.append((self.run_id, customer_id, 'sent' if success else 'failed',
+                                  None if success else str(error) if error is not None else None))
+            if success:
+                self._sent += 1
+            else:
+                self._failed += 1
+            self._done.add(customer_id)
+            due = (len(self._pending) >= self.batch_size
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+        if due:
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # The batch stays buffered and goes out with the next flush
+                pass
+
+    def flush(self):
+        """Write buffered results, customer stats and the cursor in a single transaction."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            sent, failed = self._sent, self._failed
+            sent_ids = [(row[1],) for row in pending if row[2] == 'sent']
+            self._sent = self._failed = 0
+            while self._position < len(self._order) and self._order[self._position] in self._done:
+                self._done.discard(self._order[self._position])
+                self._position += 1
+            cursor_id = self._order[self._position - 1] if self.track_cursor and self._position else None
+            self._last_flush = time.monotonic()
+            if not pending:
+                return
+            conn = self.connections.connection()
+            try:
+                with conn:
+                    conn.executemany('''
+                        INSERT OR REPLACE INTO bulk_run_recipients (run_id, customer_id, status, error)
+                        VALUES (?, ?, ?, ?)
+                    ''', pending)
+                    conn.executemany(STATS_UPDATE, sent_ids)
+                    conn.execute('''
+                        UPDATE bulk_runs
+                        SET sent = sent + ?, failed = failed + ?,
+                            last_customer_id = MAX(last_customer_id, COALESCE(?, 0)),
+                            updated_at = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (sent, failed, cursor_id, self.run_id))
+            except sqlite3.Error:
+                self._pending = pending + self._pending
+                self._sent += sent
+                self._failed += failed
+                raise
+
+
+class EmailStatsBuffer:
+    """Buffers the email stats of customers sent to outside a checkpointed run.
+
+    Sends are counted in memory and written with one executemany per
+    transaction, every batch_size sends or once flush_interval seconds have
+    passed, instead of a commit per recipient. A crash loses at most one
+    unflushed batch of stats.
+    """
+
+    def __init__(self, connections: ConnectionManager, batch_size: int = 500,
+                 flush_interval: float = 1.0):
+        self.connections = connections
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending: List[tuple] = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add(self, customer_id: int):
+        """Count one sent email, flushing when the batch is full or old."""
+        with self._lock:
+            self._pending.append((customer_id,))
+            due = (len(self._pending) >= self.batch_size
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+        if due:
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # The batch stays buffered and goes out with the next flush
+                pass
+
+    def flush(self):
+        """Write the buffered stats in a single transaction."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._last_flush = time.monotonic()
+            if not pending:
+                return
+            conn = self.connections.connection()
+            try:
+                with conn:
+                    conn.executemany(STATS_UPDATE, pending)
+            except sqlite3.Error:
+                self._pending = pending + self._pending
+                raise
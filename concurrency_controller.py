@@ -0,0 +1,211 @@
+"""
+Adaptive Concurrency
+AIMD control of in-flight SMTP sends per relay and per recipient domain.
+"""
+
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+from outbox import reply_code
+
+# Replies a relay or receiving server uses to ask senders to slow down
+RELAY_DEFERRAL_CODES = (421,)
+DOMAIN_DEFERRAL_CODES = (421, 450, 451)
+
+DEFAULT_ADAPTIVE_SETTINGS = {
+    "enabled": False,
+    "initial": 2,
+    "min": 1,
+    "max": None,
+    "domain_initial": 2,
+    "domain_max": 8,
+    "increase": 1.0,
+    "decrease_factor": 0.5,
+    "latency_tolerance": 2.0
+}
+
+
+def deferral_code(errors: Iterable) -> Optional[int]:
+    """The first 421/450/451 among send errors (421 for a dropped connection), or None."""
+    for error in errors:
+        recipients = getattr(error, 'recipients', None)
+        refusals = recipients.values() if isinstance(recipients, dict) else recipients or [error]
+        for refusal in refusals:
+            code = reply_code(refusal)
+            if code is None and type(refusal).__name__ == 'SMTPServerDisconnected':
+                code = 421
+            if code in DOMAIN_DEFERRAL_CODES:
+                return code
+    return None
+
+
+class AIMDLimit:
+    """Congestion window for one relay or domain.
+
+    Every send that goes through while the window is full adds
+    increase/limit, so the limit grows by `increase` per window of
+    successful sends. A deferral, or a short-term latency average above
+    `latency_tolerance` times the long-term one, multiplies the limit by
+    `decrease_factor`, at most once per round trip.
+    """
+
+    def __init__(self, initial: float, minimum: float, maximum: float, increase: float = 1.0,
+                 decrease_factor: float = 0.5, latency_tolerance: float = 2.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.latency: Optional[float] = None
+        self.baseline_latency: Optional[float] = None
+        self.deferral_rate = 0.0
+        self.samples = 0
+        self.deferrals = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+
+    def has_room(self) -> bool:
+        return self.in_flight < int(self.limit)
+
+    def on_result(self, latency: float, deferred: bool, now: float):
+        self.samples += 1
+        if self.latency is None:
+            self.latency = self.baseline_latency = latency
+        else:
+            self.latency += 0.2 * (latency - self.latency)
+            self.baseline_latency += 0.02 * (latency - self.baseline_latency)
+        self.deferral_rate += 0.05 * ((1.0 if deferred else 0.0) - self.deferral_rate)
+        if deferred:
+            self.deferrals += 1
+
+        congested = (self.samples >= 20
+                     and self.latency > self.baseline_latency * self.latency_tolerance)
+        if deferred or congested:
+            # Sends already in flight saw the same conditions; count them as one signal
+            if now - self._last_decrease >= self.latency:
+                self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                self.decreases += 1
+                self._last_decrease = now
+        elif self.in_flight + 1 >= int(self.limit):
+            # Only grow a window that is in use (in_flight no longer counts this send)
+            self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+
+    def snapshot(self) -> Dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "latency_ms": round(self.latency * 1000, 2) if self.latency is not None else None,
+            "deferral_rate": round(self.deferral_rate, 4),
+            "sends": self.samples,
+            "deferrals": self.deferrals,
+            "decreases": self.decreases
+        }
+
+
+class AdaptiveConcurrency:
+    """Gates bulk sends on an AIMD limit for the relay and one per recipient domain.
+
+    A 421 lowers the relay's limit; 421, 450 and 451 lower the domain's.
+    Latency is tracked for both, so a slowing relay backs off before it
+    starts deferring.
+    """
+
+    def __init__(self, relay: str, settings: Dict):
+        self.relay = relay
+        self.settings = dict(DEFAULT_ADAPTIVE_SETTINGS)
+        self.settings.update(settings)
+        self.max_concurrency = int(self.settings['max'])
+        self.relay_limit = self._new_limit(self.settings['initial'], self.max_concurrency)
+        self.domain_limits: Dict[str, AIMDLimit] = {}
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config: Dict) -> Optional["AdaptiveConcurrency"]:
+        """Build from `adaptive_concurrency`, or None if it is not enabled."""
+        settings = dict(config.get('adaptive_concurrency', {}))
+        if not settings.get('enabled'):
+            return None
+        smtp = config['smtp']
+        if not settings.get('max'):
+            settings['max'] = smtp.get('pool', {}).get('max_sessions', 4)
+        return cls(f"{smtp['server']}:{smtp['port']}", settings)
+
+    def acquire(self, domain: str):
+        """Block until both the relay and `domain` have room for another send."""
+        with self._condition:
+            domain_limit = self._domain(domain)
+            while not (self.relay_limit.has_room() and domain_limit.has_room()):
+                self._condition.wait()
+            self.relay_limit.in_flight += 1
+            domain_limit.in_flight += 1
+
+    def release(self, domain: str, latency: float, code: Optional[int] = None):
+        """Record how a send went; `code` is its deferral reply code, if any."""
+        now = time.monotonic()
+        with self._condition:
+            domain_limit = self._domain(domain)
+            self.relay_limit.in_flight -= 1
+            domain_limit.in_flight -= 1
+            self.relay_limit.on_result(latency, code in RELAY_DEFERRAL_CODES, now)
+            domain_limit.on_result(latency, code in DOMAIN_DEFERRAL_CODES, now)
+            self._condition.notify_all()
+
+    def snapshot(self) -> Dict:
+        with self._condition:
+            return {
+                "relay": dict(self.relay_limit.snapshot(), name=self.relay),
+                "domains": {domain: limit.snapshot() for domain, limit in self.domain_limits.items()}
+            }
+
+    def _domain(self, domain: str) -> AIMDLimit:
+        if domain not in self.domain_limits:
+            self.domain_limits[domain] = self._new_limit(
+                self.settings['domain_initial'], min(self.settings['domain_max'], self.max_concurrency))
+        return self.domain_limits[domain]
+
+    def _new_limit(self, initial: float, maximum: float) -> AIMDLimit:
+        return AIMDLimit(initial, self.settings['min'], maximum, self.settings['increase'],
+                         self.settings['decrease_factor'], self.settings['latency_tolerance'])
+
+
+def merge_snapshots(snapshots: List[Dict]) -> Optional[Dict]:
+    """Combine AdaptiveConcurrency snapshots from controllers that ran side by side.
+
+    Limits and counters are summed; latency and deferral rate are averaged
+    weighted by sends. Limits that never sent are left out unless nothing
+    else reported on that relay or domain.
+    """
+    if not snapshots:
+        return None
+    domains: Dict[str, List[Dict]] = {}
+    for snapshot in snapshots:
+        for domain, limit in snapshot['domains'].items():
+            domains.setdefault(domain, []).append(limit)
+    return {
+        "relay": dict(_merge_limits([s['relay'] for s in snapshots]), name=snapshots[0]['relay']['name']),
+        "domains": {domain: _merge_limits(limits) for domain, limits in domains.items()}
+    }
+
+
+def _merge_limits(limits: List[Dict]) -> Dict:
+    limits = [limit for limit in limits if limit['sends']] or limits[:1]
+    sends = sum(limit['sends'] for limit in limits)
+    timed = [limit for limit in limits if limit['latency_ms'] is not None]
+    timed_sends = sum(limit['sends'] for limit in timed)
+    latency = None
+    if timed:
+        latency = (sum(limit['latency_ms'] * limit['sends'] for limit in timed) / timed_sends
+                   if timed_sends else timed[0]['latency_ms'])
+    return {
+        "limit": round(sum(limit['limit'] for limit in limits), 2),
+        "in_flight": sum(limit['in_flight'] for limit in limits),
+        "latency_ms": round(latency, 2) if latency is not None else None,
+        "deferral_rate": round(sum(limit['deferral_rate'] * limit['sends'] for limit in limits) / sends, 4)
+                         if sends else limits[0]['deferral_rate'],
+        "sends": sends,
+        "deferrals": sum(limit['deferrals'] for limit in limits),
+        "decreases": sum(limit['decreases'] for limit in limits)
+    }
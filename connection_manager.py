@@ -0,0 +1,89 @@
+"""
+Connection Manager
+Long-lived SQLite connections, one per thread, in WAL mode.
+"""
+
+import os
+import sqlite3
+import threading
+from typing import Dict
+
+DEFAULT_DATABASE_SETTINGS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size_kib": 65536,
+    "mmap_size": 268435456,
+    "cached_statements": 256,
+    "busy_timeout_seconds": 30
+}
+
+
+class ConnectionManager:
+    """Hands each thread its own connection and keeps it open.
+
+    Connections are configured once when opened: WAL journaling, so readers
+    see the last committed state without blocking the writer (and the
+    writer does not wait for them); synchronous=NORMAL, which in WAL mode
+    only syncs at checkpoints; and a larger page cache and memory map.
+    Reusing a connection also reuses its compiled statements, up to
+    `cached_statements` distinct SQL strings.
+
+    Connections of threads that have finished are closed when the next
+    one is opened. A process forked from the owner opens new connections
+    instead of using inherited ones.
+    """
+
+    def __init__(self, db_path: str, settings: Dict = None):
+        self.db_path = db_path
+        self.settings = dict(DEFAULT_DATABASE_SETTINGS)
+        self.settings.update(settings or {})
+        self._connections: Dict[int, sqlite3.Connection] = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @classmethod
+    def from_config(cls, config: Dict) -> "ConnectionManager":
+        settings = dict(config["database"])
+        return cls(settings.pop("file"), settings)
+
+    def connection(self) -> sqlite3.Connection:
+        """The calling thread's connection, opened on first use."""
+        ident = threading.get_ident()
+        conn = self._connections.get(ident)
+        if conn is not None and self._pid == os.getpid():
+            return conn
+        with self._lock:
+            if self._pid != os.getpid():
+                # Inherited connections belong to the parent; leave them alone
+                self._connections = {}
+                self._pid = os.getpid()
+            self._close_finished()
+            conn = self._open()
+            self._connections[ident] = conn
+        return conn
+
+    def close(self):
+        """Close every connection this process opened."""
+        with self._lock:
+            if self._pid == os.getpid():
+                for conn in self._connections.values():
+                    conn.close()
+            self._connections = {}
+
+    def _open(self) -> sqlite3.Connection:
+        settings = self.settings
+        # Each thread only uses its own connection; close() may run on another
+        conn = sqlite3.connect(self.db_path, timeout=settings['busy_timeout_seconds'],
+                               cached_statements=settings['cached_statements'],
+                               check_same_thread=False)
+        conn.execute(f"PRAGMA journal_mode = {settings['journal_mode']}")
+        conn.execute(f"PRAGMA synchronous = {settings['synchronous']}")
+        # A negative cache_size is in KiB rather than pages
+        conn.execute(f"PRAGMA cache_size = {-int(settings['cache_size_kib'])}")
+        conn.execute(f"PRAGMA mmap_size = {int(settings['mmap_size'])}")
+        return conn
+
+    def _close_finished(self):
+        alive = {thread.ident for thread in threading.enumerate()}
+        for ident in [ident for ident in self._connections if ident not in alive]:
+            self._connections.pop(ident).close()
@@ -153,7 +153,9 @@ class CustomerManager:
         
         body_text = "\n".join(text_lines[:-1])  # Remove the last empty line
         
-        if self.automation.create_email_template(name, subject, body_html, body_text):
+        engine = input("Template engine (placeholder/jinja2, default: placeholder): ").strip() or "placeholder"
+        
+        if self.automation.create_email_template(name, subject, body_html, body_text, engine):
             print(f"✅ Email template '{name}' created successfully!")
         else:
             print(f"❌ Failed to create email template '{name}'")
@@ -162,23 +164,22 @@ class CustomerManager:
         """View all email templates."""
         print("\n--- EMAIL TEMPLATES ---")
         
-        import sqlite3
-        conn = sqlite3.connect(self.automation.db_path)
+        conn = self.automation.connections.connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM email_templates")
+        cursor.execute("SELECT id, name, subject, created_at, version, updated_at FROM email_templates")
         templates = cursor.fetchall()
-        conn.close()
         
         if not templates:
             print("No email templates found.")
             return
         
         for template in templates:
-            template_id, name, subject, body_html, body_text, created_at = template
+            template_id, name, subject, created_at, version, updated_at = template
             print(f"\nID: {template_id}")
             print(f"Name: {name}")
             print(f"Subject: {subject}")
             print(f"Created: {created_at}")
+            print(f"Version: {version} (updated {updated_at or created_at})")
             print("-" * 40)
     
     def send_test_email(self):
@@ -215,12 +216,10 @@ class CustomerManager:
         print("\n--- SEND BULK EMAILS ---")
         
         # Get available templates
-        import sqlite3
-        conn = sqlite3.connect(self.automation.db_path)
+        conn = self.automation.connections.connection()
         cursor = conn.cursor()
         cursor.execute("SELECT name FROM email_templates")
         templates = [row[0] for row in cursor.fetchall()]
-        conn.close()
         
         if not templates:
             print("No email templates found. Please create a template first.")
@@ -250,6 +249,14 @@ class CustomerManager:
             print("Invalid limit, sending to all customers")
             limit = None
         
+        if input("Dry run (render only, nothing is sent)? (y/N): ").strip().lower() == 'y':
+            result = self.automation.send_bulk_emails(template_name, customer_filter, limit, dry_run=True)
+            print(f"✅ Dry run: {result['messages']} messages, {result['bytes']} bytes, "
+                  f"{result['messages_per_second']} msg/s")
+            for stage, seconds in result['timings'].items():
+                print(f"   {stage}: {seconds}s")
+            return
+        
         print(f"\nSending bulk emails using template '{template_name}'...")
         result = self.automation.send_bulk_emails(template_name, customer_filter, limit)
         print(f"✅ Bulk email completed: {result['sent']} sent, {result['failed']} failed")
@@ -264,12 +271,10 @@ class CustomerManager:
             return
         
         # Get available templates
-        import sqlite3
-        conn = sqlite3.connect(self.automation.db_path)
+        conn = self.automation.connections.connection()
         cursor = conn.cursor()
         cursor.execute("SELECT name FROM email_templates")
         templates = [row[0] for row in cursor.fetchall()]
-        conn.close()
         
         if not templates:
             print("No email templates found. Please create a template first.")
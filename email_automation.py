@@ -13,19 +13,163 @@ import logging
 from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
-from typing import List, Dict, Optional
+from email.message import Message
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
 import os
 import csv
-import shutil
+import queue
+import threading
+import asyncio
+import multiprocessing
+import itertools
+from collections import OrderedDict
+
+from async_transport import AsyncSMTPSender
+from attachments import AttachmentCache
+from checkpoint import BulkRunCheckpoint, EmailStatsBuffer
+from concurrency_controller import AdaptiveConcurrency, deferral_code, merge_snapshots
+from connection_manager import DEFAULT_DATABASE_SETTINGS, ConnectionManager
+from html_preprocessor import DEFAULT_PREPROCESS_SETTINGS, preprocess_template
+from message_builder import MessageSkeleton, text_charset
+from outbox import Outbox
+from rate_limiter import RateLimiter
+from redis_queue import RedisSendQueue
+from smtp_pool import SMTPSession, SMTPSessionPool, flatten_message, quote_data, quote_lines
+from spool import SpoolReader, SpoolWriter, write_manifest
+from template_engine import (ENGINES, JinjaEngine, TemplateError, check_placeholders, compile_template,
+                             placeholder_values)
+
+# Customers are keyed by email; adding an existing email replaces the row
+CUSTOMER_INSERT = '''
+    INSERT OR REPLACE INTO customers
+    (email, first_name, last_name, company, phone, status)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+CUSTOMER_CSV_FIELDS = ('email', 'first_name', 'last_name', 'company', 'phone', 'status')
+
+def get_template_fields(*templates) -> List[str]:
+    """Return the customer fields that compiled template parts depend on."""
+    fields = set()
+    for template in templates:
+        for name in template.fields:
+            if name == 'full_name':
+                fields.update(('first_name', 'last_name'))
+            else:
+                fields.add(name)
+    return sorted(fields)
+
+class BulkSendResult:
+    """Thread-safe sent/failed counters for a bulk run.
+
+    If given, `progress` is called with the counters every `progress_every`
+    records, and results for known customers are passed on to `checkpoint`,
+    which also updates their email stats. Without a checkpoint, successful
+    sends are counted in `stats`.
+    """
+
+    def __init__(self, progress=None, progress_every: int = 100,
+                 checkpoint: Optional[BulkRunCheckpoint] = None,
+                 stats: Optional[EmailStatsBuffer] = None):
+        self.sent = 0
+        self.failed = 0
+        self.progress = progress
+        self.progress_every = progress_every
+        self.checkpoint = checkpoint
+        self.stats = stats
+        self._lock = threading.Lock()
+
+    def record(self, success: bool, customer: Optional[Dict] = None, error=None):
+        with self._lock:
+            if success:
+                self.sent += 1
+            else:
+                self.failed += 1
+            report = self.progress and (self.sent + self.failed) % self.progress_every == 0
+        if self.checkpoint is not None and customer is not None:
+            self.checkpoint.record(customer['id'], success, error)
+        elif self.stats is not None and customer is not None and success:
+            self.stats.add(customer['id'])
+        if report:
+            self.progress(self.as_dict())
+
+    def as_dict(self) -> Dict[str, int]:
+        return {"sent": self.sent, "failed": self.failed}
+
+def _exit_with_parent():
+    parent = multiprocessing.parent_process()
+    if parent is not None:
+        parent.join()
+        os._exit(1)
+
+def _spool_shard_worker(config_file: str, template_name: str, customer_filter: str,
+                        shard: tuple, max_id: int, attachments: Optional[List[str]],
+                        spool_path: str, results):
+    """Entry point of a spool rendering process: render one shard into its own segments."""
+    threading.Thread(target=_exit_with_parent, name="parent-watchdog", daemon=True).start()
+    automation = EmailAutomation(config_file)
+    try:
+        template = automation.get_email_template(template_name)
+        results.put(automation._spool_shard(template, customer_filter, max_id, shard,
+                                            attachments, spool_path, shard[0]))
+    finally:
+        automation.close()
+
+def _bulk_shard_worker(config_file: str, template_name: str, customer_filter: str,
+                       shard: tuple, max_id: int, concurrency: Optional[int],
+                       attachments: Optional[List[str]], run_id: Optional[int], results):
+    """Entry point of a bulk send worker process: send one shard, report to the parent."""
+    # Stop with the parent, so a resumed run never races an orphaned shard
+    threading.Thread(target=_exit_with_parent, name="parent-watchdog", daemon=True).start()
+    automation = EmailAutomation(config_file)
+    index, count = shard
+    # Each process gets an equal share of the configured rate limits
+    automation.rate_limiter = RateLimiter.from_config(automation.config, share=1 / count)
+    try:
+        template = automation.get_email_template(template_name)
+        customers = automation._pending_customers(customer_filter, max_id, run_id, shard)
+        # Shards finish out of id order, so only recipient rows mark progress
+        checkpoint = automation._open_checkpoint(run_id, customers, track_cursor=False)
+        result = BulkSendResult(progress=lambda counts: results.put(("progress", index, counts, None)),
+                                checkpoint=checkpoint, stats=automation.email_stats)
+        try:
+            automation._run_bulk(template, customers, concurrency, attachments, result)
+        finally:
+            if checkpoint is not None:
+                checkpoint.flush()
+        concurrency_snapshot = (automation.adaptive_concurrency.snapshot()
+                                if automation.adaptive_concurrency else None)
+        results.put(("done", index, result.as_dict(), concurrency_snapshot))
+    finally:
+        automation.close()
 
 class EmailAutomation:
     def __init__(self, config_file: str = "config.json"):
         """Initialize the email automation system."""
+        self.config_file = config_file
         self.config = self.load_config(config_file)
         self.setup_logging()
         self.setup_database()
+        self.outbox = Outbox.from_config(self.connections, self.config)
+        self.smtp_pool = SMTPSessionPool(self.config['smtp'], self.logger)
+        self.rate_limiter = RateLimiter.from_config(self.config)
+        self.adaptive_concurrency = AdaptiveConcurrency.from_config(self.config)
+        # Controller snapshots reported by the worker processes of the last multi-process run
+        self.shard_concurrency: List[Dict] = []
+        self.message_skeleton = MessageSkeleton(self.from_header, self.config['email_settings']['reply_to'])
+        attachment_settings = self.config.get('attachments', {})
+        self.attachment_cache = AttachmentCache(
+            attachment_settings.get('cache_max_bytes', 64 * 1024 * 1024),
+            attachment_settings.get('stream_threshold_bytes', 8 * 1024 * 1024))
+        # Created on first use, so Redis is only needed by nodes that use the queue
+        self.send_queue: Optional[RedisSendQueue] = None
+        # Templates by name, reused while their version is unchanged
+        self.template_cache: Dict[str, Dict] = {}
+        # Created on first use, so jinja2 is only needed for jinja2 templates
+        self.jinja_engine: Optional[JinjaEngine] = None
+        stats_settings = self.config.get('stats', {})
+        self.email_stats = EmailStatsBuffer(self.connections,
+                                            stats_settings.get('batch_size', 500),
+                                            stats_settings.get('flush_interval_seconds', 1.0))
         
     def load_config(self, config_file: str) -> Dict:
         """Load configuration from JSON file."""
@@ -40,17 +184,78 @@ class EmailAutomation:
                     "port": 587,
                     "username": "your_email@gmail.com",
                     "password": "your_app_password",
-                    "use_tls": True
+                    "use_tls": True,
+                    "pipelining": True,
+                    "pool": {
+                        "max_sessions": 4,
+                        "max_messages_per_session": 100,
+                        "max_idle_seconds": 60,
+                        "noop_after_idle_seconds": 5,
+                        "timeout": 30
+                    }
                 },
                 "email_settings": {
                     "from_name": "Your Company",
                     "reply_to": "noreply@yourcompany.com",
                     "max_emails_per_batch": 50,
-                    "delay_between_emails": 1
+                    "delay_between_emails": 1,
+                    "concurrency": 1,
+                    "processes": 1,
+                    "async_concurrency": 100,
+                    "max_recipients_per_message": 50
+                },
+                "rate_limits": {
+                    "global": {"rate": 60, "per_seconds": 60, "burst": 1},
+                    "per_account": {
+                        "default": {"rate": 60, "per_seconds": 60, "burst": 1}
+                    },
+                    "per_domain": {}
+                },
+                "attachments": {
+                    "cache_max_bytes": 67108864,
+                    "stream_threshold_bytes": 8388608
+                },
+                "adaptive_concurrency": {
+                    "enabled": False,
+                    "initial": 2,
+                    "min": 1,
+                    "max": 4,
+                    "domain_initial": 2,
+                    "domain_max": 8,
+                    "increase": 1.0,
+                    "decrease_factor": 0.5,
+                    "latency_tolerance": 2.0
                 },
-                "database": {
-                    "file": "customers.db"
-                }
+                "spool": {
+                    "directory": "spool",
+                    "max_segment_bytes": 268435456
+                },
+                "templates": {
+                    "jinja_bytecode_cache": "jinja_cache",
+                    "preprocess": dict(DEFAULT_PREPROCESS_SETTINGS)
+                },
+                "checkpoint": {
+                    "enabled": True,
+                    "batch_size": 500,
+                    "flush_interval_seconds": 1.0
+                },
+                "stats": {
+                    "batch_size": 500,
+                    "flush_interval_seconds": 1.0
+                },
+                "csv_import": {
+                    "chunk_size": 10000,
+                    "rebuild_indexes": False
+                },
+                "outbox": {
+                    "enabled": True,
+                    "max_attempts": 5,
+                    "base_delay_seconds": 60,
+                    "max_delay_seconds": 3600,
+                    "lease_seconds": 300,
+                    "batch_size": 100
+                },
+                "database": dict(DEFAULT_DATABASE_SETTINGS, file="customers.db")
             }
             with open(config_file, 'w') as f:
                 json.dump(default_config, f, indent=4)
@@ -71,7 +276,9 @@ class EmailAutomation:
     def setup_database(self):
         """Setup SQLite database for customer management."""
         self.db_path = self.config["database"]["file"]
-        conn = sqlite3.connect(self.db_path)
+        # Connections stay open per thread; see connection_manager.py
+        self.connections = ConnectionManager.from_config(self.config)
+        conn = self.connections.connection()
         cursor = conn.cursor()
         
         # Create customers table
@@ -98,9 +305,21 @@ class EmailAutomation:
                 subject TEXT NOT NULL,
                 body_html TEXT,
                 body_text TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                version INTEGER DEFAULT 1,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                engine TEXT DEFAULT 'placeholder',
+                processed_html TEXT,
+                processed_text TEXT
             )
         ''')
+        self._add_missing_columns(cursor, 'email_templates', {
+            'version': 'INTEGER DEFAULT 1',
+            'updated_at': 'TIMESTAMP',
+            'engine': "TEXT DEFAULT 'placeholder'",
+            'processed_html': 'TEXT',
+            'processed_text': 'TEXT'
+        })
         
         # Create email_campaigns table
         cursor.execute('''
@@ -115,82 +334,303 @@ class EmailAutomation:
             )
         ''')
         
+        # Create outbox table for failed sends awaiting retry
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                customer_id INTEGER NOT NULL,
+                to_email TEXT NOT NULL,
+                template_name TEXT NOT NULL,
+                attachments TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at TIMESTAMP,
+                last_error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (customer_id) REFERENCES customers (id)
+            )
+        ''')
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (status, next_attempt_at)
+        ''')
+        
+        # Create bulk run checkpoint tables
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bulk_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                template_name TEXT NOT NULL,
+                customer_filter TEXT NOT NULL,
+                max_customer_id INTEGER,
+                attachments TEXT,
+                last_customer_id INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'running',
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS bulk_run_recipients (
+                run_id INTEGER NOT NULL,
+                customer_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                PRIMARY KEY (run_id, customer_id),
+                FOREIGN KEY (run_id) REFERENCES bulk_runs (id)
+            )
+        ''')
+        
         conn.commit()
-        conn.close()
         self.logger.info("Database setup completed")
     
+    def _add_missing_columns(self, cursor: sqlite3.Cursor, table: str, columns: Dict[str, str]):
+        """Add columns that a database created by an older version lacks."""
+        existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+        for column, definition in columns.items():
+            if column not in existing:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    
     def add_customer(self, email: str, first_name: str = "", last_name: str = "", 
                     company: str = "", phone: str = "", status: str = "active") -> bool:
         """Add a new customer to the database."""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            conn = self.connections.connection()
+            with conn:
+                conn.execute(CUSTOMER_INSERT, (email, first_name, last_name, company, phone, status))
             
-            cursor.execute('''
-                INSERT OR REPLACE INTO customers 
-                (email, first_name, last_name, company, phone, status)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (email, first_name, last_name, company, phone, status))
-            
-            conn.commit()
-            conn.close()
             self.logger.info(f"Customer added: {email}")
             return True
         except Exception as e:
             self.logger.error(f"Error adding customer {email}: {str(e)}")
             return False
     
-    def import_customers_csv(self, csv_file: str) -> int:
-        """Import customers from CSV file."""
+    def import_customers_csv(self, csv_file: str, chunk_size: int = None,
+                             rebuild_indexes: bool = None) -> int:
+        """Import customers from CSV file; returns the number of rows imported.
+
+        The file is streamed in chunks of `chunk_size` rows, each inserted with
+        one executemany in one transaction. If a chunk fails, its rows are
+        inserted one at a time so that only the bad rows are logged and
+        skipped. With `rebuild_indexes`, secondary indexes on customers are
+        dropped for the load and created again afterwards. Both default to
+        the csv_import settings.
+        """
+        settings = self.config.get('csv_import', {})
+        if chunk_size is None:
+            chunk_size = settings.get('chunk_size', 10000)
+        if rebuild_indexes is None:
+            rebuild_indexes = settings.get('rebuild_indexes', False)
         imported_count = 0
+        failed_count = 0
+        start = time.perf_counter()
+        conn = self.connections.connection()
+        indexes = self._drop_customer_indexes(conn) if rebuild_indexes else []
         try:
             with open(csv_file, 'r', newline='', encoding='utf-8') as file:
                 reader = csv.DictReader(file)
-                for row in reader:
-                    if self.add_customer(
-                        email=row.get('email', ''),
-                        first_name=row.get('first_name', ''),
-                        last_name=row.get('last_name', ''),
-                        company=row.get('company', ''),
-                        phone=row.get('phone', ''),
-                        status=row.get('status', 'active')
-                    ):
-                        imported_count += 1
+                while True:
+                    chunk = list(itertools.islice(reader, chunk_size))
+                    if not chunk:
+                        break
+                    rows = []
+                    for row in chunk:
+                        try:
+                            rows.append(self._customer_row(row))
+                        except ValueError as e:
+                            failed_count += 1
+                            self.logger.error(f"Error adding customer {row.get('email')}: {str(e)}")
+                    imported = self._insert_customers(conn, rows)
+                    imported_count += imported
+                    failed_count += len(rows) - imported
         except Exception as e:
             self.logger.error(f"Error importing CSV: {str(e)}")
+        finally:
+            if indexes:
+                with conn:
+                    for sql in indexes:
+                        conn.execute(sql)
         
-        self.logger.info(f"Imported {imported_count} customers from CSV")
+        elapsed = time.perf_counter() - start
+        rate = imported_count / elapsed if elapsed > 0 else 0
+        self.logger.info(f"Imported {imported_count} customers from CSV ({failed_count} failed) "
+                         f"in {elapsed:.2f}s, {rate:.0f} rows/s")
         return imported_count
     
+    @staticmethod
+    def _customer_row(row: Dict) -> tuple:
+        """Insert parameters for a CSV row, with surrounding whitespace removed.
+
+        Raises ValueError if the row has no email; an empty status means active.
+        """
+        values = {field: (row.get(field) or '').strip() for field in CUSTOMER_CSV_FIELDS}
+        if not values['email']:
+            raise ValueError("email is required")
+        values['status'] = values['status'] or 'active'
+        return tuple(values[field] for field in CUSTOMER_CSV_FIELDS)
+    
+    def _insert_customers(self, conn: sqlite3.Connection, rows: List[tuple]) -> int:
+        """Insert customer rows in one transaction; returns how many were inserted."""
+        try:
+            with conn:
+                conn.executemany(CUSTOMER_INSERT, rows)
+            return len(rows)
+        except sqlite3.Error:
+            pass
+        # A failed statement does not end the transaction, so the good rows still commit together
+        imported = 0
+        with conn:
+            for row in rows:
+                try:
+                    conn.execute(CUSTOMER_INSERT, row)
+                    imported += 1
+                except sqlite3.Error as e:
+                    self.logger.error(f"Error adding customer {row[0]}: {str(e)}")
+        return imported
+    
+    def _drop_customer_indexes(self, conn: sqlite3.Connection) -> List[str]:
+        """Drop the secondary indexes on customers; returns the SQL that creates them."""
+        # Indexes SQLite creates for UNIQUE constraints have no SQL and cannot be dropped
+        indexes = conn.execute('''
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND tbl_name = 'customers' AND sql IS NOT NULL
+        ''').fetchall()
+        with conn:
+            for name, _ in indexes:
+                conn.execute(f'DROP INDEX "{name}"')
+        if indexes:
+            self.logger.info(f"Dropped {len(indexes)} customer indexes for the import")
+        return [sql for _, sql in indexes]
+    
     def create_email_template(self, name: str, subject: str, body_html: str = "", 
-                            body_text: str = "") -> bool:
-        """Create a new email template."""
+                            body_text: str = "", engine: str = "placeholder") -> bool:
+        """Create a new email template.
+
+        `engine` is "placeholder" ({{field}} substitution) or "jinja2" (sandboxed
+        Jinja2 with the same fields as variables). Fails if the template uses a
+        field personalization cannot fill, or is not valid Jinja2.
+
+        The HTML is preprocessed once here (CSS inlined, minified, and a text
+        part generated if there is none, per templates.preprocess) and stored
+        next to the source; sends use the processed parts.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
+            if engine not in ENGINES:
+                raise ValueError(f"Unknown template engine '{engine}' (available: {', '.join(ENGINES)})")
+            if engine == 'jinja2':
+                self.get_jinja_engine().check(subject, body_html, body_text)
+            else:
+                check_placeholders(subject, body_html, body_text)
+            processed_html, processed_text = self.preprocess_template(name, body_html, body_text, engine)
+            conn = self.connections.connection()
+            with conn:
+                cursor = conn.cursor()
             
-            cursor.execute('''
-                INSERT OR REPLACE INTO email_templates 
-                (name, subject, body_html, body_text)
-                VALUES (?, ?, ?, ?)
-            ''', (name, subject, body_html, body_text))
+                # Update in place, so the id campaigns refer to stays valid
+                cursor.execute('''
+                    INSERT INTO email_templates 
+                    (name, subject, body_html, body_text, engine, processed_html, processed_text)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (name) DO UPDATE SET
+                        subject = excluded.subject,
+                        body_html = excluded.body_html,
+                        body_text = excluded.body_text,
+                        engine = excluded.engine,
+                        processed_html = excluded.processed_html,
+                        processed_text = excluded.processed_text,
+                        version = version + 1,
+                        updated_at = CURRENT_TIMESTAMP
+                ''', (name, subject, body_html, body_text, engine, processed_html, processed_text))
             
-            conn.commit()
-            conn.close()
+            self.template_cache.pop(name, None)
             self.logger.info(f"Email template created: {name}")
             return True
         except Exception as e:
             self.logger.error(f"Error creating template {name}: {str(e)}")
             return False
     
-    def get_customers(self, status: str = "active", limit: int = None) -> List[Dict]:
-        """Get customers from database."""
-        conn = sqlite3.connect(self.db_path)
+    def preprocess_template(self, name: str, body_html: str, body_text: str,
+                            engine: str = "placeholder") -> Tuple[Optional[str], Optional[str]]:
+        """Processed HTML and text parts to store with a template, None where the source is used."""
+        settings = self.config.get('templates', {}).get('preprocess', {})
+        processed_html, processed_text = preprocess_template(body_html, body_text, settings)
+        if engine == 'jinja2':
+            try:
+                self.get_jinja_engine().check(processed_html, processed_text)
+            except TemplateError as e:
+                # Tags inside attributes or <style> may not survive rewriting
+                self.logger.warning(f"Template {name} is sent unprocessed: {e}")
+                return None, None
+        if processed_html is not None:
+            self.logger.info(f"Template {name}: HTML preprocessed from {len(body_html)} "
+                             f"to {len(processed_html)} characters")
+        return processed_html, processed_text
+    
+    def get_email_template(self, template_name: str) -> Optional[Dict]:
+        """Get an email template by name.
+
+        Templates are cached and compiled once per version; while the version
+        in the database is unchanged, only that number is read again.
+        body_html and body_text are the parts to send (preprocessed where
+        available); the saved text is kept in source_html and source_text.
+        """
+        conn = self.connections.connection()
+        cursor = conn.cursor()
+        cached = self.template_cache.get(template_name)
+        if cached is not None:
+            cursor.execute("SELECT version FROM email_templates WHERE name = ?", (template_name,))
+            row = cursor.fetchone()
+            if row and row[0] == cached['version']:
+                return dict(cached)
+        
+        cursor.execute("SELECT * FROM email_templates WHERE name = ?", (template_name,))
+        row = cursor.fetchone()
+        columns = [description[0] for description in cursor.description]
+        
+        if not row:
+            self.template_cache.pop(template_name, None)
+            return None
+        template = dict(zip(columns, row))
+        template['source_html'] = template['body_html']
+        template['source_text'] = template['body_text']
+        template['body_html'] = template.pop('processed_html', None) or template['body_html']
+        template['body_text'] = template.pop('processed_text', None) or template['body_text']
+        self.compile_parts(template['subject'], template['body_html'], template['body_text'],
+                           template['engine'])
+        self.template_cache[template_name] = template
+        return dict(template)
+    
+    def get_customer(self, customer_id: int) -> Optional[Dict]:
+        """Get one customer by id."""
+        conn = self.connections.connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM customers WHERE id = ?", (customer_id,))
+        row = cursor.fetchone()
+        columns = [description[0] for description in cursor.description]
+        return dict(zip(columns, row)) if row else None
+    
+    def get_customers(self, status: str = "active", limit: int = None,
+                      shard: tuple = None, max_id: int = None) -> List[Dict]:
+        """Get customers from database.
+
+        shard=(index, count) selects customers whose id % count == index;
+        max_id excludes customers with a higher id.
+        """
+        conn = self.connections.connection()
         cursor = conn.cursor()
         
         query = "SELECT * FROM customers WHERE status = ?"
         params = [status]
         
+        if shard:
+            query += " AND id % ? = ?"
+            params += [shard[1], shard[0]]
+        
+        if max_id is not None:
+            query += " AND id <= ?"
+            params.append(max_id)
+        
         if limit:
             query += " LIMIT ?"
             params.append(limit)
@@ -199,24 +639,22 @@ class EmailAutomation:
         columns = [description[0] for description in cursor.description]
         customers = [dict(zip(columns, row)) for row in cursor.fetchall()]
         
-        conn.close()
         return customers
     
     def delete_customer(self, identifier: str) -> bool:
         """Delete a customer by id or email. Returns True if a row was deleted."""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            # Determine if identifier is an integer id or an email
-            deleted = 0
-            if identifier.isdigit():
-                cursor.execute("DELETE FROM customers WHERE id = ?", (int(identifier),))
-                deleted = cursor.rowcount
-            else:
-                cursor.execute("DELETE FROM customers WHERE email = ?", (identifier,))
-                deleted = cursor.rowcount
-            conn.commit()
-            conn.close()
+            conn = self.connections.connection()
+            with conn:
+                cursor = conn.cursor()
+                # Determine if identifier is an integer id or an email
+                deleted = 0
+                if identifier.isdigit():
+                    cursor.execute("DELETE FROM customers WHERE id = ?", (int(identifier),))
+                    deleted = cursor.rowcount
+                else:
+                    cursor.execute("DELETE FROM customers WHERE email = ?", (identifier,))
+                    deleted = cursor.rowcount
             if deleted:
                 self.logger.info(f"Customer deleted: {identifier}")
                 return True
@@ -230,12 +668,11 @@ class EmailAutomation:
     def delete_customers_by_status(self, status: str) -> int:
         """Bulk delete customers by status. Returns number of rows deleted."""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM customers WHERE status = ?", (status,))
-            deleted = cursor.rowcount
-            conn.commit()
-            conn.close()
+            conn = self.connections.connection()
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM customers WHERE status = ?", (status,))
+                deleted = cursor.rowcount
             self.logger.info(f"Deleted {deleted} customers with status='{status}'")
             return deleted or 0
         except Exception as e:
@@ -247,12 +684,11 @@ class EmailAutomation:
         try:
             if not domain.startswith('@'):
                 domain = '@' + domain
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM customers WHERE email LIKE ?", ('%' + domain,))
-            deleted = cursor.rowcount
-            conn.commit()
-            conn.close()
+            conn = self.connections.connection()
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM customers WHERE email LIKE ?", ('%' + domain,))
+                deleted = cursor.rowcount
             self.logger.info(f"Deleted {deleted} customers with domain '{domain}'")
             return deleted or 0
         except Exception as e:
@@ -265,12 +701,11 @@ class EmailAutomation:
             return 0
         try:
             placeholders = ','.join(['?'] * len(ids))
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(f"DELETE FROM customers WHERE id IN ({placeholders})", ids)
-            deleted = cursor.rowcount
-            conn.commit()
-            conn.close()
+            conn = self.connections.connection()
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute(f"DELETE FROM customers WHERE id IN ({placeholders})", ids)
+                deleted = cursor.rowcount
             self.logger.info(f"Deleted {deleted} customers by IDs")
             return deleted or 0
         except Exception as e:
@@ -283,12 +718,11 @@ class EmailAutomation:
             return 0
         try:
             placeholders = ','.join(['?'] * len(emails))
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute(f"DELETE FROM customers WHERE email IN ({placeholders})", emails)
-            deleted = cursor.rowcount
-            conn.commit()
-            conn.close()
+            conn = self.connections.connection()
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute(f"DELETE FROM customers WHERE email IN ({placeholders})", emails)
+                deleted = cursor.rowcount
             self.logger.info(f"Deleted {deleted} customers by emails list")
             return deleted or 0
         except Exception as e:
@@ -329,9 +763,16 @@ class EmailAutomation:
             return 0
 
     def backup_database(self, backup_file: str) -> bool:
-        """Create a file-level backup of the SQLite database."""
+        """Create a backup of the SQLite database.
+
+        Uses SQLite's online backup rather than a file copy, so the backup
+        includes changes still in the WAL file and is consistent while a
+        send is writing.
+        """
         try:
-            shutil.copy2(self.db_path, backup_file)
+            target = sqlite3.connect(backup_file)
+            self.connections.connection().backup(target)
+            target.close()
             self.logger.info(f"Database backed up to {backup_file}")
             return True
         except Exception as e:
@@ -344,7 +785,11 @@ class EmailAutomation:
             if not os.path.isfile(backup_file):
                 self.logger.error(f"Backup file not found: {backup_file}")
                 return False
-            shutil.copy2(backup_file, self.db_path)
+            # Copy into the open database; replacing the file would leave a stale WAL behind
+            source = sqlite3.connect(backup_file)
+            source.backup(self.connections.connection())
+            source.close()
+            self.template_cache.clear()
             self.logger.info(f"Database restored from {backup_file}")
             return True
         except Exception as e:
@@ -354,11 +799,9 @@ class EmailAutomation:
     def vacuum_database(self) -> bool:
         """Run VACUUM to rebuild and defragment the database file."""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.connections.connection()
             cursor = conn.cursor()
             cursor.execute("VACUUM")
-            conn.commit()
-            conn.close()
             self.logger.info("Database vacuum completed")
             return True
         except Exception as e:
@@ -368,11 +811,10 @@ class EmailAutomation:
     def check_database_integrity(self) -> bool:
         """Run PRAGMA integrity_check; return True if OK."""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.connections.connection()
             cursor = conn.cursor()
             cursor.execute("PRAGMA integrity_check")
             result = cursor.fetchone()
-            conn.close()
             ok = bool(result and result[0] == 'ok')
             if ok:
                 self.logger.info("Database integrity check: OK")
@@ -385,22 +827,20 @@ class EmailAutomation:
 
     def list_tables(self) -> List[str]:
         """List user tables in the SQLite database."""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connections.connection()
         cursor = conn.cursor()
         cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")
         tables = [row[0] for row in cursor.fetchall()]
-        conn.close()
         return tables
 
     def export_table_csv(self, table_name: str, output_file: str) -> bool:
         """Export an entire table to CSV."""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = self.connections.connection()
             cursor = conn.cursor()
             cursor.execute(f"SELECT * FROM {table_name}")
             columns = [description[0] for description in cursor.description]
             rows = cursor.fetchall()
-            conn.close()
 
             with open(output_file, 'w', newline='', encoding='utf-8') as file:
                 writer = csv.writer(file)
@@ -413,159 +853,1130 @@ class EmailAutomation:
             return False
 
     def send_email(self, to_email: str, subject: str, body_html: str = "", 
-                  body_text: str = "", attachments: List[str] = None) -> bool:
-        """Send a single email."""
-        try:
-            msg = MIMEMultipart('alternative')
-            msg['From'] = f"{self.config['email_settings']['from_name']} <{self.config['smtp']['username']}>"
-            msg['To'] = to_email
-            msg['Subject'] = subject
-            msg['Reply-To'] = self.config['email_settings']['reply_to']
-            
-            # Add text and HTML parts
-            if body_text:
-                text_part = MIMEText(body_text, 'plain')
-                msg.attach(text_part)
-            
-            if body_html:
-                html_part = MIMEText(body_html, 'html')
-                msg.attach(html_part)
-            
-            # Add attachments if any
-            if attachments:
-                for file_path in attachments:
-                    if os.path.isfile(file_path):
-                        with open(file_path, "rb") as attachment:
-                            part = MIMEBase('application', 'octet-stream')
-                            part.set_payload(attachment.read())
-                            encoders.encode_base64(part)
-                            part.add_header(
-                                'Content-Disposition',
-                                f'attachment; filename= {os.path.basename(file_path)}'
-                            )
-                            msg.attach(part)
-            
-            # Connect to SMTP server and send email
-            server = smtplib.SMTP(self.config['smtp']['server'], self.config['smtp']['port'])
-            if self.config['smtp']['use_tls']:
-                server.starttls()
-            
-            server.login(self.config['smtp']['username'], self.config['smtp']['password'])
-            server.send_message(msg)
-            server.quit()
+                  body_text: str = "", attachments: List[str] = None,
+                  session: Optional[SMTPSession] = None) -> bool:
+        """Send a single email, over the given SMTP session or a pooled one."""
+        try:
+            msg = self.build_message(to_email, subject, body_html, body_text, attachments)
+        except Exception as e:
+            self.logger.error(f"Error sending email to {to_email}: {str(e)}")
+            return False
+        return self._send_prepared(to_email, msg, session) is None
+    
+    def _send_prepared(self, to_email: str, msg,
+                       session: Optional[SMTPSession] = None) -> Optional[Exception]:
+        """Send a built message, or its serialized form, to one recipient.
+
+        Returns None on success, or the error so callers can decide whether to retry.
+        """
+        try:
+            if isinstance(msg, Message):
+                self._transmit(msg, session)
+            else:
+                self._transmit(msg, session, self.config['smtp']['username'], [to_email])
             
             self.logger.info(f"Email sent successfully to {to_email}")
-            return True
+            return None
             
         except Exception as e:
             self.logger.error(f"Error sending email to {to_email}: {str(e)}")
-            return False
+            return e
+    
+    def _transmit(self, msg, session: Optional[SMTPSession] = None, from_addr: str = None,
+                  to_addrs: List[str] = None) -> Dict:
+        """Send over the given session or a pooled, already-authenticated one."""
+        if session is not None:
+            return session.send_message(msg, from_addr, to_addrs)
+        with self.smtp_pool.session() as pooled:
+            return pooled.send_message(msg, from_addr, to_addrs)
+    
+    @property
+    def from_header(self) -> str:
+        return f"{self.config['email_settings']['from_name']} <{self.config['smtp']['username']}>"
+    
+    def render_message(self, to_email: str, subject: str, body_html: str = "",
+                       body_text: str = "", attachments: List[str] = None):
+        """Serialize a bulk email through the prebuilt MIME skeleton.
+
+        Falls back to a full build_message() in the rare case the skeleton
+        cannot be used.
+        """
+        data = self.message_skeleton.render(to_email, subject, body_html, body_text,
+                                            self.get_attachment_parts(attachments))
+        if data is None:
+            return self.build_message(to_email, subject, body_html, body_text, attachments)
+        return data
+    
+    def get_attachment_parts(self, attachments: List[str] = None) -> List:
+        """Encoded MIME parts for the existing files in `attachments`, from the cache.
+
+        Files above attachments.stream_threshold_bytes are returned as
+        StreamedAttachment parts, encoded from a memory map while sending.
+        """
+        return [self.attachment_cache.get_part(file_path)
+                for file_path in attachments or [] if os.path.isfile(file_path)]
+    
+    def build_message(self, to_email: str, subject: str, body_html: str = "",
+                      body_text: str = "", attachments: List[str] = None) -> MIMEMultipart:
+        """Build the MIME message for a single email."""
+        msg = MIMEMultipart('alternative')
+        msg['From'] = self.from_header
+        msg['To'] = to_email
+        msg['Subject'] = subject
+        msg['Reply-To'] = self.config['email_settings']['reply_to']
+        
+        # Add text and HTML parts
+        if body_text:
+            text_part = MIMEText(body_text, 'plain', text_charset(body_text))
+            msg.attach(text_part)
+        
+        if body_html:
+            html_part = MIMEText(body_html, 'html', text_charset(body_html))
+            msg.attach(html_part)
+        
+        # Add attachments if any, encoded once and reused from the cache
+        if attachments:
+            for file_path in attachments:
+                if os.path.isfile(file_path):
+                    msg.attach(self.attachment_cache.get_mime_part(file_path))
+        
+        return msg
     
     def send_bulk_emails(self, template_name: str, customer_filter: str = "active", 
-                        limit: int = None) -> Dict[str, int]:
-        """Send bulk emails using a template."""
+                        limit: int = None, concurrency: int = None,
+                        attachments: List[str] = None, processes: int = None,
+                        dry_run: bool = False) -> Dict[str, int]:
+        """Send bulk emails using a template.
+
+        With concurrency > 1 (default: email_settings.concurrency), worker
+        threads each hold their own SMTP session and share a work queue.
+        With processes > 1 (default: email_settings.processes), customers are
+        sharded by id across that many worker processes.
+        Recipients that would get identical content are sent as one
+        multi-recipient message (see _plan_batches).
+        Progress is checkpointed under the returned "run_id", so an
+        interrupted run can be continued with resume_bulk_run().
+        With dry_run, messages are rendered but not sent (see dry_run_bulk).
+        """
         # Get template
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM email_templates WHERE name = ?", (template_name,))
-        template = cursor.fetchone()
-        conn.close()
-        
+        template = self.get_email_template(template_name)
         if not template:
             self.logger.error(f"Template '{template_name}' not found")
             return {"sent": 0, "failed": 0}
         
-        template_id, name, subject, body_html, body_text, created_at = template
+        if dry_run:
+            return self.dry_run_bulk(template, customer_filter, limit, attachments)
         
-        # Get customers
-        customers = self.get_customers(status=customer_filter, limit=limit)
+        # Pin the customer set so a resumed or sharded run selects the same customers
+        max_id = self._pin_customer_range(customer_filter, limit)
+        run_id = None
+        if self.config.get('checkpoint', {}).get('enabled', True):
+            run_id = BulkRunCheckpoint.create_run(self.connections, template_name, customer_filter,
+                                                  max_id, attachments)
+            self.logger.info(f"Bulk run {run_id} started for template '{template_name}'")
         
-        sent_count = 0
-        failed_count = 0
+        return self._execute_bulk_run(template, customer_filter, max_id, concurrency,
+                                      attachments, processes, run_id)
+    
+    def resume_bulk_run(self, run_id: int, concurrency: int = None,
+                        processes: int = None) -> Dict[str, int]:
+        """Continue an interrupted bulk run where its checkpoint left off.
+
+        Customers with a recorded result are skipped; the returned counts
+        cover the whole run.
+        """
+        run = BulkRunCheckpoint.load_run(self.connections, run_id)
+        if not run:
+            self.logger.error(f"Bulk run {run_id} not found")
+            return {"sent": 0, "failed": 0}
+        if run['status'] == 'completed':
+            self.logger.info(f"Bulk run {run_id} already completed")
+            return {"sent": run['sent'], "failed": run['failed'], "run_id": run_id}
+        
+        template = self.get_email_template(run['template_name'])
+        if not template:
+            self.logger.error(f"Template '{run['template_name']}' not found")
+            return {"sent": run['sent'], "failed": run['failed'], "run_id": run_id}
+        
+        self.logger.info(f"Resuming bulk run {run_id} after customer {run['last_customer_id']} "
+                         f"({run['sent']} sent, {run['failed']} failed so far)")
+        return self._execute_bulk_run(template, run['customer_filter'], run['max_customer_id'],
+                                      concurrency, run['attachments'], processes, run_id, run)
+    
+    def _execute_bulk_run(self, template: Dict, customer_filter: str, max_id: int,
+                          concurrency: Optional[int], attachments: Optional[List[str]],
+                          processes: Optional[int], run_id: Optional[int],
+                          run: Optional[Dict] = None) -> Dict[str, int]:
+        """Send the not yet recorded part of a bulk run and mark it completed."""
+        if processes is None:
+            processes = self.config['email_settings'].get('processes', 1)
+        
+        if processes > 1:
+            summary, complete = self._send_bulk_multiprocess(
+                template['name'], customer_filter, max_id, concurrency, attachments, processes, run_id)
+        else:
+            customers = self._pending_customers(customer_filter, max_id, run_id)
+            checkpoint = self._open_checkpoint(run_id, customers)
+            result = BulkSendResult(checkpoint=checkpoint, stats=self.email_stats)
+            try:
+                self._run_bulk(template, customers, concurrency, attachments, result)
+            finally:
+                if checkpoint is not None:
+                    checkpoint.flush()
+                self.email_stats.flush()
+            summary = result.as_dict()
+            # A customer without a result was lost to an error; leave the run resumable
+            missing = len(customers) - result.sent - result.failed
+            complete = missing <= 0
+            if not complete:
+                self.logger.error(f"{missing} customers got no result; the run is not complete")
+
+        if run_id is not None:
+            if complete:
+                BulkRunCheckpoint.set_status(self.connections, run_id, 'completed')
+            if run:
+                summary = {"sent": run['sent'] + summary['sent'], "failed": run['failed'] + summary['failed']}
+            summary["run_id"] = run_id
+        
+        self.logger.info(f"Bulk email completed: {summary['sent']} sent, {summary['failed']} failed")
+        return summary
+    
+    def _pin_customer_range(self, customer_filter: str, limit: Optional[int]) -> int:
+        """Highest customer id in the first `limit` customers (all if None) with the status."""
+        conn = self.connections.connection()
+        cursor = conn.cursor()
+        row = None
+        if limit:
+            cursor.execute("SELECT id FROM customers WHERE status = ? ORDER BY id LIMIT 1 OFFSET ?",
+                           (customer_filter, limit - 1))
+            row = cursor.fetchone()
+        if row is None:
+            cursor.execute("SELECT MAX(id) FROM customers WHERE status = ?", (customer_filter,))
+            row = cursor.fetchone()
+        return row[0] or 0
+    
+    def _pending_customers(self, customer_filter: str, max_id: int, run_id: Optional[int],
+                           shard: tuple = None) -> List[Dict]:
+        """Customers in a bulk run (or shard of one) without a recorded result yet."""
+        customers = self.get_customers(status=customer_filter, shard=shard, max_id=max_id)
+        if run_id is None:
+            return customers
+        run = BulkRunCheckpoint.load_run(self.connections, run_id)
+        done = BulkRunCheckpoint.done_customer_ids(self.connections, run_id, run['last_customer_id'])
+        return [customer for customer in customers
+                if customer['id'] > run['last_customer_id'] and customer['id'] not in done]
+    
+    def _open_checkpoint(self, run_id: Optional[int], customers: List[Dict],
+                         track_cursor: bool = True) -> Optional[BulkRunCheckpoint]:
+        if run_id is None:
+            return None
+        settings = self.config.get('checkpoint', {})
+        return BulkRunCheckpoint(self.connections, run_id, [customer['id'] for customer in customers],
+                                 settings.get('batch_size', 500),
+                                 settings.get('flush_interval_seconds', 1.0), track_cursor)
+    
+    def _run_bulk(self, template: Dict, customers: List[Dict], concurrency: Optional[int],
+                  attachments: Optional[List[str]], result: BulkSendResult):
+        """Send a template to a list of customers, serially or from worker threads.
+
+        With adaptive_concurrency enabled, the number of sends in flight is
+        set by the controller instead of `concurrency`.
+        """
+        if self.adaptive_concurrency is not None:
+            concurrency = self.adaptive_concurrency.max_concurrency
+        elif concurrency is None:
+            concurrency = self.config['email_settings'].get('concurrency', 1)
+        
+        content = (template['subject'], template['body_html'], template['body_text'],
+                   attachments, template['name'], template['engine'])
+        
+        batches = self._plan_batches(customers, content)
+        
+        if concurrency > 1 and len(batches) > 1:
+            self._send_bulk_concurrent(batches, content, result, concurrency)
+        else:
+            for batch in batches:
+                self._send_batch(batch, content, result)
+    
+    def _send_bulk_multiprocess(self, template_name: str, customer_filter: str, max_id: int,
+                                concurrency: Optional[int], attachments: Optional[List[str]],
+                                processes: int, run_id: Optional[int] = None) -> Tuple[Dict[str, int], bool]:
+        """Shard customers by id across worker processes and aggregate their results.
+
+        Each worker opens its own database connection and SMTP sessions. A
+        shard whose worker dies without reporting, or that has customers
+        without a result, is counted as failed, and the run is not complete.
+        Returns the summary and whether it is.
+        """
+        conn = self.connections.connection()
+        cursor = conn.cursor()
+        shard_sizes = {}
+        for index in range(processes):
+            query = "SELECT COUNT(*) FROM customers WHERE status = ? AND id % ? = ? AND id <= ?"
+            params = [customer_filter, processes, index, max_id]
+            if run_id is not None:
+                query += " AND id NOT IN (SELECT customer_id FROM bulk_run_recipients WHERE run_id = ?)"
+                params.append(run_id)
+            cursor.execute(query, params)
+            shard_sizes[index] = cursor.fetchone()[0]
+        
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        workers = {}
+        for index in range(processes):
+            worker = context.Process(
+                target=_bulk_shard_worker,
+                args=(self.config_file, template_name, customer_filter, (index, processes),
+                      max_id, concurrency, attachments, run_id, results),
+                name=f"bulk-shard-{index}", daemon=True
+            )
+            worker.start()
+            workers[index] = worker
+        
+        progress = {index: {"sent": 0, "failed": 0} for index in workers}
+        pending = set(workers)
+        lost = False
+        self.shard_concurrency = []
+        while pending:
+            try:
+                kind, index, counts, concurrency_snapshot = results.get(timeout=1)
+            except queue.Empty:
+                # Give up on workers that exited without reporting
+                for index in [i for i in pending if not workers[i].is_alive()]:
+                    if results.empty():
+                        self.logger.error(f"Bulk shard {index} exited with code {workers[index].exitcode}")
+                        pending.discard(index)
+                        lost = True
+                continue
+            progress[index] = counts
+            if kind == "done":
+                pending.discard(index)
+                if concurrency_snapshot is not None:
+                    self.shard_concurrency.append(concurrency_snapshot)
+            sent = sum(p["sent"] for p in progress.values())
+            failed = sum(p["failed"] for p in progress.values())
+            self.logger.info(f"Bulk progress: {sent} sent, {failed} failed across {processes} processes")
+        
+        for worker in workers.values():
+            worker.join()
+        
+        sent = sum(p["sent"] for p in progress.values())
+        failed = sum(shard_sizes[i] - progress[i]["sent"] for i in progress)
+        # Customers a shard lost to an error have no result yet, so they count against completion
+        recorded = sum(p["sent"] + p["failed"] for p in progress.values())
+        return {"sent": sent, "failed": failed}, not lost and recorded >= sum(shard_sizes.values())
+    
+    def _plan_batches(self, customers: List[Dict], content: tuple) -> List[List[Dict]]:
+        """Group customers that can share one SMTP transaction.
+
+        Customers share a message when they have the same recipient domain and
+        the same values for every field the template uses. Templates using
+        {{email}} are always sent one per recipient.
+        """
+        max_recipients = self.config['email_settings'].get('max_recipients_per_message', 1)
+        fields = get_template_fields(*self.compile_parts(*content[:3], content[5]))
+        if max_recipients <= 1 or 'email' in fields:
+            return [[customer] for customer in customers]
         
+        groups: Dict[tuple, List[Dict]] = {}
         for customer in customers:
-            # Personalize email content
-            personalized_subject = self.personalize_content(subject, customer)
-            personalized_html = self.personalize_content(body_html, customer)
-            personalized_text = self.personalize_content(body_text, customer)
+            domain = customer['email'].rsplit('@', 1)[-1].lower()
+            key = (domain,) + tuple(customer.get(field) for field in fields)
+            groups.setdefault(key, []).append(customer)
+        
+        batches = []
+        for group in groups.values():
+            for start in range(0, len(group), max_recipients):
+                batches.append(group[start:start + max_recipients])
+        return batches
+    
+    def _send_batch(self, batch: List[Dict], content: tuple, result: BulkSendResult,
+                    session: Optional[SMTPSession] = None):
+        """Send one planned batch, as a single or a multi-recipient message."""
+        if self.adaptive_concurrency is None:
+            if len(batch) == 1:
+                self._send_to_customer(batch[0], content, result, session)
+            else:
+                self._send_to_group(batch, content, result, session)
+            return
+        
+        # Every batch has a single recipient domain (see _plan_batches)
+        domain = batch[0]['email'].rsplit('@', 1)[-1].lower()
+        self.adaptive_concurrency.acquire(domain)
+        start = time.monotonic()
+        errors = []
+        held = None
+        if session is None:
+            # Hold the pooled session for this send, to see a deferral it recovered from
+            try:
+                session = held = self.smtp_pool.acquire()
+            except Exception:
+                # The send opens its own session, and records the failure
+                pass
+        try:
+            if len(batch) == 1:
+                errors = [self._send_to_customer(batch[0], content, result, session)]
+            else:
+                errors = self._send_to_group(batch, content, result, session)
+        finally:
+            deferral = session.deferral if session is not None else None
+            if held is not None:
+                self.smtp_pool.release(held)
+            code = deferral_code(error for error in errors if error is not None)
+            self.adaptive_concurrency.release(domain, time.monotonic() - start, code or deferral)
+    
+    def _send_to_group(self, batch: List[Dict], content: tuple, result: BulkSendResult,
+                       session: Optional[SMTPSession] = None) -> List:
+        """Send one message with a RCPT TO per customer, recipients hidden Bcc-style.
+
+        Returns the errors for refused recipients.
+        """
+        subject, body_html, body_text, attachments, template_name, engine = content
+        recipients = [customer['email'] for customer in batch]
+        
+        # Every customer in the batch renders identically, so use the first
+        self.rate_limiter.acquire(self.config['smtp']['username'], recipients[0], len(recipients))
+        
+        try:
+            msg = self.render_for_customer(batch[0], subject, body_html, body_text, attachments,
+                                           to_email="undisclosed-recipients:;", engine=engine)
+            refused = self._transmit(msg, session, self.config['smtp']['username'], recipients)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except Exception as e:
+            self.logger.error(f"Error sending email to {len(recipients)} recipients: {str(e)}")
+            refused = {email: e for email in recipients}
+        
+        for customer in batch:
+            if customer['email'] in refused:
+                error = refused[customer['email']]
+                self.logger.error(f"Error sending email to {customer['email']}: {error}")
+                result.record(False, customer, error)
+                self.queue_retry(customer, template_name, attachments, error)
+            else:
+                result.record(True, customer)
+        self.logger.info(f"Email sent to {len(recipients) - len(refused)} of {len(recipients)} "
+                         f"recipients in one transaction")
+        return list(refused.values())
+    
+    def _send_to_customer(self, customer: Dict, content: tuple, result: BulkSendResult,
+                          session: Optional[SMTPSession] = None) -> Optional[Exception]:
+        """Personalize, send and record one bulk email; returns the error, if any."""
+        subject, body_html, body_text, attachments, template_name, engine = content
+        
+        # Wait for the global, account and recipient-domain rate limits
+        self.rate_limiter.acquire(self.config['smtp']['username'], customer['email'])
+        
+        # Send personalized email
+        try:
+            msg = self.render_for_customer(customer, subject, body_html, body_text, attachments,
+                                           engine=engine)
+        except Exception as e:
+            self.logger.error(f"Error rendering email for {customer['email']}: {str(e)}")
+            error = e
+        else:
+            error = self._send_prepared(customer['email'], msg, session)
+        # Also counts the send in the customer's stats
+        result.record(error is None, customer, error)
+        if error is not None:
+            self.queue_retry(customer, template_name, attachments, error)
+        return error
+    
+    def render_for_customer(self, customer: Dict, subject: str, body_html: str = "",
+                            body_text: str = "", attachments: List[str] = None,
+                            to_email: str = None, engine: str = None):
+        """Personalize template content for a customer and serialize the message.
+
+        `to_email` overrides the To header, for messages sent to a group.
+        """
+        subject, body_html, body_text = self.personalize_parts(customer, subject, body_html,
+                                                               body_text, engine)
+        return self.render_message(
+            to_email=to_email or customer['email'],
+            subject=subject,
+            body_html=body_html,
+            body_text=body_text,
+            attachments=attachments
+        )
+    
+    def render_many(self, template: Dict, customers: Iterable[Dict], attachments: List[str] = None,
+                    cache_size: int = 10000) -> Iterator[Tuple[Dict, object]]:
+        """Render a template for many customers, yielding (customer, message) in order.
+
+        Only the fields the template uses are compared: customers with the
+        same values for them share one personalization and one encoding of
+        the subject and bodies, and only the To header is serialized per
+        message. Up to `cache_size` distinct renderings are kept.
+        """
+        batches = ([customer] for customer in customers)
+        for batch, msg in self._render_batches(template, batches, attachments, cache_size):
+            yield batch[0], msg
+    
+    def _render_batches(self, template: Dict, batches: Iterable[List[Dict]], attachments: List[str] = None,
+                        cache_size: int = 10000) -> Iterator[Tuple[List[Dict], object]]:
+        """Render planned batches (see _plan_batches), yielding (batch, message)."""
+        subject, body_html, body_text = template['subject'], template['body_html'], template['body_text']
+        engine = template.get('engine')
+        fields = get_template_fields(*self.compile_parts(subject, body_html, body_text, engine))
+        # With {{email}} every rendering is different, so there is nothing to share
+        shared = 'email' not in fields
+        attachment_parts = self.get_attachment_parts(attachments)
+        bodies: OrderedDict = OrderedDict()
+        
+        for batch in batches:
+            to_email = batch[0]['email'] if len(batch) == 1 else "undisclosed-recipients:;"
+            key = tuple(batch[0].get(field) or '' for field in fields) if shared else None
+            body = bodies.get(key) if shared else None
+            if body is not None:
+                bodies.move_to_end(key)
+                yield batch, self.message_skeleton.address(to_email, body)
+                continue
+            
+            parts = self.personalize_parts(batch[0], subject, body_html, body_text, engine)
+            if not shared:
+                msg = self.message_skeleton.render(to_email, *parts, attachment_parts)
+            else:
+                body = self.message_skeleton.prepare(*parts, attachment_parts)
+                msg = body and self.message_skeleton.address(to_email, body)
+                if body is not None:
+                    bodies[key] = body
+                    if len(bodies) > cache_size:
+                        bodies.popitem(last=False)
+            # The skeleton cannot be used if a body contains its boundary
+            yield batch, msg if msg is not None else self.build_message(to_email, *parts, attachments)
+    
+    def queue_retry(self, customer: Dict, template_name: str,
+                    attachments: Optional[List[str]], error):
+        """Put a failed bulk recipient in the outbox (dead-lettered if the error is permanent)."""
+        if not self.config.get('outbox', {}).get('enabled', True):
+            return
+        try:
+            status = self.outbox.enqueue(customer, template_name, attachments, error)
+            if status == 'pending':
+                self.logger.info(f"Queued {customer['email']} for retry")
+        except Exception as e:
+            self.logger.error(f"Error queueing retry for {customer['email']}: {str(e)}")
+    
+    def process_outbox(self, limit: int = None) -> Dict[str, int]:
+        """Retry due outbox entries; returns counts of sent, rescheduled and dead entries.
+
+        Each entry is re-rendered from its template and the customer's current
+        details. Transient failures are retried with exponential backoff until
+        outbox.max_attempts, permanent ones go straight to the dead-letter state.
+        """
+        if limit is None:
+            limit = self.config.get('outbox', {}).get('batch_size', 100)
+        summary = {"sent": 0, "retrying": 0, "dead": 0}
+        try:
+            entries = self.outbox.claim_due(limit)
+        except Exception as e:
+            self.logger.error(f"Error reading outbox: {str(e)}")
+            return summary
+        
+        templates: Dict[str, Optional[Dict]] = {}
+        for entry in entries:
+            template_name = entry['template_name']
+            if template_name not in templates:
+                templates[template_name] = self.get_email_template(template_name)
+            template = templates[template_name]
+            customer = self.get_customer(entry['customer_id'])
+            
+            if not template or not customer:
+                error = ValueError(f"template '{template_name}' or customer {entry['customer_id']} no longer exists")
+            else:
+                self.rate_limiter.acquire(self.config['smtp']['username'], customer['email'])
+                try:
+                    msg = self.render_for_customer(customer, template['subject'], template['body_html'],
+                                                   template['body_text'], entry['attachments'],
+                                                   engine=template['engine'])
+                    error = self._send_prepared(customer['email'], msg)
+                except Exception as e:
+                    error = e
             
-            # Send email
-            if self.send_email(
-                to_email=customer['email'],
-                subject=personalized_subject,
-                body_html=personalized_html,
-                body_text=personalized_text
-            ):
-                sent_count += 1
-                # Update customer record
+            if error is None:
+                self.outbox.mark_sent(entry['id'])
                 self.update_customer_email_stats(customer['id'])
+                summary["sent"] += 1
+            elif self.outbox.mark_failed(entry, error) == 'dead':
+                self.logger.warning(f"Giving up on {entry['to_email']} after {entry['attempts'] + 1} attempts: {error}")
+                summary["dead"] += 1
+            else:
+                summary["retrying"] += 1
+        
+        self.email_stats.flush()
+        if entries:
+            self.logger.info(f"Outbox processed: {summary['sent']} sent, "
+                             f"{summary['retrying']} rescheduled, {summary['dead']} dead")
+        return summary
+    
+    def dry_run_bulk(self, template: Dict, customer_filter: str = "active", limit: int = None,
+                     attachments: List[str] = None) -> Dict:
+        """Render a bulk run without sending it, timing each stage.
+
+        Customers are fetched, batched, personalized, built and serialized to
+        DATA bytes exactly as for a real send, then written to os.devnull.
+        No SMTP connection is made and no stats, checkpoints or outbox rows
+        are written. Templates that fail to render are counted as failed.
+        """
+        timings = {"fetch": 0.0, "plan": 0.0, "personalize": 0.0, "build": 0.0, "serialize": 0.0}
+        subject, body_html, body_text = template['subject'], template['body_html'], template['body_text']
+        username = self.config['smtp']['username']
+        messages = recipients = total_bytes = failed = 0
+        
+        start = time.perf_counter()
+        customers = self.get_customers(status=customer_filter, limit=limit)
+        fetched = time.perf_counter()
+        batches = self._plan_batches(customers, (subject, body_html, body_text, attachments,
+                                                 template['name'], template['engine']))
+        planned = time.perf_counter()
+        timings['fetch'], timings['plan'] = fetched - start, planned - fetched
+        
+        with open(os.devnull, "wb") as devnull:
+            for batch in batches:
+                emails = [customer['email'] for customer in batch]
+                try:
+                    stage_start = time.perf_counter()
+                    parts = self.personalize_parts(batch[0], subject, body_html, body_text,
+                                                   template['engine'])
+                    personalized = time.perf_counter()
+                    msg = self.render_message(emails[0] if len(batch) == 1 else "undisclosed-recipients:;",
+                                              *parts, attachments=attachments)
+                    built = time.perf_counter()
+                    size = self._write_data(msg, username, emails, devnull)
+                    serialized = time.perf_counter()
+                except Exception as e:
+                    self.logger.error(f"Dry run failed to render email for {emails[0]}: {str(e)}")
+                    failed += len(batch)
+                    continue
+                timings['personalize'] += personalized - stage_start
+                timings['build'] += built - personalized
+                timings['serialize'] += serialized - built
+                messages += 1
+                recipients += len(batch)
+                total_bytes += size
+        
+        elapsed = time.perf_counter() - start
+        rate = messages / elapsed if elapsed else 0.0
+        stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in timings.items())
+        self.logger.info(f"Dry run of '{template['name']}': {messages} messages for {recipients} recipients, "
+                         f"{total_bytes} bytes in {elapsed:.2f}s ({rate:.0f} msg/s); {stages}")
+        return {
+            "sent": 0,
+            "failed": failed,
+            "dry_run": True,
+            "messages": messages,
+            "recipients": recipients,
+            "bytes": total_bytes,
+            "seconds": round(elapsed, 3),
+            "messages_per_second": round(rate, 1),
+            "timings": {stage: round(seconds, 4) for stage, seconds in timings.items()}
+        }
+    
+    @staticmethod
+    def _write_data(msg, from_addr: str, recipients: List[str], output) -> int:
+        """Write a rendered message as it would follow DATA; returns the byte count."""
+        if isinstance(msg, Message):
+            msg = flatten_message(msg, from_addr, recipients)[2]
+        if isinstance(msg, bytes):
+            data = quote_data(msg)
+            output.write(data)
+            return len(data)
+        size = 0
+        for segment in msg.iter_segments():
+            for chunk in ([quote_lines(segment)] if isinstance(segment, bytes) else segment):
+                output.write(chunk)
+                size += len(chunk)
+        return size
+    
+    def spool_bulk_emails(self, template_name: str, customer_filter: str = "active",
+                          limit: int = None, attachments: List[str] = None,
+                          processes: int = None, spool_dir: str = None) -> Optional[str]:
+        """Phase one of a two-phase send: render a bulk run into an on-disk spool.
+
+        Every message is written fully rendered, so deliver_spool() never
+        touches templates or customers. Rendering is sharded across
+        `processes` worker processes (default: email_settings.processes),
+        each writing its own segment files. Returns the spool directory.
+        """
+        template = self.get_email_template(template_name)
+        if not template:
+            self.logger.error(f"Template '{template_name}' not found")
+            return None
+        
+        if processes is None:
+            processes = self.config['email_settings'].get('processes', 1)
+        spool_settings = self.config.get('spool', {})
+        spool_path = os.path.join(spool_dir or spool_settings.get('directory', 'spool'),
+                                  f"{template_name}-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}")
+        os.makedirs(spool_path)
+        max_id = self._pin_customer_range(customer_filter, limit)
+        
+        start = time.time()
+        if processes > 1:
+            context = multiprocessing.get_context("spawn")
+            results = context.Queue()
+            workers = [context.Process(target=_spool_shard_worker,
+                                       args=(self.config_file, template_name, customer_filter,
+                                             (index, processes), max_id, attachments, spool_path, results),
+                                       name=f"spool-shard-{index}", daemon=True)
+                       for index in range(processes)]
+            for worker in workers:
+                worker.start()
+            counts = []
+            while len(counts) < processes:
+                try:
+                    counts.append(results.get(timeout=1))
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers) and results.empty():
+                        break
+            for worker in workers:
+                worker.join()
+            if len(counts) < processes:
+                self.logger.error(f"Spool rendering failed: {processes - len(counts)} shards did not finish")
+                return None
+        else:
+            counts = [self._spool_shard(template, customer_filter, max_id, None,
+                                        attachments, spool_path, 0)]
+        
+        totals = {key: sum(count[key] for count in counts) for key in ("messages", "recipients", "bytes")}
+        write_manifest(spool_path, dict(totals, template_name=template_name,
+                                        customer_filter=customer_filter, attachments=attachments,
+                                        created_at=datetime.now().isoformat()))
+        self.logger.info(f"Spooled {totals['messages']} messages for {totals['recipients']} recipients "
+                         f"({totals['bytes']} bytes) to {spool_path} in {time.time() - start:.1f}s")
+        return spool_path
+    
+    def _spool_shard(self, template: Dict, customer_filter: str, max_id: int, shard: Optional[tuple],
+                     attachments: Optional[List[str]], spool_path: str, writer_index: int) -> Dict[str, int]:
+        """Render the customers of one shard (all if None) into spool segments."""
+        customers = self.get_customers(status=customer_filter, shard=shard, max_id=max_id)
+        subject, body_html, body_text = template['subject'], template['body_html'], template['body_text']
+        content = (subject, body_html, body_text, attachments, template['name'], template['engine'])
+        writer = SpoolWriter(spool_path, f"segment-{writer_index:03d}",
+                             self.config.get('spool', {}).get('max_segment_bytes', 256 * 1024 * 1024))
+        try:
+            batches = self._plan_batches(customers, content)
+            for batch, msg in self._render_batches(template, batches, attachments):
+                recipients = [customer['email'] for customer in batch]
+                if isinstance(msg, Message):
+                    msg = flatten_message(msg, self.config['smtp']['username'], recipients)[2]
+                writer.write(msg, [customer['id'] for customer in batch], recipients)
+        finally:
+            writer.close()
+        return {"messages": writer.messages, "recipients": writer.recipients, "bytes": writer.bytes}
+    
+    def deliver_spool(self, spool_path: str, concurrency: int = None,
+                      segments: List[str] = None) -> Dict[str, int]:
+        """Phase two of a two-phase send: send spooled messages exactly as stored.
+
+        Entries already in a segment's delivered log are skipped, so delivery
+        can be stopped and restarted. `segments` restricts delivery to some
+        segment names, to split one spool between several machines.
+        """
+        try:
+            reader = SpoolReader(spool_path)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Cannot deliver spool: {str(e)}")
+            return {"sent": 0, "failed": 0}
+        
+        if concurrency is None:
+            concurrency = self.config['email_settings'].get('concurrency', 1)
+        work = []
+        for segment in reader.segments():
+            if segments and segment not in segments:
+                continue
+            delivered = reader.delivered(segment)
+            work += [(segment, number, entry) for number, entry in enumerate(reader.entries(segment))
+                     if number not in delivered]
+        
+        result = BulkSendResult(stats=self.email_stats)
+        handle = lambda item, session: self._deliver_spooled(reader, item, result, session)
+        try:
+            if concurrency > 1 and len(work) > 1:
+                self._run_concurrent(work, handle, concurrency)
             else:
-                failed_count += 1
+                for item in work:
+                    handle(item, None)
+        finally:
+            reader.close()
+            self.email_stats.flush()
+        
+        self.logger.info(f"Spool delivery completed: {result.sent} sent, {result.failed} failed")
+        return result.as_dict()
+    
+    def _deliver_spooled(self, reader: SpoolReader, item: tuple, result: BulkSendResult,
+                         session: Optional[SMTPSession] = None):
+        """Send one spooled message and log it as delivered."""
+        segment, number, entry = item
+        recipients = entry['rcpt']
+        self.rate_limiter.acquire(self.config['smtp']['username'], recipients[0], len(recipients))
+        try:
+            refused = self._transmit(reader.message(segment, entry), session,
+                                     self.config['smtp']['username'], recipients)
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+        except Exception as e:
+            refused = {email: e for email in recipients}
+        
+        for customer_id, email in zip(entry['ids'], recipients):
+            customer = {"id": customer_id, "email": email}
+            if email in refused:
+                self.logger.error(f"Error sending email to {email}: {refused[email]}")
+                result.record(False, customer, refused[email])
+                self.queue_retry(customer, reader.manifest['template_name'],
+                                 reader.manifest.get('attachments'), refused[email])
+            else:
+                result.record(True, customer)
+        reader.mark_delivered(segment, number, len(recipients) - len(refused))
+    
+    def enqueue_bulk_emails(self, template_name: str, customer_filter: str = "active",
+                            limit: int = None, attachments: List[str] = None) -> Optional[str]:
+        """Queue a bulk send on the Redis send queue for run_queue_worker() on any node.
+
+        Returns the campaign id, or None if the template does not exist.
+        """
+        template = self.get_email_template(template_name)
+        if not template:
+            self.logger.error(f"Template '{template_name}' not found")
+            return None
+        
+        customers = self.get_customers(status=customer_filter, limit=limit)
+        content = {
+            "template_name": template_name,
+            "subject": template['subject'],
+            "body_html": template['body_html'],
+            "body_text": template['body_text'],
+            "engine": template['engine'],
+            "attachments": attachments
+        }
+        campaign_id = self._get_send_queue().enqueue_campaign(content, customers)
+        self.logger.info(f"Queued {len(customers)} emails for campaign {campaign_id} ({template_name})")
+        return campaign_id
+    
+    def run_queue_worker(self, concurrency: int = None, max_messages: int = None,
+                         idle_timeout: float = None) -> Dict[str, int]:
+        """Send jobs from the Redis send queue until stopped.
+
+        Runs `concurrency` threads, each with its own SMTP session. Returns
+        after about `max_messages` sends, or once the queue has been empty for
+        `idle_timeout` seconds; with neither set it runs until interrupted.
+        """
+        if concurrency is None:
+            concurrency = self.config['email_settings'].get('concurrency', 1)
+        send_queue = self._get_send_queue()
+        settings = self.config.get('redis_queue', {})
+        claim_batch = settings.get('claim_batch', 10)
+        poll_interval = settings.get('poll_interval', 1)
+        # Customer ids are the enqueueing node's; it counts the sends in collect_queue_stats()
+        result = BulkSendResult()
+        stop = threading.Event()
+        
+        def worker():
+            session = None
+            if concurrency > 1:
+                try:
+                    session = self.smtp_pool.acquire()
+                except Exception as e:
+                    self.logger.error(f"Queue worker could not open SMTP session: {str(e)}")
+            idle_since = time.monotonic()
+            try:
+                while not stop.is_set():
+                    count = claim_batch
+                    if max_messages:
+                        count = min(count, max_messages - result.sent - result.failed)
+                        if count <= 0:
+                            stop.set()
+                            break
+                    send_queue.reclaim_expired()
+                    jobs = send_queue.claim(count)
+                    if not jobs:
+                        if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                            break
+                        stop.wait(poll_interval)
+                        continue
+                    idle_since = time.monotonic()
+                    for job_id, job, lease in jobs:
+                        if session is not None:
+                            session = self._renew_session(session)
+                        self._send_queued_job(send_queue, job_id, job, lease, result, session)
+            finally:
+                if session is not None:
+                    self.smtp_pool.release(session)
+        
+        if concurrency > 1:
+            threads = [threading.Thread(target=worker, name=f"queue-sender-{i}", daemon=True)
+                       for i in range(min(concurrency, self.smtp_pool.max_sessions))]
+            for thread in threads:
+                thread.start()
+            try:
+                for thread in threads:
+                    thread.join()
+            finally:
+                stop.set()
+        else:
+            worker()
+        
+        self.logger.info(f"Queue worker stopped: {result.sent} sent, {result.failed} failed")
+        return result.as_dict()
+    
+    def _send_queued_job(self, send_queue: RedisSendQueue, job_id: str, job: Dict, lease: float,
+                         result: BulkSendResult, session: Optional[SMTPSession] = None):
+        """Send one queued job, then ack it or hand it back for retry.
+
+        If the lease ran out meanwhile, the job may already belong to another
+        worker and is left alone.
+        """
+        customer = job['customer']
+        campaign = send_queue.campaign(job['campaign'])
+        if campaign is None:
+            error = ValueError(f"campaign {job['campaign']} no longer exists")
+        else:
+            self.rate_limiter.acquire(self.config['smtp']['username'], customer['email'])
+            try:
+                msg = self.render_for_customer(customer, campaign['subject'], campaign['body_html'],
+                                               campaign['body_text'], campaign['attachments'],
+                                               engine=campaign.get('engine'))
+                error = self._send_prepared(customer['email'], msg, session)
+            except Exception as e:
+                self.logger.error(f"Error sending email to {customer['email']}: {str(e)}")
+                error = e
+        
+        result.record(error is None, customer, error)
+        if error is None:
+            status = 'sent' if send_queue.ack(job_id, job, lease) else 'lost'
+        else:
+            status = send_queue.fail(job_id, job, error, lease)
+        if status == 'dead':
+            self.logger.warning(f"Giving up on {customer['email']} after {job['attempts'] + 1} attempts: {error}")
+        elif status == 'lost':
+            self.logger.warning(f"Lease on the job for {customer['email']} ran out before it finished; "
+                                f"the job is left to be claimed again")
+    
+    def collect_queue_stats(self) -> int:
+        """Update the email stats of customers sent by queue workers; returns how many.
+
+        Call this on the node that ran enqueue_bulk_emails(), as the sender
+        nodes report customer ids from its database.
+        """
+        collected = 0
+        try:
+            send_queue = self._get_send_queue()
+            while True:
+                sent = send_queue.drain_sent()
+                for customer_id in sent:
+                    self.email_stats.add(customer_id)
+                collected += len(sent)
+                if not sent:
+                    break
+        except Exception as e:
+            self.logger.error(f"Error collecting queue stats: {str(e)}")
+        self.email_stats.flush()
+        return collected
+    
+    def _get_send_queue(self) -> RedisSendQueue:
+        if self.send_queue is None:
+            self.send_queue = RedisSendQueue.from_config(self.config)
+        return self.send_queue
+    
+    def _send_bulk_concurrent(self, batches: List[List[Dict]], content: tuple,
+                              result: BulkSendResult, concurrency: int):
+        """Send batches from worker threads that each own an SMTP session."""
+        self._run_concurrent(
+            batches, lambda batch, session: self._send_batch(batch, content, result, session),
+            concurrency)
+    
+    def _run_concurrent(self, items: List, handle, concurrency: int):
+        """Call handle(item, session) for every item from worker threads with their own sessions."""
+        work_queue = queue.Queue()
+        for item in items:
+            work_queue.put(item)
+        
+        # A worker that cannot get its own session would only wait for others
+        worker_count = min(concurrency, self.smtp_pool.max_sessions, len(items))
+        
+        def worker():
+            # Adaptive workers take a pooled session per send, so open sessions follow the limit
+            session = None
+            if self.adaptive_concurrency is None:
+                try:
+                    session = self.smtp_pool.acquire()
+                except Exception as e:
+                    # Fall back to per-message pooled sessions so failures are counted
+                    self.logger.error(f"Bulk worker could not open SMTP session: {str(e)}")
+            try:
+                while True:
+                    try:
+                        item = work_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if session is not None:
+                        session = self._renew_session(session)
+                    try:
+                        handle(item, session)
+                    except Exception as e:
+                        # Keep the worker alive for the items queued behind this one
+                        self.logger.error(f"Bulk worker failed to send an item: {str(e)}")
+            finally:
+                if session is not None:
+                    self.smtp_pool.release(session)
+        
+        threads = [threading.Thread(target=worker, name=f"bulk-sender-{i}", daemon=True)
+                   for i in range(worker_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        
+        self.logger.info(f"Concurrent bulk send used {worker_count} workers")
+
+    def _renew_session(self, session: SMTPSession) -> Optional[SMTPSession]:
+        """A worker's held session, recycled by the pool when due (None if reopening fails)."""
+        try:
+            return self.smtp_pool.renew(session)
+        except Exception as e:
+            # Fall back to per-message pooled sessions so failures are counted
+            self.logger.error(f"Worker could not reopen SMTP session: {str(e)}")
+            return None
+
+    async def send_email_async(self, to_email: str, subject: str, body_html: str = "",
+                               body_text: str = "", attachments: List[str] = None,
+                               sender: Optional[AsyncSMTPSender] = None) -> bool:
+        """Send a single email from asyncio code."""
+        try:
+            msg = self.build_message(to_email, subject, body_html, body_text, attachments)
+        except Exception as e:
+            self.logger.error(f"Error sending email to {to_email}: {str(e)}")
+            return False
+        return await self._send_prepared_async(to_email, msg, sender) is None
+    
+    async def _send_prepared_async(self, to_email: str, msg,
+                                   sender: Optional[AsyncSMTPSender] = None) -> Optional[Exception]:
+        """Asyncio counterpart to _send_prepared(); returns None or the error."""
+        try:
+            if sender is not None:
+                await sender.send_message(msg)
+            else:
+                async with AsyncSMTPSender(self.config['smtp'], 1, self.logger) as own_sender:
+                    await own_sender.send_message(msg)
+            
+            self.logger.info(f"Email sent successfully to {to_email}")
+            return None
             
-            # Delay between emails to avoid spam filters
-            time.sleep(self.config['email_settings']['delay_between_emails'])
+        except Exception as e:
+            self.logger.error(f"Error sending email to {to_email}: {str(e)}")
+            return e
+    
+    async def send_bulk_emails_async(self, template_name: str, customer_filter: str = "active",
+                                     limit: int = None, concurrency: int = None) -> Dict[str, int]:
+        """Send bulk emails using a template, with many SMTP sessions on one event loop.
+
+        Same template lookup, personalization and result summary as
+        send_bulk_emails; concurrency defaults to email_settings.async_concurrency.
+        """
+        template = self.get_email_template(template_name)
+        if not template:
+            self.logger.error(f"Template '{template_name}' not found")
+            return {"sent": 0, "failed": 0}
+        
+        customers = self.get_customers(status=customer_filter, limit=limit)
+        
+        if concurrency is None:
+            concurrency = self.config['email_settings'].get('async_concurrency', 100)
         
-        self.logger.info(f"Bulk email completed: {sent_count} sent, {failed_count} failed")
-        return {"sent": sent_count, "failed": failed_count}
+        result = BulkSendResult(stats=self.email_stats)
+        subject, body_html, body_text = template['subject'], template['body_html'], template['body_text']
+        account = self.config['smtp']['username']
+        pending = iter(customers)
+        
+        async def worker(sender: AsyncSMTPSender):
+            # Workers share one iterator, so at most `concurrency` sends are in flight
+            for customer in pending:
+                await self.rate_limiter.acquire_async(account, customer['email'])
+                try:
+                    personal_subject, personal_html, personal_text = self.personalize_parts(
+                        customer, subject, body_html, body_text, template['engine'])
+                    msg = self.build_message(
+                        to_email=customer['email'],
+                        subject=personal_subject,
+                        body_html=personal_html,
+                        body_text=personal_text
+                    )
+                    error = await self._send_prepared_async(customer['email'], msg, sender)
+                except Exception as e:
+                    self.logger.error(f"Error sending email to {customer['email']}: {str(e)}")
+                    error = e
+                result.record(error is None, customer, error)
+                if error is not None:
+                    self.queue_retry(customer, template_name, None, error)
+        
+        async with AsyncSMTPSender(self.config['smtp'], concurrency, self.logger) as sender:
+            worker_count = max(1, min(concurrency, len(customers)))
+            await asyncio.gather(*(worker(sender) for _ in range(worker_count)))
+        self.email_stats.flush()
+        
+        self.logger.info(f"Async bulk email completed: {result.sent} sent, {result.failed} failed")
+        return result.as_dict()
     
     def personalize_content(self, content: str, customer: Dict) -> str:
         """Personalize email content with customer data."""
         if not content:
             return content
-        
-        replacements = {
-            '{{first_name}}': customer.get('first_name', ''),
-            '{{last_name}}': customer.get('last_name', ''),
-            '{{email}}': customer.get('email', ''),
-            '{{company}}': customer.get('company', ''),
-            '{{phone}}': customer.get('phone', ''),
-            '{{full_name}}': f"{customer.get('first_name', '')} {customer.get('last_name', '')}".strip()
-        }
-        
-        personalized_content = content
-        for placeholder, value in replacements.items():
-            personalized_content = personalized_content.replace(placeholder, value)
-        
-        return personalized_content
+        return compile_template(content).render(placeholder_values(customer))
+    
+    def personalize_parts(self, customer: Dict, subject: str, body_html: str, body_text: str,
+                          engine: str = None) -> List[str]:
+        """Personalize the parts of one email, working out the customer's values once."""
+        values = placeholder_values(customer)
+        compiled = self.compile_parts(subject, body_html, body_text, engine)
+        return [template.render(values) if content else content
+                for template, content in zip(compiled, (subject, body_html, body_text))]
+    
+    def compile_parts(self, subject: str, body_html: str, body_text: str, engine: str = None) -> List:
+        """Compiled subject, HTML and text parts of a template (cached by their text)."""
+        if engine == 'jinja2':
+            jinja = self.get_jinja_engine()
+            return [jinja.compile(subject or ""), jinja.compile(body_html or "", html=True),
+                    jinja.compile(body_text or "")]
+        return [compile_template(part or "") for part in (subject, body_html, body_text)]
+    
+    def get_jinja_engine(self) -> JinjaEngine:
+        """The Jinja2 engine, with the bytecode cache from templates.jinja_bytecode_cache."""
+        if self.jinja_engine is None:
+            self.jinja_engine = JinjaEngine(
+                self.config.get('templates', {}).get('jinja_bytecode_cache', 'jinja_cache'))
+        return self.jinja_engine
     
     def update_customer_email_stats(self, customer_id: int):
-        """Update customer email statistics."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute('''
-            UPDATE customers 
-            SET last_email_sent = CURRENT_TIMESTAMP, 
-                email_count = email_count + 1 
-            WHERE id = ?
-        ''', (customer_id,))
-        conn.commit()
-        conn.close()
+        """Count a sent email in the customer's statistics.
+
+        Updates are buffered and written in batches (see the `stats` config
+        section); bulk sends flush them when they finish, and close() does too.
+        """
+        self.email_stats.add(customer_id)
     
     def schedule_email_campaign(self, campaign_name: str, template_name: str, 
                               scheduled_time: str, customer_filter: str = "active") -> bool:
         """Schedule an email campaign."""
         try:
             # Get template ID
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM email_templates WHERE name = ?", (template_name,))
-            template_result = cursor.fetchone()
+            conn = self.connections.connection()
+            with conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT id FROM email_templates WHERE name = ?", (template_name,))
+                template_result = cursor.fetchone()
             
-            if not template_result:
-                self.logger.error(f"Template '{template_name}' not found")
-                return False
+                if not template_result:
+                    self.logger.error(f"Template '{template_name}' not found")
+                    return False
             
-            template_id = template_result[0]
+                template_id = template_result[0]
             
-            # Create campaign
-            cursor.execute('''
-                INSERT INTO email_campaigns 
-                (name, template_id, scheduled_time, status)
-                VALUES (?, ?, ?, ?)
-            ''', (campaign_name, template_id, scheduled_time, 'scheduled'))
-            
-            conn.commit()
-            conn.close()
+                # Create campaign
+                cursor.execute('''
+                    INSERT INTO email_campaigns 
+                    (name, template_id, scheduled_time, status)
+                    VALUES (?, ?, ?, ?)
+                ''', (campaign_name, template_id, scheduled_time, 'scheduled'))
             
             self.logger.info(f"Campaign '{campaign_name}' scheduled for {scheduled_time}")
             return True
@@ -574,14 +1985,19 @@ class EmailAutomation:
             self.logger.error(f"Error scheduling campaign: {str(e)}")
             return False
     
-    def run_scheduled_campaigns(self):
-        """Run all scheduled campaigns that are due."""
-        conn = sqlite3.connect(self.db_path)
+    def run_scheduled_campaigns(self, dry_run: bool = False) -> Dict[str, Dict]:
+        """Run all scheduled campaigns that are due; returns the results by campaign name.
+
+        With dry_run, each campaign is rendered but not sent (see dry_run_bulk)
+        and stays scheduled.
+        """
+        results = {}
+        conn = self.connections.connection()
         cursor = conn.cursor()
         
-        # Get campaigns that are due
+        # Get campaigns that are due; send_bulk_emails gets the template from the cache
         cursor.execute('''
-            SELECT c.*, t.name as template_name, t.subject, t.body_html, t.body_text
+            SELECT c.id, c.name, t.name as template_name
             FROM email_campaigns c
             JOIN email_templates t ON c.template_id = t.id
             WHERE c.status = 'scheduled' AND c.scheduled_time <= ?
@@ -590,12 +2006,15 @@ class EmailAutomation:
         campaigns = cursor.fetchall()
         
         for campaign in campaigns:
-            campaign_id, name, template_id, status, scheduled_time, created_at, template_name, subject, body_html, body_text = campaign
+            campaign_id, name, template_name = campaign
             
             self.logger.info(f"Running scheduled campaign: {name}")
             
             # Send bulk emails
-            result = self.send_bulk_emails(template_name)
+            result = self.send_bulk_emails(template_name, dry_run=dry_run)
+            results[name] = result
+            if dry_run:
+                continue
             
             # Update campaign status
             cursor.execute('''
@@ -606,11 +2025,11 @@ class EmailAutomation:
             
             conn.commit()
         
-        conn.close()
+        return results
     
     def get_statistics(self) -> Dict:
         """Get email automation statistics."""
-        conn = sqlite3.connect(self.db_path)
+        conn = self.connections.connection()
         cursor = conn.cursor()
         
         # Total customers
@@ -633,22 +2052,34 @@ class EmailAutomation:
         cursor.execute("SELECT COUNT(*) FROM email_campaigns")
         total_campaigns = cursor.fetchone()[0]
         
-        conn.close()
-        
         return {
             "total_customers": total_customers,
             "active_customers": active_customers,
             "total_emails_sent": total_emails,
             "total_templates": total_templates,
-            "total_campaigns": total_campaigns
+            "total_campaigns": total_campaigns,
+            "outbox": self.outbox.counts(),
+            "concurrency": (merge_snapshots([self.adaptive_concurrency.snapshot()] + self.shard_concurrency)
+                            if self.adaptive_concurrency else None)
         }
 
+    def close(self):
+        """Flush buffered stats, then close pooled SMTP sessions and database connections."""
+        self.smtp_pool.close_all()
+        self.email_stats.flush()
+        self.connections.close()
+
 def main():
     """Main function to run the email automation system."""
     automation = EmailAutomation()
     
     # Schedule the campaign runner to run every minute
     schedule.every(1).minutes.do(automation.run_scheduled_campaigns)
+    # Retry failed sends from the outbox
+    schedule.every(1).minutes.do(automation.process_outbox)
+    # Count sends made by Redis queue workers on other nodes
+    if automation.config.get('redis_queue', {}).get('collect_stats', False):
+        schedule.every(1).minutes.do(automation.collect_queue_stats)
     
     print("Email Automation System Started")
     print("Press Ctrl+C to stop")
@@ -659,6 +2090,8 @@ def main():
             time.sleep(1)
     except KeyboardInterrupt:
         print("\nEmail Automation System Stopped")
+    finally:
+        automation.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,407 @@
+"""
+HTML Preprocessor
+Inlines CSS, minifies HTML and derives a plain-text part when a template is saved.
+"""
+
+import html
+import re
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+
+DEFAULT_PREPROCESS_SETTINGS = {
+    "inline_css": True,
+    "minify_html": True,
+    "generate_text": True
+}
+
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+                 'param', 'source', 'track', 'wbr'}
+# Whitespace next to these elements does not show, so minifying drops it
+BLOCK_ELEMENTS = {'address', 'article', 'aside', 'blockquote', 'body', 'br', 'caption', 'center',
+                  'dd', 'div', 'dl', 'dt', 'fieldset', 'figcaption', 'figure', 'footer', 'form',
+                  'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'head', 'header', 'hr', 'html', 'li', 'link',
+                  'main', 'meta', 'nav', 'ol', 'p', 'pre', 'section', 'style', 'table', 'tbody',
+                  'td', 'tfoot', 'th', 'thead', 'title', 'tr', 'ul'}
+# Content of these elements is copied exactly
+RAW_ELEMENTS = {'pre', 'textarea', 'script', 'style'}
+# Elements that start a new paragraph in the text part
+PARAGRAPH_ELEMENTS = {'p', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'table', 'ul', 'ol', 'blockquote', 'pre'}
+SKIPPED_TEXT_ELEMENTS = {'head', 'title', 'style', 'script'}
+
+STYLE_BLOCK = re.compile(r'<style\b([^>]*)>(.*?)</style\s*>', re.I | re.S)
+CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+# Semicolons outside parentheses, so url(data:...;base64,...) stays whole
+DECLARATION_SEPARATOR = re.compile(r';(?![^(]*\))')
+# tag, .class, #id and combinations such as td.header; anything else stays in <style>
+SIMPLE_SELECTOR = re.compile(r'^([a-zA-Z][\w-]*|\*)?((?:[.#][\w-]+)*)$')
+WHITESPACE = re.compile(r'\s+')
+# Minified lines are broken at about this length, well under the 998 characters
+# RFC 5322 allows, to leave room for personalized values
+MAX_LINE_LENGTH = 900
+
+
+def parse_declarations(block: str) -> List[Tuple[str, str]]:
+    """(property, value) pairs of a CSS declaration block, in order."""
+    declarations = []
+    for declaration in DECLARATION_SEPARATOR.split(block):
+        name, separator, value = declaration.partition(':')
+        if separator and name.strip() and value.strip():
+            declarations.append((name.strip().lower(), WHITESPACE.sub(' ', value.strip())))
+    return declarations
+
+
+def parse_stylesheet(css: str) -> Tuple[List[Tuple[str, List[Tuple[str, str]]]], List[str]]:
+    """Split a stylesheet into inlinable (selector, declarations) rules and rules to keep.
+
+    At-rules such as @media, and rules with selectors that cannot be
+    matched without a document tree (descendants, pseudo-classes), are kept.
+    """
+    css = CSS_COMMENT.sub('', css)
+    rules = []
+    kept = []
+    position = 0
+    while True:
+        open_brace = css.find('{', position)
+        if open_brace == -1:
+            break
+        depth, index = 1, open_brace + 1
+        while index < len(css) and depth:
+            if css[index] == '{':
+                depth += 1
+            elif css[index] == '}':
+                depth -= 1
+            index += 1
+        prelude = css[position:open_brace].strip()
+        block = css[open_brace + 1:index - 1].strip()
+        position = index
+        if prelude.startswith('@') or '{' in block:
+            kept.append(f"{prelude}{{{block}}}")
+            continue
+        selectors = [selector.strip() for selector in prelude.split(',') if selector.strip()]
+        declarations = parse_declarations(block)
+        complex_selectors = []
+        for selector in selectors:
+            if SIMPLE_SELECTOR.match(selector):
+                rules.append((selector, declarations))
+            else:
+                complex_selectors.append(selector)
+        if complex_selectors:
+            kept.append(f"{','.join(complex_selectors)}{{{block}}}")
+    return rules, kept
+
+
+class _Selector:
+    """A compound selector of a tag, classes and an id."""
+
+    def __init__(self, selector: str, order: int, declarations: List[Tuple[str, str]]):
+        match = SIMPLE_SELECTOR.match(selector)
+        tag = match.group(1)
+        self.tag = None if tag in (None, '*') else tag.lower()
+        parts = re.findall(r'[.#][\w-]+', match.group(2))
+        self.classes = {part[1:] for part in parts if part[0] == '.'}
+        self.ids = {part[1:] for part in parts if part[0] == '#'}
+        self.specificity = (len(self.ids), len(self.classes), 1 if self.tag else 0, order)
+        self.declarations = declarations
+
+    def matches(self, tag: str, classes: set, element_id: Optional[str]) -> bool:
+        return ((self.tag is None or self.tag == tag)
+                and self.classes <= classes
+                and self.ids <= {element_id})
+
+
+class _HTMLRewriter(HTMLParser):
+    """Re-serializes HTML, applying inline styles and collapsing whitespace."""
+
+    def __init__(self, selectors: List[_Selector], minify: bool):
+        super().__init__(convert_charrefs=False)
+        self.selectors = selectors
+        self.minify = minify
+        self.output: List[str] = []
+        self.raw_depth = 0
+        self.pending_space = False
+        self.after_block = True
+        self.line_length = 0
+
+    def handle_starttag(self, tag, attrs):
+        self._tag(tag, self._start_tag(tag, attrs, "<{}>"))
+        if tag in RAW_ELEMENTS:
+            self.raw_depth += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self._tag(tag, self._start_tag(tag, attrs, "<{} />"))
+
+    def handle_endtag(self, tag):
+        if tag in RAW_ELEMENTS and self.raw_depth:
+            self.raw_depth -= 1
+        self._tag(tag, f"</{tag}>")
+
+    def handle_data(self, data):
+        if self.raw_depth or not self.minify:
+            self._text(data)
+            return
+        data = WHITESPACE.sub(' ', data)
+        if data.startswith(' '):
+            self.pending_space = True
+            data = data[1:]
+        trailing = data.endswith(' ')
+        if trailing:
+            data = data[:-1]
+        if data:
+            self._text(data, wrap=True)
+        self.pending_space = self.pending_space or trailing
+
+    def handle_entityref(self, name):
+        self._text(f"&{name};")
+
+    def handle_charref(self, name):
+        self._text(f"&#{name};")
+
+    def handle_comment(self, data):
+        # Conditional comments carry markup for Outlook and must stay
+        if not self.minify or data.startswith('[if') or data.endswith('<![endif]'):
+            self._text(f"<!--{data}-->")
+
+    def handle_decl(self, decl):
+        self._tag('!doctype', f"<!{decl}>")
+
+    def handle_pi(self, data):
+        self._text(f"<?{data}>")
+
+    def unknown_decl(self, data):
+        self._text(f"<![{data}]>")
+
+    def _start_tag(self, tag: str, attrs: List[Tuple[str, Optional[str]]], form: str) -> str:
+        styles = self._matched_styles(tag, attrs)
+        if not styles:
+            return self.get_starttag_text()
+        inline = [(name, value) for name, value in attrs if name == 'style']
+        declarations = dict(styles)
+        for _, value in inline:
+            declarations.update(parse_declarations(value or ""))
+        style = "; ".join(f"{name}: {value}" for name, value in declarations.items())
+        attrs = [(name, value) for name, value in attrs if name != 'style'] + [('style', style)]
+        rendered = "".join(f" {name}" if value is None else f' {name}="{html.escape(value)}"'
+                           for name, value in attrs)
+        return form.format(tag + rendered)
+
+    def _matched_styles(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> List[Tuple[str, str]]:
+        if not self.selectors:
+            return []
+        values = dict(attrs)
+        classes = set((values.get('class') or "").split())
+        matched = [selector for selector in self.selectors
+                   if selector.matches(tag, classes, values.get('id'))]
+        return [declaration for selector in sorted(matched, key=lambda s: s.specificity)
+                for declaration in selector.declarations]
+
+    def _tag(self, tag: str, text: str):
+        is_block = tag in BLOCK_ELEMENTS or tag == '!doctype'
+        space = self.pending_space and not (self.after_block or is_block)
+        self.pending_space = False
+        if self.minify and not self.raw_depth and self.line_length + len(text) >= MAX_LINE_LENGTH:
+            if space or self.after_block or is_block:
+                # Whitespace does not show here, so a line break is as good
+                self._emit("\n")
+                space = False
+            elif self.line_length:
+                # Whitespace is allowed after the tag name, e.g. "<span\nclass=...>"
+                cut = len(tag) + (2 if text.startswith('</') else 1)
+                rest = text[cut:]
+                text = text[:cut] + "\n" + (rest[1:] if rest.startswith(' ') else rest)
+        if space:
+            self._emit(' ')
+        self._emit(text)
+        self.after_block = is_block
+
+    def _text(self, text: str, wrap: bool = False):
+        space = self.pending_space and not self.after_block
+        self.pending_space = False
+        if wrap and self.minify and self.line_length + space + len(text) >= MAX_LINE_LENGTH:
+            words = text.split(' ')
+            text = self._wrap([''] + words if space else words)
+        elif space:
+            self._emit(' ')
+        self._emit(text)
+        self.after_block = False
+
+    def _wrap(self, words: List[str]) -> str:
+        """Join words with spaces, or line breaks where the line would get too long."""
+        pieces = []
+        length = self.line_length
+        for index, word in enumerate(words):
+            if index and length + 1 + len(word) >= MAX_LINE_LENGTH:
+                pieces.append("\n")
+                length = 0
+            elif index:
+                pieces.append(' ')
+                length += 1
+            pieces.append(word)
+            length += len(word)
+        return "".join(pieces)
+
+    def _emit(self, text: str):
+        self.output.append(text)
+        newline = text.rfind("\n")
+        if newline == -1:
+            self.line_length += len(text)
+        else:
+            self.line_length = len(text) - newline - 1
+
+
+def inline_css(body_html: str, minify: bool = False) -> str:
+    """Move <style> rules onto matching elements' style attributes.
+
+    Rules that cannot be inlined stay in a single <style> block where the
+    first one was. With `minify`, comments and insignificant whitespace are
+    removed in the same pass.
+    """
+    rules = []
+    kept = []
+    first_block = None
+
+    def collect(match):
+        nonlocal first_block
+        if 'media' in match.group(1).lower():
+            # Styles for some media only (e.g. print) cannot be inlined
+            return match.group(0)
+        block_rules, block_kept = parse_stylesheet(match.group(2))
+        rules.extend(block_rules)
+        kept.extend(block_kept)
+        if first_block is None:
+            first_block = match.start()
+            return "\x00"
+        return ""
+
+    remaining = STYLE_BLOCK.sub(collect, body_html)
+    if kept:
+        # One rule per line, which also keeps minified lines short
+        kept_css = "\n".join(kept)
+        remaining = remaining.replace("\x00", f"<style>{kept_css}</style>", 1)
+    else:
+        remaining = remaining.replace("\x00", "", 1)
+    selectors = [_Selector(selector, order, declarations)
+                 for order, (selector, declarations) in enumerate(rules)]
+    return _rewrite(remaining, selectors, minify)
+
+
+def minify_html(body_html: str) -> str:
+    """Remove comments and whitespace that does not affect rendering."""
+    return _rewrite(body_html, [], True)
+
+
+def _rewrite(body_html: str, selectors: List[_Selector], minify: bool) -> str:
+    rewriter = _HTMLRewriter(selectors, minify)
+    rewriter.feed(body_html)
+    rewriter.close()
+    return "".join(rewriter.output).strip() if minify else "".join(rewriter.output)
+
+
+class _TextExtractor(HTMLParser):
+    """Collects the readable text of an HTML body, with links and list items spelled out."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.lines: List[str] = []
+        self.line: List[str] = []
+        self.skip_depth = 0
+        self.pre_depth = 0
+        self.links: List[Tuple[Optional[str], int]] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TEXT_ELEMENTS:
+            self.skip_depth += 1
+        elif tag == 'br':
+            self._break()
+        elif tag == 'li':
+            self._break()
+            self.line.append("- ")
+        elif tag in PARAGRAPH_ELEMENTS:
+            self._paragraph()
+        elif tag in BLOCK_ELEMENTS:
+            self._break()
+        if tag == 'pre':
+            self.pre_depth += 1
+        elif tag == 'a':
+            self.links.append((dict(attrs).get('href'), len("".join(self.line))))
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == 'br':
+            self._break()
+        elif tag == 'hr':
+            self._paragraph()
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TEXT_ELEMENTS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag == 'a' and self.links:
+            href, start = self.links.pop()
+            text = "".join(self.line)[start:].strip()
+            if href and not href.startswith('#') and href != text and not href.startswith('mailto:'):
+                self.line.append(f" ({href})")
+        elif tag in PARAGRAPH_ELEMENTS:
+            self._paragraph()
+        elif tag in BLOCK_ELEMENTS:
+            self._break()
+        if tag == 'pre':
+            self.pre_depth = max(0, self.pre_depth - 1)
+
+    def handle_data(self, data):
+        if self.skip_depth:
+            return
+        if self.pre_depth:
+            lines = data.split("\n")
+            self.line.append(lines[0])
+            for line in lines[1:]:
+                self._break()
+                self.line.append(line)
+            return
+        text = WHITESPACE.sub(' ', data)
+        if not "".join(self.line).strip():
+            text = text.lstrip()
+        self.line.append(text)
+
+    def text(self) -> str:
+        self._break()
+        return "\n".join(self.lines).strip()
+
+    def _break(self):
+        line = "".join(self.line).strip() if not self.pre_depth else "".join(self.line).rstrip()
+        self.line = []
+        if line.strip("- ") or line == "-":
+            self.lines.append(line)
+
+    def _paragraph(self):
+        self._break()
+        if self.lines and self.lines[-1] != "":
+            self.lines.append("")
+
+
+def html_to_text(body_html: str) -> str:
+    """A plain-text version of an HTML body for the text/plain part."""
+    extractor = _TextExtractor()
+    extractor.feed(body_html)
+    extractor.close()
+    return extractor.text()
+
+
+def preprocess_template(body_html: str, body_text: str,
+                        settings: Dict = None) -> Tuple[Optional[str], Optional[str]]:
+    """The HTML and text parts to send for a template, None where the source is used as is.
+
+    The text part is generated from the HTML only when the template has none.
+    """
+    options = dict(DEFAULT_PREPROCESS_SETTINGS)
+    options.update(settings or {})
+    if not body_html:
+        return None, None
+
+    processed_html = body_html
+    if options['inline_css']:
+        processed_html = inline_css(processed_html, minify=options['minify_html'])
+    elif options['minify_html']:
+        processed_html = minify_html(processed_html)
+
+    processed_text = None
+    if options['generate_text'] and not (body_text or "").strip():
+        processed_text = html_to_text(body_html) or None
+    return (processed_html if processed_html != body_html else None), processed_text
@@ -0,0 +1,158 @@
+"""
+Message Builder
+Prebuilt MIME skeletons that serialize bulk emails straight to wire bytes.
+"""
+
+import base64
+import re
+import secrets
+from email import quoprimime
+from email.charset import QP, Charset
+from email.header import Header
+from typing import Iterator, List, Optional, Union
+
+CRLF = b"\r\n"
+# A line longer than the 998 characters RFC 5322 allows, which 7bit cannot carry
+LONG_LINE = re.compile(r'[^\r\n]{999}')
+
+
+def encode_header(name: str, value: str) -> bytes:
+    """Encode and fold one header line the way the email package would."""
+    if value.isascii() and value.isprintable() and len(name) + 2 + len(value) <= 78:
+        # Short printable ASCII is left as it is; skip the Header machinery
+        return f"{name}: {value}".encode('ascii') + CRLF
+    charset = 'us-ascii' if value.isascii() else 'utf-8'
+    folded = Header(value, charset, header_name=name).encode(linesep='\r\n')
+    return f"{name}: {folded}".encode('ascii') + CRLF
+
+
+def encode_text_part(subtype: str, body: str) -> bytes:
+    """Serialize a text/* part like MIMEText: 7bit ASCII, otherwise base64 UTF-8.
+
+    ASCII with overlong lines is sent quoted-printable, which wraps them.
+    """
+    if body.isascii() and LONG_LINE.search(body):
+        headers = (f'Content-Type: text/{subtype}; charset="us-ascii"\r\n'
+                   'MIME-Version: 1.0\r\n'
+                   'Content-Transfer-Encoding: quoted-printable\r\n\r\n')
+        payload = quoprimime.body_encode(body, eol='\r\n').encode('ascii')
+    elif body.isascii():
+        headers = (f'Content-Type: text/{subtype}; charset="us-ascii"\r\n'
+                   'MIME-Version: 1.0\r\n'
+                   'Content-Transfer-Encoding: 7bit\r\n\r\n')
+        payload = body.encode('ascii')
+    else:
+        headers = (f'Content-Type: text/{subtype}; charset="utf-8"\r\n'
+                   'MIME-Version: 1.0\r\n'
+                   'Content-Transfer-Encoding: base64\r\n\r\n')
+        payload = base64.encodebytes(body.encode('utf-8')).replace(b"\n", CRLF)
+    return headers.encode('ascii') + payload
+
+
+def text_charset(body: str) -> Optional[Charset]:
+    """The charset to give MIMEText for a body, so it is encoded as encode_text_part does.
+
+    None leaves MIMEText's own choice; ASCII with overlong lines gets quoted-printable.
+    """
+    if body.isascii() and LONG_LINE.search(body):
+        charset = Charset('us-ascii')
+        charset.body_encoding = QP
+        return charset
+    return None
+
+
+class StreamedMessage:
+    """A serialized message with some parts produced lazily while sending.
+
+    Segments are either bytes or objects with iter_chunks() and len(), such as
+    attachments.StreamedAttachment.
+    """
+
+    def __init__(self, segments: List):
+        self.segments = segments
+
+    def __len__(self) -> int:
+        return sum(len(segment) for segment in self.segments)
+
+    def isascii(self) -> bool:
+        return all(segment.isascii() for segment in self.segments if isinstance(segment, bytes))
+
+    def iter_segments(self) -> Iterator[Union[bytes, Iterator[bytes]]]:
+        """Yield bytes segments as-is and streamed segments as chunk iterators."""
+        for segment in self.segments:
+            yield segment if isinstance(segment, bytes) else segment.iter_chunks()
+
+    def as_bytes(self) -> bytes:
+        return b"".join(segment if isinstance(segment, bytes) else b"".join(segment.iter_chunks())
+                        for segment in self.segments)
+
+
+class MessageSkeleton:
+    """The multipart/alternative structure of a bulk email, built once.
+
+    The boundary and the From, Reply-To and MIME headers are serialized up
+    front; render() only encodes To, Subject and the body parts, and splices
+    in attachment parts that were encoded ahead of time.
+    """
+
+    def __init__(self, from_header: str, reply_to: str):
+        self.boundary = "===============" + secrets.token_hex(16) + "=="
+        self._delimiter = b"--" + self.boundary.encode('ascii')
+        self._content_type = (
+            f'Content-Type: multipart/alternative; boundary="{self.boundary}"\r\n'
+            'MIME-Version: 1.0\r\n'
+        ).encode('ascii') + encode_header('From', from_header)
+        self._reply_to = encode_header('Reply-To', reply_to)
+
+    def render(self, to_email: str, subject: str, body_html: str = "",
+               body_text: str = "", attachment_parts: List = None
+               ) -> Optional[Union[bytes, StreamedMessage]]:
+        """Serialize one message, or return None if a body contains the boundary.
+
+        Returns a StreamedMessage when any attachment part is streamed.
+        """
+        body = self.prepare(subject, body_html, body_text, attachment_parts)
+        if body is None:
+            return None
+        return self.address(to_email, body)
+
+    def prepare(self, subject: str, body_html: str = "", body_text: str = "",
+                attachment_parts: List = None) -> Optional[List]:
+        """Serialize everything after the To header, for messages that differ only in To.
+
+        Returns segments for address(), or None if a body contains the boundary.
+        """
+        if self.boundary in (body_text or "") or self.boundary in (body_html or ""):
+            return None
+
+        parts: List = [
+            encode_header('Subject', subject),
+            self._reply_to,
+            CRLF
+        ]
+        if body_text:
+            parts += [self._delimiter, CRLF, encode_text_part('plain', body_text), CRLF]
+        if body_html:
+            parts += [self._delimiter, CRLF, encode_text_part('html', body_html), CRLF]
+        for attachment in attachment_parts or []:
+            parts += [self._delimiter, CRLF, attachment, CRLF]
+        parts += [self._delimiter, b"--", CRLF]
+
+        # Join the fixed bytes between streamed parts into single segments
+        segments: List = []
+        pending: List[bytes] = []
+        for part in parts:
+            if isinstance(part, bytes):
+                pending.append(part)
+            else:
+                segments += [b"".join(pending), part]
+                pending = []
+        segments.append(b"".join(pending))
+        return segments
+
+    def address(self, to_email: str, body: List) -> Union[bytes, StreamedMessage]:
+        """Complete a prepared body with the headers before it."""
+        head = self._content_type + encode_header('To', to_email)
+        if len(body) == 1:
+            return head + body[0]
+        return StreamedMessage([head + body[0]] + body[1:])
@@ -0,0 +1,187 @@
+"""
+Outbox
+Durable retry queue in SQLite for bulk emails that could not be delivered.
+"""
+
+import json
+import random
+import sqlite3
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from connection_manager import ConnectionManager
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+
+def backoff_delay(attempts: int, base_delay: float, max_delay: float) -> float:
+    """Delay before the next try: doubles per attempt, capped, with jitter."""
+    delay = min(max_delay, base_delay * 2 ** max(attempts - 1, 0))
+    # Keep half the delay and randomize the rest so retries do not arrive in lockstep
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def reply_code(error) -> Optional[int]:
+    """The SMTP reply code carried by a refusal tuple or an smtplib/aiosmtplib error."""
+    if isinstance(error, tuple):
+        return error[0]
+    code = getattr(error, 'smtp_code', None)
+    if code is None:
+        code = getattr(error, 'code', None)
+    return code if isinstance(code, int) else None
+
+
+def classify_error(error) -> str:
+    """Classify a send failure as TRANSIENT (worth retrying) or PERMANENT.
+
+    4xx replies, dropped connections and timeouts are transient; 5xx replies
+    and anything else (bad template, missing file) are permanent.
+    """
+    recipients = getattr(error, 'recipients', None)
+    if recipients:
+        # Transient only if every recipient was deferred rather than rejected
+        refusals = recipients.values() if isinstance(recipients, dict) else recipients
+        codes = [reply_code(refusal) for refusal in refusals]
+        return TRANSIENT if all(code and 400 <= code < 500 for code in codes) else PERMANENT
+    code = reply_code(error)
+    if code is not None:
+        return TRANSIENT if 400 <= code < 500 else PERMANENT
+    if isinstance(error, (ConnectionError, TimeoutError)) or type(error).__name__ == 'SMTPServerDisconnected':
+        return TRANSIENT
+    return PERMANENT
+
+
+class Outbox:
+    """Failed recipients waiting for a retry, with exponential backoff and a dead-letter state.
+
+    Rows are renderable rather than rendered: they name the customer and the
+    template, so a retry picks up the customer's current details. Status is
+    'pending' until a retry succeeds ('sent') or the failure is permanent or
+    out of attempts ('dead').
+    """
+
+    def __init__(self, connections: ConnectionManager, max_attempts: int = 5,
+                 base_delay_seconds: float = 60, max_delay_seconds: float = 3600,
+                 lease_seconds: float = 300):
+        self.connections = connections
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.lease_seconds = lease_seconds
+
+    @classmethod
+    def from_config(cls, connections: ConnectionManager, config: Dict) -> "Outbox":
+        settings = config.get('outbox', {})
+        return cls(connections,
+                   settings.get('max_attempts', 5),
+                   settings.get('base_delay_seconds', 60),
+                   settings.get('max_delay_seconds', 3600),
+                   settings.get('lease_seconds', 300))
+
+    def backoff(self, attempts: int) -> float:
+        return backoff_delay(attempts, self.base_delay_seconds, self.max_delay_seconds)
+
+    def enqueue(self, customer: Dict, template_name: str, attachments: Optional[List[str]],
+                error) -> str:
+        """Record a failed send; returns the row's status ('pending' or 'dead').
+
+        A customer already waiting for a retry of the same template is not
+        queued twice.
+        """
+        error_class = classify_error(error)
+        status = 'pending' if error_class == TRANSIENT and self.max_attempts > 1 else 'dead'
+        next_attempt = datetime.now() + timedelta(seconds=self.backoff(1))
+        conn = self.connections.connection()
+        with conn:
+            conn.execute('''
+                INSERT INTO outbox
+                (customer_id, to_email, template_name, attachments, status, attempts,
+                 next_attempt_at, last_error)
+                SELECT ?, ?, ?, ?, ?, 1, ?, ?
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM outbox
+                    WHERE customer_id = ? AND template_name = ? AND status = 'pending'
+                )
+            ''', (customer['id'], customer['email'], template_name,
+                  json.dumps(attachments) if attachments else None, status,
+                  next_attempt.isoformat(), f"{error_class}: {error}",
+                  customer['id'], template_name))
+        return status
+
+    def claim_due(self, limit: int = 100) -> List[Dict]:
+        """Take up to `limit` due rows, leasing them so another worker skips them.
+
+        A worker that dies mid-retry leaves its rows to come due again when
+        the lease runs out.
+        """
+        now = datetime.now()
+        conn = self.connections.connection()
+        with conn:
+            # Take the write lock before reading, so two workers cannot claim the same rows
+            conn.execute("BEGIN IMMEDIATE")
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute('''
+                SELECT * FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT ?
+            ''', (now.isoformat(), limit))
+            rows = [dict(row) for row in cursor.fetchall()]
+            lease_until = (now + timedelta(seconds=self.lease_seconds)).isoformat()
+            conn.executemany("UPDATE outbox SET next_attempt_at = ? WHERE id = ?",
+                             [(lease_until, row['id']) for row in rows])
+        for row in rows:
+            row['attachments'] = json.loads(row['attachments']) if row['attachments'] else None
+        return rows
+
+    def mark_sent(self, entry_id: int):
+        conn = self.connections.connection()
+        with conn:
+            conn.execute('''
+                UPDATE outbox SET status = 'sent', updated_at = CURRENT_TIMESTAMP WHERE id = ?
+            ''', (entry_id,))
+
+    def mark_failed(self, entry: Dict, error) -> str:
+        """Record another failed attempt; returns the new status."""
+        attempts = entry['attempts'] + 1
+        error_class = classify_error(error)
+        if error_class == PERMANENT or attempts >= self.max_attempts:
+            status = 'dead'
+        else:
+            status = 'pending'
+        next_attempt = datetime.now() + timedelta(seconds=self.backoff(attempts))
+        conn = self.connections.connection()
+        with conn:
+            conn.execute('''
+                UPDATE outbox
+                SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (status, attempts, next_attempt.isoformat(), f"{error_class}: {error}", entry['id']))
+        return status
+
+    def requeue_dead(self, template_name: str = None) -> int:
+        """Move dead letters back to pending for a fresh set of attempts."""
+        query = '''
+            UPDATE outbox
+            SET status = 'pending', attempts = 0, next_attempt_at = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'dead'
+        '''
+        params = [datetime.now().isoformat()]
+        if template_name:
+            query += " AND template_name = ?"
+            params.append(template_name)
+        conn = self.connections.connection()
+        with conn:
+            requeued = conn.execute(query, params).rowcount
+        return requeued
+
+    def counts(self) -> Dict[str, int]:
+        """Number of outbox rows per status."""
+        cursor = self.connections.connection().cursor()
+        cursor.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status")
+        counts = {"pending": 0, "sent": 0, "dead": 0}
+        counts.update(dict(cursor.fetchall()))
+        return counts
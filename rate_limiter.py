@@ -0,0 +1,120 @@
+"""
+Rate Limiter
+Token buckets for global, per-SMTP-account and per-recipient-domain send limits.
+"""
+
+import asyncio
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` tokens every `per_seconds`."""
+
+    def __init__(self, rate: float, per_seconds: float = 1.0, burst: Optional[float] = None):
+        if rate <= 0 or per_seconds <= 0:
+            raise ValueError("Token bucket rate and period must be positive")
+        self.fill_rate = rate / per_seconds
+        self.capacity = float(burst if burst else max(1.0, rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens: float = 1.0) -> float:
+        """Take tokens now and return how long the caller must wait for them.
+
+        The balance may go negative, which queues later callers behind this one
+        instead of letting them race for the next refill.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+            self.updated = now
+            self.tokens -= tokens
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.fill_rate
+
+
+class RateLimiter:
+    """Combines global, per-account and per-domain buckets from config."""
+
+    def __init__(self, limits: Dict):
+        self.global_bucket = self._bucket(limits.get('global'))
+        self.account_limits = limits.get('per_account', {})
+        self.domain_limits = limits.get('per_domain', {})
+        self._account_buckets: Dict[str, Optional[TokenBucket]] = {}
+        self._domain_buckets: Dict[str, Optional[TokenBucket]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: Dict, share: float = 1.0) -> "RateLimiter":
+        """Build from the `rate_limits` section, or from delay_between_emails if absent.
+
+        `share` scales every limit, for senders that split one budget between them.
+        """
+        if 'rate_limits' in config:
+            limits = config['rate_limits']
+        else:
+            delay = config.get('email_settings', {}).get('delay_between_emails', 0)
+            limits = {"global": {"rate": 1, "per_seconds": delay, "burst": 1}} if delay else {}
+        if share != 1.0:
+            limits = {
+                "global": cls._scaled(limits.get('global'), share),
+                "per_account": {key: cls._scaled(spec, share)
+                                for key, spec in limits.get('per_account', {}).items()},
+                "per_domain": {key: cls._scaled(spec, share)
+                               for key, spec in limits.get('per_domain', {}).items()}
+            }
+        return cls(limits)
+
+    def reserve(self, account: str = "", recipient: str = "", count: int = 1) -> float:
+        """Take `count` tokens from every applicable bucket; return the wait in seconds."""
+        domain = recipient.rsplit('@', 1)[-1].lower() if '@' in recipient else ""
+        buckets: List[TokenBucket] = []
+        if self.global_bucket:
+            buckets.append(self.global_bucket)
+        account_bucket = self._keyed_bucket(self._account_buckets, self.account_limits, account)
+        if account_bucket:
+            buckets.append(account_bucket)
+        domain_bucket = self._keyed_bucket(self._domain_buckets, self.domain_limits, domain)
+        if domain_bucket:
+            buckets.append(domain_bucket)
+        return max([bucket.reserve(count) for bucket in buckets], default=0.0)
+
+    def acquire(self, account: str = "", recipient: str = "", count: int = 1):
+        """Block until `count` messages to `recipient`'s domain may be sent from `account`."""
+        wait = self.reserve(account, recipient, count)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, account: str = "", recipient: str = "", count: int = 1):
+        """Asyncio counterpart to acquire()."""
+        wait = self.reserve(account, recipient, count)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def _keyed_bucket(self, buckets: Dict[str, Optional[TokenBucket]],
+                      limits: Dict, key: str) -> Optional[TokenBucket]:
+        if not limits:
+            return None
+        with self._lock:
+            if key not in buckets:
+                buckets[key] = self._bucket(limits.get(key, limits.get('default')))
+            return buckets[key]
+
+    @staticmethod
+    def _scaled(spec: Optional[Dict], share: float) -> Optional[Dict]:
+        if not spec:
+            return spec
+        scaled = dict(spec, rate=spec['rate'] * share)
+        if spec.get('burst'):
+            scaled['burst'] = max(1.0, spec['burst'] * share)
+        return scaled
+
+    @staticmethod
+    def _bucket(spec: Optional[Dict]) -> Optional[TokenBucket]:
+        if not spec:
+            return None
+        return TokenBucket(spec['rate'], spec.get('per_seconds', 1), spec.get('burst'))
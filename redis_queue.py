@@ -0,0 +1,227 @@
+"""
+Redis Send Queue
+Distributes a campaign's recipients from one enqueueing node to many sender nodes.
+"""
+
+import json
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import redis
+except ImportError:  # optional dependency, only needed for the distributed queue
+    redis = None
+
+from outbox import TRANSIENT, backoff_delay, classify_error
+
+DEFAULT_QUEUE_SETTINGS = {
+    "url": "redis://localhost:6379/0",
+    "name": "email_queue",
+    "visibility_timeout": 300,
+    "max_in_flight": 1000,
+    "claim_batch": 10,
+    "max_attempts": 5,
+    "base_delay_seconds": 60,
+    "max_delay_seconds": 3600
+}
+
+
+class RedisSendQueue:
+    """At-least-once work queue of (campaign, customer) jobs in Redis.
+
+    Keys, all under the queue name:
+      jobs      hash of job id -> JSON payload
+      ready     sorted set of job id -> time the job becomes visible
+      leases    sorted set of claimed job id -> lease deadline
+      dead      list of job ids that failed permanently
+      sent      list of customer ids sent, drained by the enqueueing node
+      campaigns hash of campaign id -> JSON template content
+
+    A claimed job moves from `ready` to `leases`; it is deleted when acked
+    and made visible again if its lease runs out before that. The lease
+    deadline is returned with the job and acts as its token: ack() and
+    fail() only apply while `leases` still holds that deadline, so a worker
+    whose lease ran out cannot touch a job another worker has reclaimed.
+    Claims, acks and failures are WATCH/MULTI transactions, so the
+    in-flight cap holds across all consumers and no Lua scripting is
+    required.
+    """
+
+    def __init__(self, client, name: str = "email_queue", visibility_timeout: float = 300,
+                 max_in_flight: int = 1000, max_attempts: int = 5,
+                 base_delay_seconds: float = 60, max_delay_seconds: float = 3600):
+        self.client = client
+        self.name = name
+        self.visibility_timeout = visibility_timeout
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.base_delay_seconds = base_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.jobs_key = f"{name}:jobs"
+        self.ready_key = f"{name}:ready"
+        self.leases_key = f"{name}:leases"
+        self.dead_key = f"{name}:dead"
+        self.campaigns_key = f"{name}:campaigns"
+        self.sent_key = f"{name}:sent"
+        self._campaigns: Dict[str, Dict] = {}
+
+    @classmethod
+    def from_config(cls, config: Dict, client=None) -> "RedisSendQueue":
+        """Build from the `redis_queue` section; `client` overrides the configured url."""
+        settings = dict(DEFAULT_QUEUE_SETTINGS)
+        settings.update(config.get('redis_queue', {}))
+        if client is None:
+            if redis is None:
+                raise RuntimeError("The distributed send queue requires redis (pip install redis)")
+            client = redis.Redis.from_url(settings['url'])
+        return cls(client, settings['name'], settings['visibility_timeout'],
+                   settings['max_in_flight'], settings['max_attempts'],
+                   settings['base_delay_seconds'], settings['max_delay_seconds'])
+
+    def enqueue_campaign(self, content: Dict, customers: List[Dict], chunk_size: int = 1000) -> str:
+        """Store the campaign content once and queue one job per customer; returns the campaign id."""
+        campaign_id = uuid.uuid4().hex
+        self.client.hset(self.campaigns_key, campaign_id, json.dumps(content))
+        now = time.time()
+        for start in range(0, len(customers), chunk_size):
+            jobs = {}
+            for customer in customers[start:start + chunk_size]:
+                job_id = uuid.uuid4().hex
+                jobs[job_id] = json.dumps({"campaign": campaign_id, "customer": customer, "attempts": 0})
+            pipe = self.client.pipeline()
+            pipe.hset(self.jobs_key, mapping=jobs)
+            pipe.zadd(self.ready_key, {job_id: now for job_id in jobs})
+            pipe.execute()
+        return campaign_id
+
+    def campaign(self, campaign_id: str) -> Optional[Dict]:
+        """Campaign content, fetched once per consumer."""
+        if campaign_id not in self._campaigns:
+            content = self.client.hget(self.campaigns_key, campaign_id)
+            if content is None:
+                return None
+            self._campaigns[campaign_id] = json.loads(content)
+        return self._campaigns[campaign_id]
+
+    def claim(self, count: int = 1) -> List[Tuple[str, Dict, float]]:
+        """Lease up to `count` visible jobs, fewer if the in-flight cap is reached.
+
+        Returns (job id, job, lease) for each; pass the lease to ack() or fail().
+        Ids whose payload is gone are dropped from the queue instead of leased.
+        """
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.ready_key, self.leases_key, self.jobs_key)
+                    room = self.max_in_flight - pipe.zcard(self.leases_key)
+                    if room <= 0:
+                        pipe.unwatch()
+                        return []
+                    now = time.time()
+                    job_ids = pipe.zrangebyscore(self.ready_key, "-inf", now,
+                                                 start=0, num=min(count, room))
+                    if not job_ids:
+                        pipe.unwatch()
+                        return []
+                    payloads = pipe.hmget(self.jobs_key, job_ids)
+                    claimed = [(job_id, payload) for job_id, payload in zip(job_ids, payloads)
+                               if payload is not None]
+                    lease = now + self.visibility_timeout
+                    pipe.multi()
+                    pipe.zrem(self.ready_key, *job_ids)
+                    if claimed:
+                        pipe.zadd(self.leases_key, {job_id: lease for job_id, _ in claimed})
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    continue
+        return [(self._text(job_id), json.loads(payload), lease) for job_id, payload in claimed]
+
+    def ack(self, job_id: str, job: Dict, lease: float) -> bool:
+        """Delete a job that was sent and report its customer on the sent list.
+
+        Returns False if the lease was lost and the job left alone.
+        """
+        def complete(pipe):
+            pipe.hdel(self.jobs_key, job_id)
+            pipe.rpush(self.sent_key, job['customer']['id'])
+
+        return self._release(job_id, lease, complete)
+
+    def fail(self, job_id: str, job: Dict, error, lease: float) -> str:
+        """Reschedule a failed job with backoff, or dead-letter it.
+
+        Returns 'pending' or 'dead', or 'lost' if the lease ran out and the
+        job was left to whoever holds it now.
+        """
+        job = dict(job, attempts=job['attempts'] + 1, last_error=str(error))
+        retry = classify_error(error) == TRANSIENT and job['attempts'] < self.max_attempts
+
+        def reschedule(pipe):
+            pipe.hset(self.jobs_key, job_id, json.dumps(job))
+            if retry:
+                delay = backoff_delay(job['attempts'], self.base_delay_seconds, self.max_delay_seconds)
+                pipe.zadd(self.ready_key, {job_id: time.time() + delay})
+            else:
+                pipe.rpush(self.dead_key, job_id)
+
+        if not self._release(job_id, lease, reschedule):
+            return 'lost'
+        return 'pending' if retry else 'dead'
+
+    def _release(self, job_id: str, lease: float, update) -> bool:
+        """End a lease and run update(pipe) in the same transaction, if the lease is still ours."""
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.leases_key)
+                    if pipe.zscore(self.leases_key, job_id) != lease:
+                        pipe.unwatch()
+                        return False
+                    pipe.multi()
+                    pipe.zrem(self.leases_key, job_id)
+                    update(pipe)
+                    pipe.execute()
+                    return True
+                except redis.WatchError:
+                    continue
+
+    def reclaim_expired(self) -> int:
+        """Make jobs whose lease ran out visible again; returns how many."""
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(self.leases_key)
+                    now = time.time()
+                    expired = pipe.zrangebyscore(self.leases_key, "-inf", now)
+                    if not expired:
+                        pipe.unwatch()
+                        return 0
+                    pipe.multi()
+                    pipe.zrem(self.leases_key, *expired)
+                    pipe.zadd(self.ready_key, {job_id: now for job_id in expired})
+                    pipe.execute()
+                    return len(expired)
+                except redis.WatchError:
+                    continue
+
+    def drain_sent(self, count: int = 1000) -> List[int]:
+        """Take up to `count` customer ids off the sent list."""
+        pipe = self.client.pipeline()
+        pipe.lrange(self.sent_key, 0, count - 1)
+        pipe.ltrim(self.sent_key, count, -1)
+        sent, _ = pipe.execute()
+        return [int(customer_id) for customer_id in sent]
+
+    def stats(self) -> Dict[str, int]:
+        pipe = self.client.pipeline()
+        pipe.zcard(self.ready_key)
+        pipe.zcard(self.leases_key)
+        pipe.llen(self.dead_key)
+        ready, in_flight, dead = pipe.execute()
+        return {"pending": ready, "in_flight": in_flight, "dead": dead}
+
+    @staticmethod
+    def _text(value) -> str:
+        return value.decode() if isinstance(value, bytes) else value
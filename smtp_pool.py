@@ -0,0 +1,370 @@
+"""
+SMTP Session Pool
+Keeps authenticated SMTP connections open and reuses them across messages.
+"""
+
+import copy
+import io
+import re
+import smtplib
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from email.generator import BytesGenerator
+from email.utils import getaddresses
+from typing import Dict, List, Optional, Tuple
+
+from message_builder import StreamedMessage
+
+# SMTP reply codes that mean the server is closing the transmission channel
+RECONNECT_CODES = (421,)
+
+DEFAULT_POOL_SETTINGS = {
+    "max_sessions": 4,
+    "max_messages_per_session": 100,
+    "max_idle_seconds": 60,
+    "noop_after_idle_seconds": 5,
+    "timeout": 30
+}
+
+CRLF = b"\r\n"
+BARE_EOL = re.compile(rb'(?:\r\n|\n|\r(?!\n))')
+LEADING_DOT = re.compile(rb'(?m)^\.')
+
+
+def quote_lines(data: bytes) -> bytes:
+    """Normalize line endings and dot-stuff lines; data must start at a line start."""
+    return LEADING_DOT.sub(b'..', BARE_EOL.sub(CRLF, data))
+
+
+def quote_data(data: bytes) -> bytes:
+    """Normalize line endings and dot-stuff a message for the DATA command."""
+    data = quote_lines(data)
+    if not data.endswith(CRLF):
+        data += CRLF
+    return data
+
+
+def flatten_message(msg, from_addr: Optional[str] = None,
+                    to_addrs: Optional[List[str]] = None) -> Tuple[str, List[str], bytes]:
+    """Work out the envelope and wire bytes for a message, as smtplib.send_message does."""
+    if from_addr is None:
+        from_addr = getaddresses([msg['Sender'] or msg['From']])[0][1]
+    if to_addrs is None:
+        headers = msg.get_all('To', []) + msg.get_all('Cc', []) + msg.get_all('Bcc', [])
+        to_addrs = [address for _, address in getaddresses(headers)]
+    msg_copy = copy.copy(msg)
+    del msg_copy['Bcc']
+    del msg_copy['Resent-Bcc']
+    with io.BytesIO() as buffer:
+        BytesGenerator(buffer).flatten(msg_copy, linesep='\r\n')
+        return from_addr, to_addrs, buffer.getvalue()
+
+
+class SMTPSession:
+    """A single authenticated SMTP connection owned by the pool."""
+
+    def __init__(self, smtp_config: Dict, timeout: float = 30):
+        self.smtp_config = smtp_config
+        self.timeout = timeout
+        self.pipelining = smtp_config.get('pipelining', True)
+        self.server: Optional[smtplib.SMTP] = None
+        self.message_count = 0
+        self.last_used = 0.0
+        self.needs_reset = False
+        # 421 when the last send only went through after reconnecting
+        self.deferral: Optional[int] = None
+
+    @property
+    def connected(self) -> bool:
+        return self.server is not None
+
+    def connect(self):
+        """Open the connection, upgrade to TLS and log in."""
+        server = smtplib.SMTP(self.smtp_config['server'], self.smtp_config['port'],
+                              timeout=self.timeout)
+        try:
+            if self.smtp_config.get('use_tls'):
+                server.starttls()
+            if self.smtp_config.get('username'):
+                server.login(self.smtp_config['username'], self.smtp_config['password'])
+        except Exception:
+            server.close()
+            raise
+        self.server = server
+        self.message_count = 0
+        self.needs_reset = False
+        self.last_used = time.monotonic()
+
+    def close(self):
+        """Close the connection, politely if the server is still there."""
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except Exception:
+            self.server.close()
+        self.server = None
+
+    def reconnect(self):
+        self.close()
+        self.connect()
+
+    def is_healthy(self) -> bool:
+        """Health-check the connection with RSET (after a failure) or NOOP."""
+        try:
+            if self.needs_reset:
+                code, _ = self.server.rset()
+                self.needs_reset = False
+            else:
+                code, _ = self.server.noop()
+            return code == 250
+        except Exception:
+            return False
+
+    def send_message(self, msg, from_addr: Optional[str] = None,
+                     to_addrs: Optional[List[str]] = None) -> Dict:
+        """Send a message, reconnecting once on 421 or a dropped connection.
+
+        `msg` is an email.message.Message, or already-serialized bytes together
+        with an explicit envelope. Returns the refused recipients, like sendmail.
+        A send that only went through after reconnecting sets `deferral`, so
+        callers can still slow down when the server asked them to.
+        """
+        self.deferral = None
+        if self.server is None:
+            self.connect()
+        try:
+            refused = self._send(msg, from_addr, to_addrs)
+        except smtplib.SMTPServerDisconnected:
+            self.reconnect()
+            self.deferral = 421
+            refused = self._send(msg, from_addr, to_addrs)
+        except smtplib.SMTPResponseException as e:
+            if e.smtp_code not in RECONNECT_CODES:
+                self.needs_reset = True
+                raise
+            self.reconnect()
+            self.deferral = e.smtp_code
+            refused = self._send(msg, from_addr, to_addrs)
+        except smtplib.SMTPException:
+            self.needs_reset = True
+            raise
+        except OSError:
+            # Socket-level failure: the connection state is unknown, drop it
+            self.close()
+            raise
+        self.message_count += 1
+        self.last_used = time.monotonic()
+        return refused
+
+    def _send(self, msg, from_addr: Optional[str], to_addrs: Optional[List[str]]) -> Dict:
+        pipelined = self.pipelining and self.server.has_extn('pipelining')
+        if isinstance(msg, StreamedMessage) or pipelined:
+            if not isinstance(msg, (bytes, StreamedMessage)):
+                from_addr, to_addrs, msg = flatten_message(msg, from_addr, to_addrs)
+            if msg.isascii() or self.server.has_extn('8bitmime'):
+                return self._send_transaction(from_addr, to_addrs, msg, pipelined)
+            if isinstance(msg, StreamedMessage):
+                msg = msg.as_bytes()
+        if isinstance(msg, bytes):
+            return self.server.sendmail(from_addr, to_addrs, msg)
+        return self.server.send_message(msg, from_addr, to_addrs)
+
+    def _send_transaction(self, from_addr: str, to_addrs: List[str], data,
+                          pipelined: bool = True) -> Dict:
+        """Run a MAIL FROM / RCPT TO / DATA transaction for bytes or a StreamedMessage.
+
+        When pipelined (RFC 2920), all envelope commands and DATA go out in one
+        round trip. Raises the same exceptions as smtplib.SMTP.sendmail and
+        returns the recipients refused by the server.
+        """
+        server = self.server
+        server.ehlo_or_helo_if_needed()
+        options = ""
+        if server.has_extn('size'):
+            options += f" SIZE={len(data)}"
+        if not data.isascii():
+            options += " BODY=8BITMIME"
+        mail_command = f"MAIL FROM:{smtplib.quoteaddr(from_addr)}{options}\r\n"
+        rcpt_commands = [f"RCPT TO:{smtplib.quoteaddr(address)}\r\n" for address in to_addrs]
+
+        if pipelined:
+            server.send(mail_command + "".join(rcpt_commands) + "DATA\r\n")
+            # Replies arrive in command order; read all of them before acting
+            mail_reply = server.getreply()
+            rcpt_replies = [server.getreply() for _ in to_addrs]
+            data_code, data_response = server.getreply()
+        else:
+            # Stop at the first step that makes the rest pointless, as sendmail does
+            rcpt_replies = []
+            data_code, data_response = 0, b""
+            server.send(mail_command)
+            mail_reply = server.getreply()
+            if mail_reply[0] == 250:
+                for command in rcpt_commands:
+                    server.send(command)
+                    rcpt_replies.append(server.getreply())
+                if any(code in (250, 251) for code, _ in rcpt_replies):
+                    server.send("DATA\r\n")
+                    data_code, data_response = server.getreply()
+
+        refused = {address: reply for address, reply in zip(to_addrs, rcpt_replies)
+                   if reply[0] not in (250, 251)}
+        failed = mail_reply[0] != 250 or len(refused) == len(to_addrs)
+        if data_code == 354 and failed:
+            # The server took DATA anyway; end it empty so the session stays usable
+            server.send(b".\r\n")
+            server.getreply()
+        if mail_reply[0] != 250:
+            self._abort_transaction(mail_reply[0])
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        if len(refused) == len(to_addrs):
+            self._abort_transaction(*(code for code, _ in refused.values()))
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_code != 354:
+            self._abort_transaction(data_code)
+            raise smtplib.SMTPDataError(data_code, data_response)
+
+        if isinstance(data, StreamedMessage):
+            self._send_streamed(data)
+        else:
+            server.send(quote_data(data) + b".\r\n")
+        code, response = server.getreply()
+        if code != 250:
+            self._abort_transaction(code)
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+    def _send_streamed(self, data: StreamedMessage):
+        """Write message data chunk by chunk, ending with the DATA terminator.
+
+        Bytes segments are dot-stuffed; streamed segments are base64 lines,
+        which never need it. The terminator goes out with the last chunk, as
+        a separate small write would wait on a delayed ACK.
+        """
+        last = b""
+        for segment in data.iter_segments():
+            for chunk in ([quote_lines(segment)] if isinstance(segment, bytes) else segment):
+                if last:
+                    self.server.send(last)
+                last = chunk
+        self.server.send(last + b".\r\n")
+
+    def _abort_transaction(self, *codes: int):
+        """Reset a failed transaction, or close if the server is shutting down."""
+        if any(code in RECONNECT_CODES for code in codes):
+            self.server.close()
+        else:
+            try:
+                self.server.rset()
+            except smtplib.SMTPServerDisconnected:
+                pass
+
+
+class SMTPSessionPool:
+    """Thread-safe pool of reusable SMTP sessions."""
+
+    def __init__(self, smtp_config: Dict, logger: Optional[logging.Logger] = None):
+        self.smtp_config = smtp_config
+        settings = dict(DEFAULT_POOL_SETTINGS)
+        settings.update(smtp_config.get('pool', {}))
+        self.max_sessions = max(1, int(settings['max_sessions']))
+        self.max_messages_per_session = int(settings['max_messages_per_session'])
+        self.max_idle_seconds = float(settings['max_idle_seconds'])
+        self.noop_after_idle_seconds = float(settings['noop_after_idle_seconds'])
+        self.timeout = float(settings['timeout'])
+        self.logger = logger or logging.getLogger(__name__)
+
+        self._idle: List[SMTPSession] = []
+        self._open_count = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def acquire(self) -> SMTPSession:
+        """Take a ready-to-use session, opening one if the pool has room."""
+        with self._condition:
+            while True:
+                if self._idle:
+                    session = self._idle.pop()
+                    break
+                if self._open_count < self.max_sessions:
+                    self._open_count += 1
+                    session = None
+                    break
+                self._condition.wait()
+            self._closed = False
+
+        try:
+            if session is None:
+                session = SMTPSession(self.smtp_config, self.timeout)
+                session.connect()
+                self.logger.debug("Opened new SMTP session")
+            else:
+                self._prepare(session)
+        except Exception:
+            with self._condition:
+                self._open_count -= 1
+                self._condition.notify()
+            raise
+        return session
+
+    def release(self, session: SMTPSession, discard: bool = False):
+        """Return a session to the pool, closing it if it is spent or broken."""
+        if (discard or self._closed or not session.connected
+                or session.message_count >= self.max_messages_per_session):
+            session.close()
+            with self._condition:
+                self._open_count -= 1
+                self._condition.notify()
+            return
+        # A deferral is only reported to the holder that saw it
+        session.deferral = None
+        with self._condition:
+            self._idle.append(session)
+            self._condition.notify()
+
+    def renew(self, session: SMTPSession) -> SMTPSession:
+        """Keep using a held session, or swap it for a fresh one when it is due.
+
+        For workers that hold one session across many sends: a session that
+        is spent, broken or has been idle goes back through release() and
+        acquire(), so the per-session message limit, idle recycling and the
+        health check apply to it as they do to pooled sends.
+        """
+        if (session.connected and not session.needs_reset
+                and session.message_count < self.max_messages_per_session
+                and time.monotonic() - session.last_used <= self.noop_after_idle_seconds):
+            return session
+        self.release(session)
+        return self.acquire()
+
+    @contextmanager
+    def session(self):
+        """Context manager wrapping acquire()/release()."""
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def close_all(self):
+        """Close every idle session; sessions in use are closed on release."""
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._open_count -= len(idle)
+            self._closed = True
+            self._condition.notify_all()
+        for session in idle:
+            session.close()
+
+    def _prepare(self, session: SMTPSession):
+        """Recycle or health-check an idle session before handing it out."""
+        idle_for = time.monotonic() - session.last_used
+        if not session.connected or idle_for > self.max_idle_seconds:
+            session.reconnect()
+        elif (session.needs_reset or idle_for > self.noop_after_idle_seconds) \
+                and not session.is_healthy():
+            self.logger.debug("SMTP session failed health check, reconnecting")
+            session.reconnect()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Local SMTP Sink
+A throwaway ESMTP server that accepts and discards mail, for offline benchmarks.
+"""
+
+import argparse
+import asyncio
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class SinkStats:
+    """Counters updated by the sink as it handles mail."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.deferred = 0
+        self.rejected = 0
+        self.disconnects = 0
+
+    def snapshot(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "connections": self.connections,
+                "messages": self.messages,
+                "recipients": self.recipients,
+                "bytes": self.bytes,
+                "deferred": self.deferred,
+                "rejected": self.rejected,
+                "disconnects": self.disconnects
+            }
+
+
+class SinkProtocol(asyncio.Protocol):
+    """One SMTP conversation. Replies to everything received in one read are
+    sent together after the configured latency, so pipelined commands cost a
+    single simulated round trip."""
+
+    def __init__(self, sink: "SMTPSink"):
+        self.sink = sink
+        self.transport = None
+        self.buffer = b""
+        self.state = "command"
+        self.recipients: List[str] = []
+        self.data_size = 0
+        self.closing = False
+        self.replies: asyncio.Queue = asyncio.Queue()
+        self.writer_task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        with self.sink.stats.lock:
+            self.sink.stats.connections += 1
+        self.sink.protocols.add(self)
+        self.writer_task = asyncio.get_running_loop().create_task(self._write_replies())
+        self._queue([b"220 localhost SMTP sink ready"])
+
+    def connection_lost(self, exc):
+        self.sink.protocols.discard(self)
+        self.writer_task.cancel()
+
+    def data_received(self, data: bytes):
+        self.buffer += data
+        replies: List[bytes] = []
+        while not self.closing:
+            line_end = self.buffer.find(b"\n")
+            if line_end < 0:
+                break
+            line, self.buffer = self.buffer[:line_end + 1], self.buffer[line_end + 1:]
+            if self.state == "data":
+                self._data_line(line, replies)
+            else:
+                self._command(line.decode("utf-8", "replace").strip(), replies)
+        if replies:
+            self._queue(replies)
+
+    def _queue(self, replies: List[bytes]):
+        due = time.monotonic() + self.sink.latency
+        self.replies.put_nowait((due, b"".join(reply + b"\r\n" for reply in replies), self.closing))
+
+    async def _write_replies(self):
+        while True:
+            due, payload, close = await self.replies.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.transport.write(payload)
+            if close:
+                self.transport.close()
+                return
+
+    def _command(self, command: str, replies: List[bytes]):
+        sink = self.sink
+        verb = command[:4].upper()
+        if self.state == "auth":
+            self.state = "command"
+            replies.append(b"235 2.7.0 Authentication successful")
+        elif self.state.startswith("auth-login"):
+            if self.state == "auth-login-user":
+                self.state = "auth-login-password"
+                replies.append(b"334 UGFzc3dvcmQ6")
+            else:
+                self.state = "command"
+                replies.append(b"235 2.7.0 Authentication successful")
+        elif verb in ("EHLO", "HELO"):
+            replies.append(b"250-localhost\r\n250-PIPELINING\r\n250-8BITMIME\r\n"
+                           b"250-SIZE 104857600\r\n250 AUTH PLAIN LOGIN")
+        elif verb == "AUTH":
+            parts = command.split()
+            if len(parts) == 2 and parts[1].upper() == "LOGIN":
+                self.state = "auth-login-user"
+                replies.append(b"334 VXNlcm5hbWU6")
+            elif len(parts) == 2:
+                self.state = "auth"
+                replies.append(b"334 ")
+            else:
+                replies.append(b"235 2.7.0 Authentication successful")
+        elif verb == "MAIL":
+            self.recipients = []
+            replies.append(b"250 2.1.0 OK")
+        elif verb == "RCPT":
+            roll = sink.random.random()
+            if roll < sink.reject_rate:
+                with sink.stats.lock:
+                    sink.stats.rejected += 1
+                replies.append(b"550 5.1.1 Mailbox unavailable")
+            elif roll < sink.reject_rate + sink.error_rate:
+                with sink.stats.lock:
+                    sink.stats.deferred += 1
+                replies.append(b"451 4.3.0 Try again later")
+            else:
+                self.recipients.append(command[8:].strip())
+                replies.append(b"250 2.1.5 OK")
+        elif verb == "DATA":
+            if not self.recipients:
+                replies.append(b"554 5.5.1 No valid recipients")
+            else:
+                self.state = "data"
+                self.data_size = 0
+                replies.append(b"354 End data with <CR><LF>.<CR><LF>")
+        elif verb == "RSET":
+            self.recipients = []
+            replies.append(b"250 2.0.0 OK")
+        elif verb == "NOOP":
+            replies.append(b"250 2.0.0 OK")
+        elif verb == "QUIT":
+            self.closing = True
+            replies.append(b"221 2.0.0 Bye")
+        else:
+            replies.append(b"502 5.5.2 Command not recognized")
+
+    def _data_line(self, line: bytes, replies: List[bytes]):
+        sink = self.sink
+        if line != b".\r\n":
+            self.data_size += len(line)
+            return
+        self.state = "command"
+        if sink.random.random() < sink.disconnect_rate:
+            with sink.stats.lock:
+                sink.stats.disconnects += 1
+            self.closing = True
+            replies.append(b"421 4.3.2 Closing connection")
+            return
+        with sink.stats.lock:
+            sink.stats.messages += 1
+            sink.stats.recipients += len(self.recipients)
+            sink.stats.bytes += self.data_size
+        self.recipients = []
+        replies.append(b"250 2.0.0 Queued")
+
+
+class SMTPSink:
+    """Minimal ESMTP server (PIPELINING, AUTH, 8BITMIME, SIZE) that discards mail.
+
+    latency: seconds added to every server response round trip.
+    error_rate: probability of a transient 451 reply to RCPT TO.
+    reject_rate: probability of a permanent 550 reply to RCPT TO.
+    disconnect_rate: probability of a 421 reply and dropped connection per message.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0,
+                 error_rate: float = 0.0, reject_rate: float = 0.0,
+                 disconnect_rate: float = 0.0, seed: Optional[int] = None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        self.stats = SinkStats()
+        # Open conversations, closed by stop_async()
+        self.protocols = set()
+        self._server = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    async def start_async(self):
+        """Start listening on the running event loop."""
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(lambda: SinkProtocol(self), self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop_async(self):
+        """Stop listening, drop open connections and wait for their reply writers to end."""
+        self._server.close()
+        protocols = list(self.protocols)
+        for protocol in protocols:
+            protocol.transport.abort()
+        writers = [protocol.writer_task for protocol in protocols]
+        for writer in writers:
+            writer.cancel()
+        await asyncio.gather(*writers, return_exceptions=True)
+        await self._server.wait_closed()
+
+    def start(self) -> "SMTPSink":
+        """Run the sink on a background thread; returns once it is listening."""
+        ready = threading.Event()
+
+        def run():
+            loop = self._loop = asyncio.new_event_loop()
+            loop.run_until_complete(self.start_async())
+            ready.set()
+            loop.run_forever()
+            loop.close()
+
+        self._thread = threading.Thread(target=run, name="smtp-sink", daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        """Stop a sink started with start()."""
+        if self._loop is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self.stop_async(), self._loop).result(timeout=5)
+        finally:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._loop = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local SMTP sink that discards mail")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8025, help="0 picks a free port")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per round trip")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of RCPTs deferred (451)")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="share of RCPTs rejected (550)")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0,
+                        help="share of messages answered with 421 and a disconnect")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.host, args.port, args.latency, args.error_rate,
+                    args.reject_rate, args.disconnect_rate, args.seed)
+
+    async def serve():
+        await sink.start_async()
+        print(f"SMTP sink listening on {sink.host}:{sink.port}", flush=True)
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await sink.stop_async()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print(f"\nSMTP sink stopped: {sink.stats.snapshot()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Message Spool
+Rendered messages on disk, so rendering and delivery can run as separate phases.
+"""
+
+import json
+import mmap
+import os
+import threading
+from typing import Dict, Iterator, List, Set, Union
+
+from message_builder import StreamedMessage
+from smtp_pool import quote_data, quote_lines
+
+MANIFEST = "manifest.json"
+
+# Spooled messages are read back in chunks of this size while sending
+CHUNK_BYTES = 1024 * 1024
+
+
+class SpoolWriter:
+    """Appends messages to segment files, with a JSON-lines index per segment.
+
+    Messages are stored exactly as they go after DATA (CRLF line endings,
+    dot-stuffed), so delivery only copies bytes. A new segment is started
+    once the current one reaches max_segment_bytes.
+    """
+
+    def __init__(self, spool_path: str, prefix: str, max_segment_bytes: int = 256 * 1024 * 1024):
+        self.spool_path = spool_path
+        self.prefix = prefix
+        self.max_segment_bytes = max_segment_bytes
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self._sequence = -1
+        self._data = None
+        self._index = None
+        self._offset = 0
+        self._open_segment()
+
+    def write(self, data: Union[bytes, StreamedMessage], customer_ids: List[int],
+              recipients: List[str]):
+        """Store one serialized message for the given envelope recipients."""
+        if self._offset >= self.max_segment_bytes:
+            self._open_segment()
+        start = self._offset
+        if isinstance(data, StreamedMessage):
+            # Write streamed attachment parts without holding the whole message
+            for segment in data.iter_segments():
+                if isinstance(segment, bytes):
+                    self._write(quote_lines(segment))
+                else:
+                    for chunk in segment:
+                        self._write(chunk)
+        else:
+            self._write(quote_data(data))
+        self._index.write(json.dumps({
+            "offset": start,
+            "length": self._offset - start,
+            "ids": customer_ids,
+            "rcpt": recipients
+        }) + "\n")
+        self.messages += 1
+        self.recipients += len(recipients)
+
+    def close(self):
+        if self._data is not None:
+            self._data.close()
+            self._index.close()
+            self._data = self._index = None
+
+    def _write(self, chunk: bytes):
+        self._data.write(chunk)
+        self._offset += len(chunk)
+        self.bytes += len(chunk)
+
+    def _open_segment(self):
+        self.close()
+        self._sequence += 1
+        name = f"{self.prefix}-{self._sequence:04d}"
+        self._data = open(os.path.join(self.spool_path, name + ".eml"), "wb")
+        self._index = open(os.path.join(self.spool_path, name + ".idx"), "w")
+        self._offset = 0
+
+
+class SpoolSlice:
+    """One spooled message, streamed from a memory-mapped segment."""
+
+    def __init__(self, mapped: mmap.mmap, offset: int, length: int):
+        self.mapped = mapped
+        self.offset = offset
+        self.length = length
+
+    def __len__(self) -> int:
+        return self.length
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        end = self.offset + self.length
+        for position in range(self.offset, end, CHUNK_BYTES):
+            yield self.mapped[position:min(position + CHUNK_BYTES, end)]
+
+
+class SpoolReader:
+    """Reads a finished spool and records which entries have been delivered.
+
+    Each segment has a `.delivered` log of entry numbers, appended as
+    messages are sent, so delivery can stop and restart, or be split
+    across machines by segment.
+    """
+
+    def __init__(self, spool_path: str):
+        self.spool_path = spool_path
+        manifest_file = os.path.join(spool_path, MANIFEST)
+        if not os.path.exists(manifest_file):
+            raise ValueError(f"Spool '{spool_path}' is incomplete (no {MANIFEST})")
+        with open(manifest_file, "r") as f:
+            self.manifest = json.load(f)
+        self._maps: Dict[str, mmap.mmap] = {}
+        self._logs: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def segments(self) -> List[str]:
+        return sorted(name[:-4] for name in os.listdir(self.spool_path) if name.endswith(".idx"))
+
+    def entries(self, segment: str) -> List[Dict]:
+        with open(os.path.join(self.spool_path, segment + ".idx"), "r") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def delivered(self, segment: str) -> Set[int]:
+        log_file = os.path.join(self.spool_path, segment + ".delivered")
+        if not os.path.exists(log_file):
+            return set()
+        with open(log_file, "r") as f:
+            return {int(line.split("\t", 1)[0]) for line in f if line.strip()}
+
+    def message(self, segment: str, entry: Dict) -> StreamedMessage:
+        """The stored DATA bytes of an index entry, ready for SMTPSession.send_message."""
+        with self._lock:
+            mapped = self._maps.get(segment)
+            if mapped is None:
+                with open(os.path.join(self.spool_path, segment + ".eml"), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[segment] = mapped
+        return StreamedMessage([SpoolSlice(mapped, entry['offset'], entry['length'])])
+
+    def mark_delivered(self, segment: str, number: int, sent: int):
+        """Log an entry as handled; `sent` is how many of its recipients were accepted."""
+        with self._lock:
+            log = self._logs.get(segment)
+            if log is None:
+                log = open(os.path.join(self.spool_path, segment + ".delivered"), "a")
+                self._logs[segment] = log
+            log.write(f"{number}\t{sent}\n")
+            log.flush()
+
+    def close(self):
+        with self._lock:
+            for mapped in self._maps.values():
+                mapped.close()
+            for log in self._logs.values():
+                log.close()
+            self._maps.clear()
+            self._logs.clear()
+
+
+def write_manifest(spool_path: str, manifest: Dict):
+    """Write the manifest last and atomically; a spool without one is not deliverable."""
+    temporary = os.path.join(spool_path, MANIFEST + ".tmp")
+    with open(temporary, "w") as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(temporary, os.path.join(spool_path, MANIFEST))
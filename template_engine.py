@@ -0,0 +1,233 @@
+"""
+Template Engine
+Compiles {{placeholder}} templates once into literal segments and field slots,
+and optionally renders Jinja2 templates in a sandbox.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import jinja2
+    from jinja2 import meta
+    from jinja2.sandbox import SandboxedEnvironment
+    from markupsafe import escape
+except ImportError:  # optional dependency, only needed for jinja2 templates
+    jinja2 = None
+
+# Placeholders filled from customer data
+PLACEHOLDER_FIELDS = ('first_name', 'last_name', 'email', 'company', 'phone', 'full_name')
+PLACEHOLDER_PATTERN = re.compile(r'\{\{(\w+)\}\}')
+
+ENGINES = ('placeholder', 'jinja2')
+
+# A Jinja2 template that is nothing but text and {{ field }} expressions
+JINJA_FIELD_PATTERN = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+JINJA_MARKUP = ('{{', '{%', '{#')
+
+# Characters that HTML escaping changes; most values contain none
+HTML_SPECIAL = re.compile(r'[&<>"\']')
+
+
+class TemplateError(ValueError):
+    """A template uses placeholders that cannot be filled."""
+
+
+def placeholder_values(customer: Dict) -> Dict[str, str]:
+    """The value of every placeholder for one customer; missing or NULL fields render empty."""
+    first_name = customer.get('first_name') or ''
+    last_name = customer.get('last_name') or ''
+    return {
+        'first_name': first_name,
+        'last_name': last_name,
+        'email': customer.get('email') or '',
+        'company': customer.get('company') or '',
+        'phone': customer.get('phone') or '',
+        'full_name': f"{first_name} {last_name}".strip()
+    }
+
+
+class CompiledTemplate:
+    """A template split into literal text and the placeholder slots between it.
+
+    Rendering fills the slots and joins the parts once, instead of copying
+    the whole text for every placeholder. Unknown placeholders are kept as
+    literal text, as they always have been, and listed in `unknown`. With
+    `escape`, values are HTML-escaped as Jinja2's autoescaping would.
+    """
+
+    __slots__ = ('source', 'escape', 'fields', 'unknown', '_parts', '_slots')
+
+    def __init__(self, source: str, escape: bool = False):
+        self.source = source
+        self.escape = escape
+        parts: List[str] = []
+        slots: List[Tuple[int, str]] = []
+        unknown: List[str] = []
+        literal = ""
+        # split() alternates literal text and placeholder names
+        for index, piece in enumerate(PLACEHOLDER_PATTERN.split(source)):
+            if index % 2 == 0:
+                literal += piece
+            elif piece in PLACEHOLDER_FIELDS:
+                if literal:
+                    parts.append(literal)
+                    literal = ""
+                slots.append((len(parts), piece))
+                parts.append("")
+            else:
+                if piece not in unknown:
+                    unknown.append(piece)
+                literal += "{{" + piece + "}}"
+        if literal or not parts:
+            parts.append(literal)
+        self._parts = parts
+        self._slots = slots
+        self.fields = tuple(dict.fromkeys(name for _, name in slots))
+        self.unknown = tuple(unknown)
+
+    def render(self, values: Dict[str, str]) -> str:
+        """Fill the slots from placeholder_values()."""
+        if not self._slots:
+            return self.source
+        parts = self._parts[:]
+        if self.escape:
+            for index, name in self._slots:
+                value = values[name]
+                parts[index] = str(escape(value)) if HTML_SPECIAL.search(value) else value
+        else:
+            for index, name in self._slots:
+                parts[index] = values[name]
+        return "".join(parts)
+
+
+@lru_cache(maxsize=512)
+def compile_template(source: str, escape: bool = False) -> CompiledTemplate:
+    """Compile a template, reusing the result for the same text."""
+    return CompiledTemplate(source, escape)
+
+
+class _SourceLoader(jinja2.BaseLoader if jinja2 else object):
+    """Serves template sources registered under the hash of their text.
+
+    A source is only registered while its template is being loaded.
+    """
+
+    def __init__(self):
+        self.sources: Dict[str, str] = {}
+
+    def get_source(self, environment, name: str):
+        if name not in self.sources:
+            raise jinja2.TemplateNotFound(name)
+        # Names are content hashes, so a loaded template never goes stale
+        return self.sources[name], None, lambda: True
+
+
+class JinjaTemplate:
+    """A compiled Jinja2 template with the CompiledTemplate interface."""
+
+    def __init__(self, environment, template, source: str):
+        self._environment = environment
+        self._template = template
+        self._fields: Optional[Tuple[str, ...]] = None
+        self.source = source
+
+    @property
+    def fields(self) -> Tuple[str, ...]:
+        """Placeholder fields the template reads (parsed on first use)."""
+        if self._fields is None:
+            names = meta.find_undeclared_variables(self._environment.parse(self.source))
+            self._fields = tuple(name for name in PLACEHOLDER_FIELDS if name in names)
+        return self._fields
+
+    def render(self, values: Dict[str, str]) -> str:
+        return self._template.render(values)
+
+
+class JinjaEngine:
+    """Sandboxed Jinja2 environments for templates stored with engine 'jinja2'.
+
+    The 512 most recently used templates stay compiled in the process;
+    with a bytecode cache directory, fresh processes load the compiled
+    code from disk instead of compiling again. HTML bodies are autoescaped.
+    Templates that only use {{ field }} expressions are rendered through
+    CompiledTemplate, so Jinja2 costs nothing for them.
+    """
+
+    def __init__(self, bytecode_cache_dir: Optional[str] = None):
+        if jinja2 is None:
+            raise RuntimeError("Jinja2 templates require jinja2 (pip install jinja2)")
+        bytecode_cache = None
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+        self._loader = _SourceLoader()
+        self._environments = {
+            autoescape: SandboxedEnvironment(loader=self._loader, autoescape=autoescape,
+                                             bytecode_cache=bytecode_cache,
+                                             keep_trailing_newline=True)
+            for autoescape in (False, True)
+        }
+        self._load_lock = threading.Lock()
+        # Bounded like compile_template, so old template versions are dropped
+        self._compiled = lru_cache(maxsize=512)(self._compile)
+
+    def compile(self, source: str, html: bool = False):
+        """A CompiledTemplate for plain {{ field }} templates, otherwise a JinjaTemplate."""
+        return self._compiled(source, html)
+
+    def check(self, *sources: Optional[str]):
+        """Raise TemplateError for syntax errors or variables that are not placeholder fields."""
+        environment = self._environments[False]
+        unknown = []
+        for source in sources:
+            try:
+                names = meta.find_undeclared_variables(environment.parse(source or ""))
+            except jinja2.TemplateSyntaxError as e:
+                raise TemplateError(f"Template syntax error on line {e.lineno}: {e.message}")
+            unknown += sorted(name for name in names if name not in PLACEHOLDER_FIELDS and name not in unknown)
+        if unknown:
+            raise TemplateError(f"Unknown variables: {', '.join(unknown)} "
+                                f"(available: {', '.join(PLACEHOLDER_FIELDS)})")
+
+    def _compile(self, source: str, html: bool):
+        simple = self._as_placeholders(source)
+        if simple is not None:
+            return compile_template(simple, html)
+        # Autoescaped code differs, so it gets its own name in the bytecode cache
+        name = hashlib.sha256(source.encode('utf-8')).hexdigest() + (".html" if html else ".txt")
+        environment = self._environments[html]
+        with self._load_lock:
+            self._loader.sources[name] = source
+            try:
+                template = environment.get_template(name)
+            finally:
+                del self._loader.sources[name]
+        return JinjaTemplate(environment, template, source)
+
+    @staticmethod
+    def _as_placeholders(source: str) -> Optional[str]:
+        """The template in {{field}} syntax if it uses nothing else from Jinja2, else None."""
+        simple = JINJA_FIELD_PATTERN.sub(
+            lambda match: "{{" + match.group(1) + "}}" if match.group(1) in PLACEHOLDER_FIELDS else match.group(0),
+            source)
+        rest = PLACEHOLDER_PATTERN.sub(
+            lambda match: "" if match.group(1) in PLACEHOLDER_FIELDS else match.group(0), simple)
+        return None if any(markup in rest for markup in JINJA_MARKUP) else simple
+
+
+def check_placeholders(*sources: Optional[str]):
+    """Raise TemplateError if any of the texts uses an unknown placeholder."""
+    unknown = []
+    for source in sources:
+        for name in compile_template(source or "").unknown:
+            if name not in unknown:
+                unknown.append(name)
+    if unknown:
+        raise TemplateError("Unknown placeholders: " + ", ".join("{{" + name + "}}" for name in unknown)
+                            + f" (available: {', '.join(PLACEHOLDER_FIELDS)})")
+
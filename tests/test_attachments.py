@@ -0,0 +1,55 @@
+import base64
+import email
+import mmap
+import os
+
+import pytest
+
+from attachments import AttachmentCache, StreamedAttachment, attachment_headers, encode_attachment
+
+
+def write_file(tmp_path, name, size):
+    path = tmp_path / name
+    path.write_bytes(os.urandom(size))
+    return str(path)
+
+
+@pytest.mark.parametrize("size, chunk_lines", [
+    (0, 3), (1, 3), (56, 3), (57, 3), (58, 3), (4095, 3), (57 * 3 + 2, 3), (200_000, 3),
+    (600_000, mmap.PAGESIZE)
+])
+def test_streamed_body_matches_encodebytes(tmp_path, size, chunk_lines):
+    path = write_file(tmp_path, "data.bin", size)
+    streamed = StreamedAttachment(path, chunk_lines=chunk_lines)
+    chunks = list(streamed.iter_chunks())
+    assert chunks[0] == attachment_headers(path)
+
+    with open(path, "rb") as f:
+        expected = base64.encodebytes(f.read()).rstrip(b"\n").replace(b"\n", b"\r\n")
+    assert b"".join(chunks[1:]) == expected
+    assert len(streamed) == len(b"".join(chunks))
+
+
+def test_streamed_part_matches_cached_part(tmp_path):
+    path = write_file(tmp_path, "report.pdf", 10_000)
+    cache = AttachmentCache(stream_threshold=1024 * 1024)
+    assert cache.get_part(path) == b"".join(StreamedAttachment(path).iter_chunks())
+    assert encode_attachment(path) == cache.get_part(path).split(b"\r\n\r\n", 1)[1]
+
+
+def test_cache_streams_large_files_and_reuses_small_ones(tmp_path):
+    small = write_file(tmp_path, "small.bin", 100)
+    large = write_file(tmp_path, "large.bin", 4096)
+    cache = AttachmentCache(stream_threshold=1024)
+    assert isinstance(cache.get_part(large), StreamedAttachment)
+    cache.get_part(small)
+    cache.get_part(small)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_non_ascii_file_name_is_encoded(tmp_path):
+    path = write_file(tmp_path, "résumé.pdf", 10)
+    headers = attachment_headers(path)
+    assert headers.isascii()
+    part = email.message_from_bytes(headers + b"\r\n")
+    assert part.get_filename() == "résumé.pdf"
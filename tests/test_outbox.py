@@ -0,0 +1,86 @@
+import smtplib
+
+import pytest
+
+from email_automation import EmailAutomation
+from outbox import PERMANENT, TRANSIENT, Outbox, classify_error
+
+
+@pytest.fixture
+def automation(tmp_path, monkeypatch):
+    # Writes the default config, database and log into the temporary directory
+    monkeypatch.chdir(tmp_path)
+    automation = EmailAutomation("config.json")
+    automation.add_customer("ada@example.com", "Ada", "Lovelace")
+    yield automation
+    automation.close()
+
+
+@pytest.fixture
+def outbox(automation):
+    return Outbox(automation.connections, max_attempts=3, base_delay_seconds=0, max_delay_seconds=0)
+
+
+@pytest.fixture
+def customer(automation):
+    return automation.get_customers()[0]
+
+
+def deferred(email="ada@example.com"):
+    return smtplib.SMTPRecipientsRefused({email: (451, b"try again later")})
+
+
+def test_classify_error():
+    assert classify_error(deferred()) == TRANSIENT
+    assert classify_error(smtplib.SMTPRecipientsRefused({"a@x.com": (550, b"no such user")})) == PERMANENT
+    assert classify_error(smtplib.SMTPServerDisconnected("gone")) == TRANSIENT
+    assert classify_error(ConnectionResetError()) == TRANSIENT
+    assert classify_error(ValueError("bad template")) == PERMANENT
+
+
+def test_enqueue_and_claim(outbox, customer):
+    assert outbox.enqueue(customer, "welcome", ["a.pdf"], deferred()) == "pending"
+    rows = outbox.claim_due()
+    assert len(rows) == 1
+    assert rows[0]["to_email"] == "ada@example.com"
+    assert rows[0]["attachments"] == ["a.pdf"]
+    # The claimed row is leased, so a second worker does not get it
+    assert outbox.claim_due() == []
+
+
+def test_enqueue_skips_duplicates_and_dead_letters_permanent_errors(outbox, customer):
+    outbox.enqueue(customer, "welcome", None, deferred())
+    outbox.enqueue(customer, "welcome", None, deferred())
+    assert outbox.enqueue(customer, "other", None, ValueError("bad template")) == "dead"
+    assert outbox.counts() == {"pending": 1, "sent": 0, "dead": 1}
+
+
+def test_mark_failed_gives_up_after_max_attempts(outbox, customer):
+    outbox.enqueue(customer, "welcome", None, deferred())
+    entry = outbox.claim_due()[0]
+    assert outbox.mark_failed(entry, deferred()) == "pending"
+    entry["attempts"] += 1
+    assert outbox.mark_failed(entry, deferred()) == "dead"
+    assert outbox.counts()["dead"] == 1
+
+    assert outbox.requeue_dead("welcome") == 1
+    assert [row["attempts"] for row in outbox.claim_due()] == [0]
+
+
+def test_mark_sent(outbox, customer):
+    outbox.enqueue(customer, "welcome", None, deferred())
+    outbox.mark_sent(outbox.claim_due()[0]["id"])
+    assert outbox.counts() == {"pending": 0, "sent": 1, "dead": 0}
+
+
+def test_backoff_doubles_up_to_the_cap(automation):
+    outbox = Outbox(automation.connections, base_delay_seconds=10, max_delay_seconds=60)
+    for attempts, delay in [(1, 10), (2, 20), (3, 40), (4, 60), (10, 60)]:
+        assert delay / 2 <= outbox.backoff(attempts) <= delay
+
+
+def test_expired_lease_comes_due_again(automation, customer):
+    outbox = Outbox(automation.connections, base_delay_seconds=0, max_delay_seconds=0, lease_seconds=-1)
+    outbox.enqueue(customer, "welcome", None, deferred())
+    assert len(outbox.claim_due()) == 1
+    assert len(outbox.claim_due()) == 1
@@ -0,0 +1,91 @@
+import json
+import smtplib
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from redis_queue import RedisSendQueue
+
+CONTENT = {"subject": "Hi", "body_html": "<p>Hi</p>", "body_text": "Hi", "attachments": None}
+
+
+@pytest.fixture
+def send_queue():
+    return RedisSendQueue(fakeredis.FakeRedis(), visibility_timeout=60, max_in_flight=3,
+                          max_attempts=2, base_delay_seconds=0, max_delay_seconds=0)
+
+
+def customers(count):
+    return [{"id": i, "email": f"user{i}@example.com"} for i in range(1, count + 1)]
+
+
+def deferred():
+    return smtplib.SMTPRecipientsRefused({"user1@example.com": (451, b"try again later")})
+
+
+def test_enqueue_and_claim(send_queue):
+    campaign_id = send_queue.enqueue_campaign(CONTENT, customers(2))
+    jobs = send_queue.claim(10)
+    assert sorted(job["customer"]["id"] for _, job, _ in jobs) == [1, 2]
+    assert all(job["campaign"] == campaign_id for _, job, _ in jobs)
+    assert send_queue.campaign(campaign_id) == CONTENT
+    assert send_queue.stats() == {"pending": 0, "in_flight": 2, "dead": 0}
+
+
+def test_claim_respects_in_flight_cap(send_queue):
+    send_queue.enqueue_campaign(CONTENT, customers(5))
+    assert len(send_queue.claim(10)) == 3
+    assert send_queue.claim(10) == []
+
+
+def test_claim_drops_ids_without_payload(send_queue):
+    send_queue.enqueue_campaign(CONTENT, customers(1))
+    send_queue.client.zadd(send_queue.ready_key, {"orphan": 0})
+    assert [job["customer"]["id"] for _, job, _ in send_queue.claim(10)] == [1]
+    assert send_queue.stats() == {"pending": 0, "in_flight": 1, "dead": 0}
+
+
+def test_ack_reports_the_customer_as_sent(send_queue):
+    send_queue.enqueue_campaign(CONTENT, customers(2))
+    for job_id, job, lease in send_queue.claim(10):
+        assert send_queue.ack(job_id, job, lease)
+    assert send_queue.stats() == {"pending": 0, "in_flight": 0, "dead": 0}
+    assert send_queue.client.hlen(send_queue.jobs_key) == 0
+    assert sorted(send_queue.drain_sent()) == [1, 2]
+    assert send_queue.drain_sent() == []
+
+
+def test_fail_retries_transient_errors_then_dead_letters(send_queue):
+    send_queue.enqueue_campaign(CONTENT, customers(1))
+    job_id, job, lease = send_queue.claim()[0]
+    assert send_queue.fail(job_id, job, deferred(), lease) == "pending"
+
+    job_id, job, lease = send_queue.claim()[0]
+    assert job["attempts"] == 1
+    assert send_queue.fail(job_id, job, deferred(), lease) == "dead"
+    assert send_queue.stats() == {"pending": 0, "in_flight": 0, "dead": 1}
+    assert json.loads(send_queue.client.hget(send_queue.jobs_key, job_id))["attempts"] == 2
+
+
+def test_fail_dead_letters_permanent_errors(send_queue):
+    send_queue.enqueue_campaign(CONTENT, customers(1))
+    job_id, job, lease = send_queue.claim()[0]
+    assert send_queue.fail(job_id, job, ValueError("bad template"), lease) == "dead"
+
+
+def test_expired_lease_is_reclaimed_and_old_lease_cannot_ack(send_queue):
+    send_queue.visibility_timeout = -1
+    send_queue.enqueue_campaign(CONTENT, customers(1))
+    job_id, job, old_lease = send_queue.claim()[0]
+    assert send_queue.reclaim_expired() == 1
+
+    send_queue.visibility_timeout = 60
+    _, _, lease = send_queue.claim()[0]
+    assert not send_queue.ack(job_id, job, old_lease)
+    assert send_queue.fail(job_id, job, deferred(), old_lease) == "lost"
+    assert send_queue.stats()["in_flight"] == 1
+    assert send_queue.drain_sent() == []
+
+    assert send_queue.ack(job_id, job, lease)
+    assert send_queue.drain_sent() == [1]
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from attachments import StreamedAttachment
+from message_builder import StreamedMessage
+from smtp_pool import quote_data
+from spool import SpoolReader, SpoolWriter, write_manifest
+
+MESSAGES = [
+    b"Subject: one\r\n\r\nHello\r\n",
+    b"Subject: two\n\n.leading dot\nbare newlines",
+    b"Subject: three\r\n\r\n" + b"x" * 5000 + b"\r\n.\r\n",
+]
+
+
+def write_spool(path, messages, max_segment_bytes=256 * 1024 * 1024):
+    writer = SpoolWriter(str(path), "segment-000", max_segment_bytes)
+    for number, data in enumerate(messages):
+        writer.write(data, [number], [f"user{number}@example.com"])
+    writer.close()
+    write_manifest(str(path), {"messages": writer.messages})
+    return writer
+
+
+def read_spool(path):
+    reader = SpoolReader(str(path))
+    try:
+        return [(entry, reader.message(segment, entry).as_bytes())
+                for segment in reader.segments() for entry in reader.entries(segment)]
+    finally:
+        reader.close()
+
+
+def test_round_trip(tmp_path):
+    writer = write_spool(tmp_path, MESSAGES)
+    assert (writer.messages, writer.recipients) == (3, 3)
+    stored = read_spool(tmp_path)
+    assert [data for _, data in stored] == [quote_data(data) for data in MESSAGES]
+    assert [entry["ids"] for entry, _ in stored] == [[0], [1], [2]]
+    assert stored[1][0]["rcpt"] == ["user1@example.com"]
+
+
+def test_segments_roll_over(tmp_path):
+    write_spool(tmp_path, MESSAGES * 3, max_segment_bytes=100)
+    reader = SpoolReader(str(tmp_path))
+    assert len(reader.segments()) > 1
+    reader.close()
+    assert [data for _, data in read_spool(tmp_path)] == [quote_data(data) for data in MESSAGES * 3]
+
+
+def test_streamed_message_round_trip(tmp_path):
+    attachment_path = tmp_path / "data.bin"
+    attachment_path.write_bytes(os.urandom(10_000))
+    attachment = StreamedAttachment(str(attachment_path), chunk_lines=7)
+    head = b"Subject: attached\r\n\r\n--b\r\n"
+    message = StreamedMessage([head, attachment, b"\r\n--b--\r\n"])
+    spool_path = tmp_path / "spool"
+    spool_path.mkdir()
+    write_spool(spool_path, [message])
+    assert read_spool(spool_path)[0][1] == quote_data(message.as_bytes())
+
+
+def test_delivered_log(tmp_path):
+    write_spool(tmp_path, MESSAGES)
+    reader = SpoolReader(str(tmp_path))
+    segment = reader.segments()[0]
+    reader.mark_delivered(segment, 0, 1)
+    reader.mark_delivered(segment, 2, 0)
+    reader.close()
+    assert SpoolReader(str(tmp_path)).delivered(segment) == {0, 2}
+
+
+def test_spool_without_manifest_is_refused(tmp_path):
+    writer = SpoolWriter(str(tmp_path), "segment-000")
+    writer.write(MESSAGES[0], [1], ["user1@example.com"])
+    writer.close()
+    with pytest.raises(ValueError, match="incomplete"):
+        SpoolReader(str(tmp_path))
@@ -0,0 +1,55 @@
+import pytest
+
+from template_engine import (CompiledTemplate, TemplateError, check_placeholders, compile_template,
+                             placeholder_values)
+
+CUSTOMER = {"first_name": "Ada", "last_name": "Lovelace", "email": "ada@example.com",
+            "company": "R&D <Labs>", "phone": None}
+
+
+def replace_render(source, values):
+    """Rendering as it was done before templates were compiled."""
+    for name, value in values.items():
+        source = source.replace("{{" + name + "}}", value)
+    return source
+
+
+@pytest.mark.parametrize("source", [
+    "",
+    "no placeholders",
+    "{{first_name}}",
+    "Hi {{first_name}} {{last_name}}, welcome to {{company}}!",
+    "{{full_name}}{{full_name}} <{{email}}> {{phone}}",
+    "Dear {{nickname}} and {{first_name}}",
+])
+def test_render_matches_str_replace(source):
+    values = placeholder_values(CUSTOMER)
+    assert CompiledTemplate(source).render(values) == replace_render(source, values)
+
+
+def test_fields_and_unknown_placeholders():
+    template = CompiledTemplate("{{first_name}} {{nickname}} {{first_name}} {{email}} {{nickname}}")
+    assert template.fields == ("first_name", "email")
+    assert template.unknown == ("nickname",)
+    assert template.render(placeholder_values(CUSTOMER)) == "Ada {{nickname}} Ada ada@example.com {{nickname}}"
+
+
+def test_escape_html_values():
+    template = CompiledTemplate("<p>{{company}} / {{first_name}}</p>", escape=True)
+    assert template.render(placeholder_values(CUSTOMER)) == "<p>R&amp;D &lt;Labs&gt; / Ada</p>"
+
+
+def test_missing_values_render_empty():
+    values = placeholder_values({"email": "x@example.com", "last_name": None})
+    assert CompiledTemplate("[{{first_name}}|{{full_name}}|{{phone}}]").render(values) == "[||]"
+
+
+def test_compile_template_is_cached():
+    assert compile_template("Hi {{first_name}}") is compile_template("Hi {{first_name}}")
+    assert compile_template("Hi {{first_name}}") is not compile_template("Hi {{first_name}}", True)
+
+
+def test_check_placeholders():
+    check_placeholders("Hi {{first_name}}", None, "{{company}}")
+    with pytest.raises(TemplateError, match=r"\{\{nickname\}\}"):
+        check_placeholders("Hi {{nickname}}")